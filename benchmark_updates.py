@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Update delivery benchmark for VPN Telegram Bot
+Runs the real application in webhook mode against a local Bot API stub
+and POSTs synthetic Update JSON to measure updates/sec and the latency of
+the purchase flow (start -> show_plans -> select_payment_method).
+
+Usage: python benchmark_updates.py [--updates 1000] [--concurrency 50]
+       python benchmark_updates.py --scenario purchase [--users 200] [--api-latency 0.05]
+"""
+
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import tempfile
+import statistics
+from itertools import count
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BOT_TOKEN = '123456:BENCHMARK'
+SECRET_TOKEN = 'benchmark_secret'
+
+from aiohttp import web, ClientSession, TCPConnector
+
+
+class StubBotApi:
+    """Local HTTP server answering Bot API methods used by the bot"""
+    
+    def __init__(self, latency: float = 0):
+        self.latency = latency  # Simulated Bot API round trip, seconds
+        self.calls = {}
+        self.message_ids = count(1)
+        self.sent = asyncio.Event()
+        self.expected_messages = 0
+        self.replies = {}
+        self.history = {}
+        self.runner = None
+        self.base_url = None
+    
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        """Future resolved by the next message sent or edited in chat"""
+        future = asyncio.get_running_loop().create_future()
+        self.replies[chat_id] = future
+        return future
+    
+    def _message(self, params):
+        chat_id = int(params.get('chat_id') or 1)
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', '')
+        }
+    
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            self.history.setdefault(chat_id, []).append(params.get('text', ''))
+            future = self.replies.pop(chat_id, None)
+            if future and not future.done():
+                future.set_result(method)
+        
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'VPN Bot', 'username': 'vpn_benchmark_bot'}
+        elif method in ('sendMessage', 'sendDocument', 'sendPhoto', 'editMessageText'):
+            result = self._message(params)
+            if method == 'sendMessage' and self.calls[method] >= self.expected_messages:
+                self.sent.set()
+        else:
+            result = True  # setWebhook, deleteWebhook, answerCallbackQuery, ...
+        return web.json_response({'ok': True, 'result': result})
+    
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/bot"
+    
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def make_message_update(update_id: int, user_id: int, text: str) -> dict:
+    """Build synthetic message Update JSON"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': f"User{user_id}"},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'language_code': 'ru'},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_callback_update(update_id: int, user_id: int, data: str) -> dict:
+    """Build synthetic callback query Update JSON"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'language_code': 'ru'},
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'VPN Bot'},
+                'text': 'menu'
+            }
+        }
+    }
+
+
+def configure_environment(api_url: str, port: int, database_url: str):
+    """Point bot configuration at the local stub before importing the bot"""
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'ADMIN_IDS': '1',
+        'DATABASE_URL': database_url,
+        'TELEGRAM_API_URL': api_url,
+        'BOT_MODE': 'webhook',
+        'WEBHOOK_LISTEN': '127.0.0.1',
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_URL': f"http://127.0.0.1:{port}",
+        'WEBHOOK_PATH': 'telegram',
+        'WEBHOOK_SECRET_TOKEN': SECRET_TOKEN,
+        'LOG_LEVEL': 'WARNING'
+    })
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def start_bot():
+    """Create application and start it in webhook mode"""
+    from bot.main import create_application, webhook_options, post_init
+    
+    application = create_application()
+    await application.initialize()
+    await post_init(application)
+    await application.updater.start_webhook(**webhook_options())
+    await application.start()
+    return application
+
+
+async def stop_bot(application):
+    from bot.main import post_shutdown
+    
+    await application.updater.stop()
+    await application.stop()
+    await post_shutdown(application)
+    await application.shutdown()
+
+
+async def post_updates(url: str, updates: list, concurrency: int, secret: str = SECRET_TOKEN) -> list:
+    """POST updates to webhook endpoint, returning HTTP statuses"""
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+    
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(url, data=json.dumps(update), headers=headers) as response:
+                    return response.status
+        
+        return await asyncio.gather(*[post(update) for update in updates])
+
+
+async def run_benchmark(updates_count: int, concurrency: int) -> dict:
+    """Measure webhook accept and processing throughput for /start updates"""
+    api = StubBotApi()
+    await api.start()
+    port = free_port()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_environment(api.base_url, port, f"sqlite:///{tmp}/benchmark.db")
+        application = await start_bot()
+        url = f"http://127.0.0.1:{port}/telegram"
+        
+        try:
+            # Requests without the secret token are rejected
+            statuses = await post_updates(url, [make_message_update(0, 999, '/start')], 1, secret='wrong')
+            assert statuses == [403], statuses
+            
+            api.calls.clear()
+            api.expected_messages = updates_count
+            updates = [make_message_update(i, 100000 + i, '/start') for i in range(1, updates_count + 1)]
+            
+            started = time.perf_counter()
+            statuses = await post_updates(url, updates, concurrency)
+            accepted = time.perf_counter() - started
+            await asyncio.wait_for(api.sent.wait(), timeout=300)
+            processed = time.perf_counter() - started
+            
+            assert all(status == 200 for status in statuses), set(statuses)
+        finally:
+            await stop_bot(application)
+            await api.stop()
+    
+    return {
+        'updates': updates_count,
+        'accepted_per_sec': updates_count / accepted,
+        'processed_per_sec': updates_count / processed,
+        'processed_seconds': processed,
+        'api_calls': dict(api.calls)
+    }
+
+
+def percentile(values: list, percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+PURCHASE_FLOW = [
+    ('start_command', lambda i, user_id: make_message_update(i, user_id, '/start')),
+    ('show_plans', lambda i, user_id: make_callback_update(i, user_id, 'buy_vpn')),
+    ('select_payment_method', lambda i, user_id: make_callback_update(i, user_id, 'plan_1_month'))
+]
+
+
+async def run_purchase_benchmark(users: int, api_latency: float, update_concurrency: int) -> dict:
+    """Feed simulated users through the purchase flow and measure step latency"""
+    api = StubBotApi(latency=api_latency)
+    await api.start()
+    port = free_port()
+    update_ids = count(1)
+    latencies = {step: [] for step, _ in PURCHASE_FLOW}
+    
+    async def user_flow(session, url, user_id):
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN}
+        for step, make_update in PURCHASE_FLOW:
+            reply = api.expect_reply(user_id)
+            started = time.perf_counter()
+            async with session.post(url, data=json.dumps(make_update(next(update_ids), user_id)), headers=headers):
+                pass
+            await asyncio.wait_for(reply, timeout=60)
+            latencies[step].append(time.perf_counter() - started)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_environment(api.base_url, port, f"sqlite:///{tmp}/benchmark.db")
+        os.environ['UPDATE_CONCURRENCY'] = str(update_concurrency)
+        application = await start_bot()
+        url = f"http://127.0.0.1:{port}/telegram"
+        
+        try:
+            started = time.perf_counter()
+            async with ClientSession(connector=TCPConnector(limit=0)) as session:
+                await asyncio.gather(*[user_flow(session, url, 200000 + i) for i in range(users)])
+            elapsed = time.perf_counter() - started
+            
+            # Burst of one user's updates without waiting for replies must
+            # end in the same conversation state as the step-by-step flow
+            burst_user = 100
+            updates = [make_update(next(update_ids), burst_user) for _, make_update in PURCHASE_FLOW]
+            await post_updates(url, updates, 1)
+            for _ in range(600):
+                if len(api.history.get(burst_user, [])) >= len(PURCHASE_FLOW):
+                    break
+                await asyncio.sleep(0.05)
+            ordered = api.history.get(burst_user) == api.history[200000]
+        finally:
+            await stop_bot(application)
+            await api.stop()
+    
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'users': users,
+        'elapsed': elapsed,
+        'updates_per_sec': len(all_latencies) / elapsed,
+        'steps': {step: (percentile(values, 50), percentile(values, 99)) for step, values in latencies.items()},
+        'p50': statistics.median(all_latencies),
+        'p99': percentile(all_latencies, 99),
+        'ordered': ordered
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhook update delivery benchmark')
+    parser.add_argument('--updates', type=int, default=1000, help='number of synthetic updates')
+    parser.add_argument('--concurrency', type=int, default=50, help='parallel webhook requests')
+    parser.add_argument('--scenario', choices=['start', 'purchase'], default='start')
+    parser.add_argument('--users', type=int, default=200, help='simulated users in purchase scenario')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='simulated Bot API latency, seconds')
+    parser.add_argument('--update-concurrency', type=int, default=64, help='UPDATE_CONCURRENCY of the bot')
+    args = parser.parse_args()
+    
+    if args.scenario == 'purchase':
+        print(f"🚀 {args.users} users: start -> show_plans -> select_payment_method "
+              f"(API latency {args.api_latency * 1000:.0f} ms, UPDATE_CONCURRENCY={args.update_concurrency})...")
+        result = asyncio.run(run_purchase_benchmark(args.users, args.api_latency, args.update_concurrency))
+        
+        for step, (p50, p99) in result['steps'].items():
+            print(f"   {step:<24} p50 {p50 * 1000:7.1f} ms   p99 {p99 * 1000:7.1f} ms")
+        print(f"⏱️ All steps: p50 {result['p50'] * 1000:.1f} ms, p99 {result['p99'] * 1000:.1f} ms")
+        print(f"⚙️ Throughput: {result['updates_per_sec']:.0f} updates/sec ({result['elapsed']:.2f} s)")
+        print(f"🔒 Per-chat ordering: {'✅ preserved' if result['ordered'] else '❌ broken'}")
+        return
+    
+    print(f"🚀 Posting {args.updates} /start updates to webhook ({args.concurrency} in parallel)...")
+    result = asyncio.run(run_benchmark(args.updates, args.concurrency))
+    
+    print(f"📥 Accepted:  {result['accepted_per_sec']:.0f} updates/sec")
+    print(f"⚙️ Processed: {result['processed_per_sec']:.0f} updates/sec ({result['processed_seconds']:.2f} s)")
+    print(f"📡 Bot API calls: {result['api_calls']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ Configuration module for VPN Telegram Bot
 """
 
 import os
+import ipaddress
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,15 +15,85 @@ class Config:
     # Telegram Bot Settings
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
+    TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Local Bot API server, e.g. http://localhost:8082/bot
+    
+    # Telegram Update Delivery
+    BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()  # polling or webhook
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL, e.g. https://your-domain.com
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+    WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # parallel Telegram deliveries
+    UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))  # updates processed in parallel, 1 = sequential
     
     # Database Settings
     DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///vpn_bot.db')
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))  # seconds to wait for a free connection
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # seconds before a connection is replaced
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True').lower() == 'true'
+    DB_AUTO_MIGRATE = os.getenv('DB_AUTO_MIGRATE', 'True').lower() == 'true'  # apply pending migrations on start
     
     # Payment Settings
     YOOMONEY_TOKEN = os.getenv('YOOMONEY_TOKEN')
     QIWI_TOKEN = os.getenv('QIWI_TOKEN')
     CRYPTOMUS_API_KEY = os.getenv('CRYPTOMUS_API_KEY')
     CRYPTOMUS_MERCHANT_ID = os.getenv('CRYPTOMUS_MERCHANT_ID')
+    PAYMENT_HTTP_TIMEOUT = int(os.getenv('PAYMENT_HTTP_TIMEOUT', 10))  # total request timeout, seconds
+    PAYMENT_HTTP_CONNECT_TIMEOUT = int(os.getenv('PAYMENT_HTTP_CONNECT_TIMEOUT', 5))
+    PAYMENT_HTTP_LIMIT = int(os.getenv('PAYMENT_HTTP_LIMIT', 20))  # open connections per provider
+    
+    # Payment Webhooks (provider notifications)
+    PAYMENT_WEBHOOK_ENABLED = os.getenv('PAYMENT_WEBHOOK_ENABLED', 'False').lower() == 'true'
+    PAYMENT_WEBHOOK_HOST = os.getenv('PAYMENT_WEBHOOK_HOST', '0.0.0.0')
+    PAYMENT_WEBHOOK_PORT = int(os.getenv('PAYMENT_WEBHOOK_PORT', 8081))
+    PAYMENT_WEBHOOK_BASE_URL = os.getenv('PAYMENT_WEBHOOK_BASE_URL', 'https://your-domain.com')
+    QIWI_SECRET_KEY = os.getenv('QIWI_SECRET_KEY')
+    YOOMONEY_NOTIFICATION_SECRET = os.getenv('YOOMONEY_NOTIFICATION_SECRET')
+    PAYMENT_CHECK_MIN_INTERVAL = int(os.getenv('PAYMENT_CHECK_MIN_INTERVAL', 10))  # seconds between manual checks
+    
+    # Payment Reconciliation (background status checks)
+    PAYMENT_RECONCILE_INTERVAL = int(os.getenv('PAYMENT_RECONCILE_INTERVAL', 60))  # seconds
+    PAYMENT_RECONCILE_BATCH_SIZE = int(os.getenv('PAYMENT_RECONCILE_BATCH_SIZE', 100))
+    PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv('PAYMENT_RECONCILE_CONCURRENCY', 5))  # parallel checks per provider
+    PAYMENT_RECONCILE_GRACE = int(os.getenv('PAYMENT_RECONCILE_GRACE', 300))  # seconds unanswered checks keep an expired payment pending
+    
+    # User Cache
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))  # users kept in memory, 0 disables cache
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))  # seconds
+    ACTIVITY_FLUSH_INTERVAL = int(os.getenv('ACTIVITY_FLUSH_INTERVAL', 5))  # seconds between last_activity writes
+    ADMIN_DASHBOARD_CACHE_TTL = int(os.getenv('ADMIN_DASHBOARD_CACHE_TTL', 5))  # seconds admin panel metrics are reused
+    STATS_ROLLUP_INTERVAL = int(os.getenv('STATS_ROLLUP_INTERVAL', 3600))  # seconds between daily rollup checks
+    
+    # Broadcasts
+    BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 30))  # messages per second, Telegram global limit
+    BROADCAST_CHAT_INTERVAL = float(os.getenv('BROADCAST_CHAT_INTERVAL', 1.0))  # seconds between messages to one chat
+    BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))  # messages in flight
+    BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', 100))  # recipients per checkpoint
+    BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', 3))
+    BROADCAST_PROGRESS_INTERVAL = int(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))  # seconds between progress edits
+    
+    # QR Code Cache
+    QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', 256))  # PNGs kept in memory, 0 disables memory cache
+    QR_CACHE_DIR = os.getenv('QR_CACHE_DIR', '')  # directory for PNGs on disk, empty disables disk cache
+    QR_CACHE_DISK_SIZE = int(os.getenv('QR_CACHE_DISK_SIZE', 10000))  # PNGs kept on disk
+    QR_RENDER_EXECUTOR = os.getenv('QR_RENDER_EXECUTOR', 'thread')  # thread or process
+    QR_RENDER_WORKERS = int(os.getenv('QR_RENDER_WORKERS', 2))
+    
+    # VPN Key Pool
+    VPN_KEY_PREFETCH = int(os.getenv('VPN_KEY_PREFETCH', 5))  # keys reserved per location at once
+    VPN_KEY_RESERVATION_TTL = int(os.getenv('VPN_KEY_RESERVATION_TTL', 600))  # seconds before unassigned reservations return to the pool
+    
+    # WireGuard Client Addresses and Keys
+    WG_CLIENT_NETWORK = os.getenv('WG_CLIENT_NETWORK', '10.8.0.0/16')  # per-server client network, .1 is the server
+    ADDRESS_RELEASE_INTERVAL = int(os.getenv('ADDRESS_RELEASE_INTERVAL', 300))  # seconds between expired address sweeps
+    WG_KEYPAIR_POOL_SIZE = int(os.getenv('WG_KEYPAIR_POOL_SIZE', 256))  # pre-generated key pairs, 0 generates inline
+    WG_KEYPAIR_POOL_LOW_WATER = int(os.getenv('WG_KEYPAIR_POOL_LOW_WATER', 64))  # refill when fewer pairs are left
+    
+    # Server Registry
+    SERVER_REFRESH_INTERVAL = int(os.getenv('SERVER_REFRESH_INTERVAL', 300))  # seconds between expired peer sweeps and reloads
     
     # VPN Settings
     VPN_SERVER_URL = os.getenv('VPN_SERVER_URL')
@@ -54,6 +125,28 @@ class Config:
             raise ValueError("BOT_TOKEN is required")
         if not cls.ADMIN_IDS:
             raise ValueError("At least one ADMIN_ID is required")
+        if cls.BOT_MODE not in ('polling', 'webhook'):
+            raise ValueError("BOT_MODE must be 'polling' or 'webhook'")
+        if cls.UPDATE_CONCURRENCY < 1:
+            raise ValueError("UPDATE_CONCURRENCY must be at least 1")
+        if cls.BOT_MODE == 'webhook' and not cls.WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL is required in webhook mode")
+        if cls.PAYMENT_WEBHOOK_ENABLED:
+            # Notifications of a provider without its secret would all be rejected
+            if cls.YOOMONEY_TOKEN and not cls.YOOMONEY_NOTIFICATION_SECRET:
+                raise ValueError("YOOMONEY_NOTIFICATION_SECRET is required for payment webhooks")
+            if cls.QIWI_TOKEN and not cls.QIWI_SECRET_KEY:
+                raise ValueError("QIWI_SECRET_KEY is required for payment webhooks")
+        if cls.QR_RENDER_EXECUTOR not in ('thread', 'process'):
+            raise ValueError("QR_RENDER_EXECUTOR must be 'thread' or 'process'")
+        try:
+            network = ipaddress.ip_network(cls.WG_CLIENT_NETWORK)
+        except ValueError:
+            raise ValueError("WG_CLIENT_NETWORK must be a network in CIDR notation")
+        if not 4 <= network.num_addresses <= 2 ** 20:
+            raise ValueError("WG_CLIENT_NETWORK must have between 4 and 1048576 addresses")
+        if cls.WG_KEYPAIR_POOL_SIZE < 0 or cls.WG_KEYPAIR_POOL_LOW_WATER < 0:
+            raise ValueError("WG_KEYPAIR_POOL_SIZE and WG_KEYPAIR_POOL_LOW_WATER must not be negative")
         return True
 
 
@@ -1,13 +1,14 @@
 """Admin handlers for VPN Telegram Bot"""
 
 import logging
-import asyncio
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from sqlalchemy import func, desc
+from telegram.error import BadRequest
+from sqlalchemy import select, func, desc
+from sqlalchemy.orm import selectinload
 
-from bot.models.database import DatabaseManager, User, Subscription, Payment, VPNKey, BotStats
+from bot.models.database import get_db_manager, User, Subscription, Payment, VPNKey, BotStats
 from bot.config.settings import Config
 from bot.utils.helpers import (
     is_admin, 
@@ -17,16 +18,58 @@ from bot.utils.helpers import (
     format_time_ago,
     StatsCalculator
 )
+from bot.utils.cache import user_cache, qr_cache
+from bot.utils.billing import delivery_stats
+from bot.utils.activity import activity_tracker
+from bot.utils.dashboard import dashboard_metrics
+from bot.utils.rollups import stats_rollup, day_start
+from bot.utils.broadcast import broadcast_manager, broadcast_cancel_keyboard, broadcast_segment_keyboard
+from bot.utils.segments import parse_segment, describe_segment, count_segment
+from bot.utils.servers import server_registry
 from locales.ru import get_message
 
 logger = logging.getLogger(__name__)
 
-db_manager = DatabaseManager(Config.DATABASE_URL)
+db_manager = get_db_manager()
 
 # Admin conversation states
 WAITING_BROADCAST_MESSAGE = 1
 
 
+def build_admin_panel(metrics: dict, refreshed: bool = False):
+    """Build admin panel text and keyboard from dashboard metrics"""
+    admin_text = get_message('admin_panel',
+        total_users=metrics['total_users'],
+        active_subscriptions=metrics['active_subscriptions'],
+        daily_revenue=int(metrics['daily_revenue']),
+        monthly_revenue=int(metrics['monthly_revenue']),
+        available_keys=metrics['available_keys'],
+        new_users=metrics['new_users'],
+        last_update=format_datetime(metrics['updated_at'])
+    )
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("👥 Пользователи", callback_data='admin_users'),
+            InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')
+        ],
+        [
+            InlineKeyboardButton("🔑 VPN ключи", callback_data='admin_keys'),
+            InlineKeyboardButton("💰 Платежи", callback_data='admin_payments')
+        ],
+        [
+            InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast'),
+            InlineKeyboardButton("📋 Логи", callback_data='admin_logs')
+        ],
+        [
+            InlineKeyboardButton("⚙️ Настройки", callback_data='admin_settings'),
+            InlineKeyboardButton("🔄 Обновлено ✅" if refreshed else "🔄 Обновить", callback_data='admin_refresh')
+        ]
+    ]
+    
+    return admin_text, InlineKeyboardMarkup(keyboard)
+
+
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show admin panel"""
     user_id = update.effective_user.id
@@ -35,84 +78,15 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text(get_message('admin_not_authorized'))
         return
     
-    session = db_manager.get_session()
-    try:
-        # Get comprehensive statistics
-        total_users = session.query(User).count()
-        active_users = session.query(User).filter(
-            User.last_activity >= datetime.utcnow() - timedelta(days=7)
-        ).count()
-        
-        active_subscriptions = session.query(Subscription).filter(
-            Subscription.is_active == True,
-            Subscription.end_date > datetime.utcnow()
-        ).count()
-        
-        # Daily revenue
-        today = datetime.utcnow().date()
-        daily_revenue = session.query(func.sum(Payment.amount)).filter(
-            Payment.status == 'completed',
-            Payment.completed_at >= today
-        ).scalar() or 0
-        daily_revenue = daily_revenue / 100  # Convert from kopecks
-        
-        # Monthly revenue
-        start_of_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        monthly_revenue = session.query(func.sum(Payment.amount)).filter(
-            Payment.status == 'completed',
-            Payment.completed_at >= start_of_month
-        ).scalar() or 0
-        monthly_revenue = monthly_revenue / 100  # Convert from kopecks
-        
-        # Available VPN keys
-        available_keys = session.query(VPNKey).filter(VPNKey.is_used == False).count()
-        
-        # New users today
-        new_users = session.query(User).filter(
-            User.created_at >= today
-        ).count()
-        
-        admin_text = get_message('admin_panel',
-            total_users=total_users,
-            active_subscriptions=active_subscriptions,
-            daily_revenue=int(daily_revenue),
-            monthly_revenue=int(monthly_revenue),
-            available_keys=available_keys,
-            new_users=new_users,
-            last_update=format_datetime(datetime.utcnow())
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("👥 Пользователи", callback_data='admin_users'),
-                InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')
-            ],
-            [
-                InlineKeyboardButton("🔑 VPN ключи", callback_data='admin_keys'),
-                InlineKeyboardButton("💰 Платежи", callback_data='admin_payments')
-            ],
-            [
-                InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast'),
-                InlineKeyboardButton("📋 Логи", callback_data='admin_logs')
-            ],
-            [
-                InlineKeyboardButton("⚙️ Настройки", callback_data='admin_settings'),
-                InlineKeyboardButton("🔄 Обновить", callback_data='admin_refresh')
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            text=admin_text,
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
-        
-        log_admin_action(user_id, "accessed_admin_panel")
-        
-    finally:
-        session.close()
+    admin_text, reply_markup = build_admin_panel(await dashboard_metrics.get())
+    
+    await update.message.reply_text(
+        text=admin_text,
+        reply_markup=reply_markup,
+        parse_mode='HTML'
+    )
+    
+    await log_admin_action(user_id, "accessed_admin_panel")
 
 
 async def admin_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -156,73 +130,20 @@ async def admin_panel_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     user_id = update.effective_user.id
     
-    session = db_manager.get_session()
+    admin_text, reply_markup = build_admin_panel(await dashboard_metrics.get(), refreshed=True)
+    
     try:
-        # Get fresh statistics
-        total_users = session.query(User).count()
-        active_subscriptions = session.query(Subscription).filter(
-            Subscription.is_active == True,
-            Subscription.end_date > datetime.utcnow()
-        ).count()
-        
-        today = datetime.utcnow().date()
-        daily_revenue = session.query(func.sum(Payment.amount)).filter(
-            Payment.status == 'completed',
-            Payment.completed_at >= today
-        ).scalar() or 0
-        daily_revenue = daily_revenue / 100
-        
-        start_of_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        monthly_revenue = session.query(func.sum(Payment.amount)).filter(
-            Payment.status == 'completed',
-            Payment.completed_at >= start_of_month
-        ).scalar() or 0
-        monthly_revenue = monthly_revenue / 100
-        
-        available_keys = session.query(VPNKey).filter(VPNKey.is_used == False).count()
-        new_users = session.query(User).filter(User.created_at >= today).count()
-        
-        admin_text = get_message('admin_panel',
-            total_users=total_users,
-            active_subscriptions=active_subscriptions,
-            daily_revenue=int(daily_revenue),
-            monthly_revenue=int(monthly_revenue),
-            available_keys=available_keys,
-            new_users=new_users,
-            last_update=format_datetime(datetime.utcnow())
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("👥 Пользователи", callback_data='admin_users'),
-                InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')
-            ],
-            [
-                InlineKeyboardButton("🔑 VPN ключи", callback_data='admin_keys'),
-                InlineKeyboardButton("💰 Платежи", callback_data='admin_payments')
-            ],
-            [
-                InlineKeyboardButton("📢 Рассылка", callback_data='admin_broadcast'),
-                InlineKeyboardButton("📋 Логи", callback_data='admin_logs')
-            ],
-            [
-                InlineKeyboardButton("⚙️ Настройки", callback_data='admin_settings'),
-                InlineKeyboardButton("🔄 Обновлено ✅", callback_data='admin_refresh')
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             text=admin_text,
             reply_markup=reply_markup,
             parse_mode='HTML'
         )
-        
-        log_admin_action(user_id, "refreshed_admin_panel")
-        
-    finally:
-        session.close()
+    except BadRequest as e:
+        # Metrics served from cache did not change since the last refresh
+        if 'not modified' not in str(e).lower():
+            raise
+    
+    await log_admin_action(user_id, "refreshed_admin_panel")
 
 
 async def admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -230,15 +151,20 @@ async def admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     query = update.callback_query
     user_id = update.effective_user.id
     
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
         # Get recent users with pagination
         page = context.user_data.get('admin_users_page', 0)
         limit = 10
         offset = page * limit
         
-        users = session.query(User).order_by(desc(User.created_at)).offset(offset).limit(limit).all()
-        total_users = session.query(User).count()
+        users = (await session.execute(
+            select(User)
+            .order_by(desc(User.created_at))
+            .offset(offset)
+            .limit(limit)
+        )).scalars().all()
+        total_users = await session.scalar(select(func.count(User.id)))
         
         users_text = f"👥 Пользователи (стр. {page + 1}):\n\n"
         
@@ -286,7 +212,7 @@ async def admin_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         
     finally:
-        session.close()
+        await session.close()
 
 
 async def admin_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -294,64 +220,66 @@ async def admin_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     user_id = update.effective_user.id
     
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
         # Calculate comprehensive stats
-        stats = StatsCalculator.calculate_daily_stats()
+        stats = await StatsCalculator.calculate_daily_stats()
         
         # User statistics
-        total_users = session.query(User).count()
-        active_users_week = session.query(User).filter(
+        total_users = await session.scalar(select(func.count(User.id)))
+        active_users_week = await session.scalar(select(func.count(User.id)).where(
             User.last_activity >= datetime.utcnow() - timedelta(days=7)
-        ).count()
-        active_users_month = session.query(User).filter(
+        ))
+        active_users_month = await session.scalar(select(func.count(User.id)).where(
             User.last_activity >= datetime.utcnow() - timedelta(days=30)
-        ).count()
+        ))
         
         # Subscription statistics
-        subs_by_plan = session.query(
-            Subscription.plan_type,
-            func.count(Subscription.id)
-        ).filter(
-            Subscription.is_active == True,
-            Subscription.end_date > datetime.utcnow()
-        ).group_by(Subscription.plan_type).all()
-        
-        # Payment statistics
-        total_revenue = session.query(func.sum(Payment.amount)).filter(
-            Payment.status == 'completed'
-        ).scalar() or 0
-        total_revenue = total_revenue / 100
-        
-        # Weekly revenue
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        weekly_revenue = session.query(func.sum(Payment.amount)).filter(
-            Payment.status == 'completed',
-            Payment.completed_at >= week_ago
-        ).scalar() or 0
-        weekly_revenue = weekly_revenue / 100
-        
-        stats_text = f"📊 <b>Подробная статистика</b>\n\n"
-        
-        stats_text += f"👥 <b>Пользователи:</b>\n"
+        subs_by_plan = (await session.execute(
+            select(
+                Subscription.plan_type,
+                func.count(Subscription.id)
+            ).where(
+                Subscription.is_active == True,
+                Subscription.end_date > datetime.utcnow()
+            ).group_by(Subscription.plan_type)
+        )).all()
+        
+        # Payment statistics from daily rollups plus today's live delta
+        today = day_start(datetime.utcnow())
+        total_stats = await stats_rollup.period_stats(datetime.min)
+        weekly_stats = await stats_rollup.period_stats(today - timedelta(days=6))
+        monthly_stats = await stats_rollup.period_stats(today - timedelta(days=29))
+        total_revenue = total_stats['revenue']
+        weekly_revenue = weekly_stats['revenue']
+        
+        stats_text = "📊 <b>Подробная статистика</b>\n\n"
+        
+        stats_text += "👥 <b>Пользователи:</b>\n"
         stats_text += f"   • Всего: {total_users}\n"
         stats_text += f"   • Новых сегодня: {stats['new_users']}\n"
         stats_text += f"   • Активных за неделю: {active_users_week}\n"
         stats_text += f"   • Активных за месяц: {active_users_month}\n\n"
         
-        stats_text += f"📱 <b>Подписки:</b>\n"
+        stats_text += "📱 <b>Подписки:</b>\n"
         stats_text += f"   • Активных: {stats['active_subscriptions']}\n"
         for plan_type, count in subs_by_plan:
             plan_name = plan_type.replace('_', ' ').title()
             stats_text += f"   • {plan_name}: {count}\n"
         stats_text += "\n"
         
-        stats_text += f"💰 <b>Доходы:</b>\n"
+        stats_text += "💰 <b>Доходы:</b>\n"
         stats_text += f"   • Сегодня: {stats['daily_revenue']:.0f} ₽\n"
         stats_text += f"   • За неделю: {weekly_revenue:.0f} ₽\n"
         stats_text += f"   • Всего: {total_revenue:.0f} ₽\n"
         stats_text += f"   • Платежей сегодня: {stats['successful_payments']}\n\n"
         
+        if monthly_stats['by_method']:
+            stats_text += "💳 <b>Способы оплаты (30 дней):</b>\n"
+            for method, entry in sorted(monthly_stats['by_method'].items(), key=lambda item: -item[1]['revenue']):
+                stats_text += f"   • {method.upper()}: {entry['payments']} шт. / {entry['revenue']:.0f} ₽\n"
+            stats_text += "\n"
+        
         stats_text += f"🔄 <b>Обновлено:</b> {format_datetime(datetime.utcnow())}"
         
         keyboard = [
@@ -374,10 +302,10 @@ async def admin_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYP
             parse_mode='HTML'
         )
         
-        log_admin_action(user_id, "viewed_detailed_stats")
+        await log_admin_action(user_id, "viewed_detailed_stats")
         
     finally:
-        session.close()
+        await session.close()
 
 
 async def admin_keys_management(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -385,14 +313,14 @@ async def admin_keys_management(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     user_id = update.effective_user.id
     
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
-        total_keys = session.query(VPNKey).count()
-        available_keys = session.query(VPNKey).filter(VPNKey.is_used == False).count()
+        total_keys = await session.scalar(select(func.count(VPNKey.id)))
+        available_keys = await session.scalar(select(func.count(VPNKey.id)).where(VPNKey.is_used == False))
         used_keys = total_keys - available_keys
         
-        keys_text = f"🔑 <b>Управление VPN ключами</b>\n\n"
-        keys_text += f"📊 <b>Статистика:</b>\n"
+        keys_text = "🔑 <b>Управление VPN ключами</b>\n\n"
+        keys_text += "📊 <b>Статистика:</b>\n"
         keys_text += f"   • Всего ключей: {total_keys}\n"
         keys_text += f"   • Доступных: {available_keys}\n"
         keys_text += f"   • Использованных: {used_keys}\n\n"
@@ -400,6 +328,15 @@ async def admin_keys_management(update: Update, context: ContextTypes.DEFAULT_TY
         if available_keys < 10:
             keys_text += "⚠️ <b>Внимание!</b> Мало доступных ключей!\n\n"
         
+        servers = server_registry.servers()
+        if servers:
+            keys_text += "🖥️ <b>Нагрузка серверов:</b>\n"
+            for server in servers:
+                state = "" if server['is_enabled'] else " (отключён)"
+                keys_text += (f"   • {server['flag'] or '🌍'} {server['location']}: "
+                              f"{server['active_peers']}/{server['capacity']}{state}\n")
+            keys_text += "\n"
+        
         keys_text += f"🔄 <b>Обновлено:</b> {format_datetime(datetime.utcnow())}"
         
         keyboard = [
@@ -423,7 +360,7 @@ async def admin_keys_management(update: Update, context: ContextTypes.DEFAULT_TY
         )
         
     finally:
-        session.close()
+        await session.close()
 
 
 async def admin_payments_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -431,20 +368,26 @@ async def admin_payments_list(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     user_id = update.effective_user.id
     
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
         # Get recent payments
-        payments = session.query(Payment).order_by(desc(Payment.created_at)).limit(20).all()
+        payments = (await session.execute(
+            select(Payment)
+            .options(selectinload(Payment.user))
+            .order_by(desc(Payment.created_at))
+            .limit(20)
+        )).scalars().all()
         
-        payments_text = f"💰 <b>Последние платежи</b>\n\n"
+        payments_text = "💰 <b>Последние платежи</b>\n\n"
         
         for payment in payments:
-            user = session.query(User).filter_by(id=payment.user_id).first()
+            user = payment.user
             status_emoji = {
                 'completed': '✅',
                 'pending': '⏳',
                 'failed': '❌',
-                'cancelled': '🚫'
+                'cancelled': '🚫',
+                'expired': '⌛'
             }.get(payment.status, '❓')
             
             payments_text += f"{status_emoji} <b>{payment.amount_rubles:.0f} ₽</b>\n"
@@ -453,6 +396,15 @@ async def admin_payments_list(update: Update, context: ContextTypes.DEFAULT_TYPE
             payments_text += f"   💳 {payment.payment_method.upper()}\n"
             payments_text += f"   📅 {format_datetime(payment.created_at)}\n\n"
         
+        # Background reconciliation status
+        from bot.utils.reconciliation import payment_reconciler
+        reconcile = payment_reconciler.stats
+        if reconcile['last_run_at']:
+            payments_text += f"🔄 <b>Сверка платежей:</b> {format_datetime(reconcile['last_run_at'])}\n"
+            payments_text += f"   ✅ {reconcile['completed']} | ❌ {reconcile['failed']} | ⌛ {reconcile['expired']} "
+            payments_text += f"из {reconcile['checked']} за {reconcile['last_duration_ms']:.0f} мс\n"
+            payments_text += f"   ⏱️ Задержка: {reconcile['lag_seconds']:.0f} с\n"
+        
         keyboard = [
             [
                 InlineKeyboardButton("💰 Статистика доходов", callback_data='admin_revenue_stats'),
@@ -474,7 +426,7 @@ async def admin_payments_list(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         
     finally:
-        session.close()
+        await session.close()
 
 
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -482,23 +434,24 @@ async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     user_id = update.effective_user.id
     
-    session = db_manager.get_session()
+    segment, segment_param = context.user_data.setdefault('broadcast_segment', ('all', None))
+    
+    session = db_manager.get_async_session()
     try:
-        total_users = session.query(User).count()
-        active_users = session.query(User).filter(
+        total_users = await session.scalar(select(func.count(User.id)))
+        active_users = await session.scalar(select(func.count(User.id)).where(
             User.last_activity >= datetime.utcnow() - timedelta(days=30)
-        ).count()
+        ))
+        recipients = await count_segment(session, segment, segment_param)
         
         broadcast_text = get_message('broadcast_start',
             total_users=total_users,
-            active_users=active_users
+            active_users=active_users,
+            segment=describe_segment(segment, segment_param),
+            recipients=recipients
         )
         
-        keyboard = [
-            [InlineKeyboardButton("⬅️ Назад в админку", callback_data='admin_back')]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = broadcast_segment_keyboard(f"{segment}:{segment_param}" if segment_param else segment)
         
         await query.edit_message_text(
             text=broadcast_text,
@@ -510,7 +463,7 @@ async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TY
         context.user_data['waiting_broadcast'] = True
         
     finally:
-        session.close()
+        await session.close()
 
 
 async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -523,19 +476,21 @@ async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT
     broadcast_message = update.message.text
     context.user_data['waiting_broadcast'] = False
     context.user_data['broadcast_message'] = broadcast_message
+    segment, segment_param = context.user_data.get('broadcast_segment', ('all', None))
     
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
-        total_users = session.query(User).count()
+        recipients = await count_segment(session, segment, segment_param)
         
         confirm_text = get_message('broadcast_confirm',
-            recipients=total_users,
+            segment=describe_segment(segment, segment_param),
+            recipients=recipients,
             message=broadcast_message
         )
         
         keyboard = [
             [
-                InlineKeyboardButton("✅ Отправить всем", callback_data='admin_broadcast_confirm'),
+                InlineKeyboardButton("✅ Отправить", callback_data='admin_broadcast_confirm'),
                 InlineKeyboardButton("❌ Отмена", callback_data='admin_back')
             ]
         ]
@@ -549,83 +504,93 @@ async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT
         )
         
     finally:
-        session.close()
+        await session.close()
 
 
 async def admin_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Confirm and execute broadcast"""
+    """Confirm broadcast and start sending it in the background"""
     query = update.callback_query
     await query.answer("📢 Начинаем рассылку...")
     
     user_id = update.effective_user.id
-    broadcast_message = context.user_data.get('broadcast_message')
+    if not is_admin(user_id):
+        return
+    
+    broadcast_message = context.user_data.pop('broadcast_message', None)
+    segment, segment_param = context.user_data.pop('broadcast_segment', ('all', None))
     
     if not broadcast_message:
         await query.edit_message_text("❌ Сообщение для рассылки не найдено")
         return
     
-    session = db_manager.get_session()
+    broadcast = await broadcast_manager.create(
+        admin_id=user_id,
+        text=broadcast_message,
+        progress_chat_id=query.message.chat_id,
+        progress_message_id=query.message.message_id,
+        segment=segment,
+        segment_param=segment_param
+    )
+    broadcast_manager.start(context.bot, broadcast.id)
+    
+    eta_minutes = broadcast.total / broadcast_manager.bucket.rate / 60
+    await query.edit_message_text(
+        text=get_message('broadcast_started',
+            id=broadcast.id,
+            segment=describe_segment(segment, segment_param),
+            total=broadcast.total,
+            skipped=broadcast.skipped,
+            eta=f"{eta_minutes:.0f} мин." if eta_minutes >= 1 else "меньше минуты"
+        ),
+        reply_markup=broadcast_cancel_keyboard(broadcast.id),
+        parse_mode='HTML'
+    )
+    
+    audience = f"{segment}:{segment_param}" if segment_param else segment
+    await log_admin_action(user_id, "broadcast_started",
+                           details=f"Broadcast #{broadcast.id} to {broadcast.total} users, segment {audience}")
+
+
+async def admin_broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Choose broadcast audience"""
+    query = update.callback_query
+    
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await query.answer()
+        return
+    
     try:
-        users = session.query(User).all()
-        total_users = len(users)
-        sent_count = 0
-        failed_count = 0
-        
-        # Update message to show progress
-        await query.edit_message_text(
-            f"📢 Рассылка запущена...\n\n"
-            f"👥 Всего получателей: {total_users}\n"
-            f"✅ Отправлено: 0\n"
-            f"❌ Ошибок: 0"
-        )
-        
-        # Send messages with progress updates
-        for i, user in enumerate(users):
-            try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=broadcast_message,
-                    parse_mode='HTML'
-                )
-                sent_count += 1
-                
-                # Update progress every 50 messages
-                if (i + 1) % 50 == 0:
-                    await query.edit_message_text(
-                        f"📢 Рассылка в процессе...\n\n"
-                        f"👥 Всего получателей: {total_users}\n"
-                        f"✅ Отправлено: {sent_count}\n"
-                        f"❌ Ошибок: {failed_count}\n"
-                        f"📊 Прогресс: {((i + 1) / total_users * 100):.1f}%"
-                    )
-                
-                # Small delay to avoid rate limits
-                await asyncio.sleep(0.1)
-                
-            except Exception as e:
-                failed_count += 1
-                logger.warning(f"Failed to send broadcast to user {user.telegram_id}: {e}")
-        
-        # Final result
-        success_text = get_message('broadcast_success', sent=sent_count, total=total_users)
-        if failed_count > 0:
-            success_text += f"\n❌ Не удалось отправить: {failed_count}"
-        
-        keyboard = [
-            [InlineKeyboardButton("⬅️ Назад в админку", callback_data='admin_back')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            text=success_text,
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
-        
-        log_admin_action(user_id, "broadcast_sent", details=f"Sent to {sent_count}/{total_users} users")
-        
-    finally:
-        session.close()
+        context.user_data['broadcast_segment'] = parse_segment(query.data.replace('admin_broadcast_segment_', ''))
+    except ValueError as e:
+        logger.warning(f"Invalid broadcast segment from admin {user_id}: {e}")
+        await query.answer("❌ Неизвестная аудитория")
+        return
+    
+    await query.answer()
+    try:
+        await admin_broadcast_start(update, context)
+    except BadRequest as e:
+        # Same segment chosen again
+        if 'not modified' not in str(e).lower():
+            raise
+
+
+async def admin_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stop running broadcast"""
+    query = update.callback_query
+    
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await query.answer()
+        return
+    
+    broadcast_id = int(query.data.replace('admin_broadcast_cancel_', ''))
+    if await broadcast_manager.cancel(broadcast_id):
+        await query.answer("⏹ Рассылка будет остановлена")
+        await log_admin_action(user_id, "broadcast_cancelled", details=f"Broadcast #{broadcast_id}")
+    else:
+        await query.answer("Рассылка уже завершена")
 
 
 async def admin_logs_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -640,7 +605,7 @@ async def admin_logs_view(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             lines = f.readlines()
             recent_logs = lines[-20:]  # Last 20 lines
         
-        logs_text = f"📋 <b>Последние логи</b>\n\n"
+        logs_text = "📋 <b>Последние логи</b>\n\n"
         logs_text += "<pre>"
         for line in recent_logs:
             if len(line) > 100:
@@ -674,22 +639,46 @@ async def admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Show admin settings"""
     query = update.callback_query
     
-    settings_text = f"⚙️ <b>Настройки бота</b>\n\n"
-    settings_text += f"🤖 <b>Основные:</b>\n"
+    settings_text = "⚙️ <b>Настройки бота</b>\n\n"
+    settings_text += "🤖 <b>Основные:</b>\n"
     settings_text += f"   • Режим отладки: {'✅' if Config.DEBUG else '❌'}\n"
     settings_text += f"   • Уровень логов: {Config.LOG_LEVEL}\n"
     settings_text += f"   • Язык по умолчанию: {Config.DEFAULT_LANGUAGE}\n\n"
     
-    settings_text += f"💰 <b>Тарифы:</b>\n"
+    settings_text += "💰 <b>Тарифы:</b>\n"
     settings_text += f"   • 1 месяц: {Config.PLAN_1_MONTH_PRICE} ₽\n"
     settings_text += f"   • 3 месяца: {Config.PLAN_3_MONTH_PRICE} ₽\n"
     settings_text += f"   • 6 месяцев: {Config.PLAN_6_MONTH_PRICE} ₽\n"
     settings_text += f"   • 12 месяцев: {Config.PLAN_12_MONTH_PRICE} ₽\n\n"
     
-    settings_text += f"🎁 <b>Реферальная программа:</b>\n"
+    settings_text += "🎁 <b>Реферальная программа:</b>\n"
     settings_text += f"   • Процент бонуса: {Config.REFERRAL_BONUS_PERCENT}%\n"
     settings_text += f"   • Минимум для вывода: {Config.REFERRAL_MIN_PAYOUT} ₽\n"
     
+    pool_stats = db_manager.pool_stats()
+    settings_text += "\n🗄️ <b>Пул соединений БД:</b>\n"
+    settings_text += f"   • Размер / overflow: {Config.DB_POOL_SIZE} / {Config.DB_MAX_OVERFLOW}\n"
+    settings_text += f"   • Занято сейчас (макс.): {pool_stats['checked_out']} ({pool_stats['max_checked_out']})\n"
+    settings_text += f"   • Выдач соединений: {pool_stats['checkouts']}\n"
+    settings_text += f"   • Ожидание ср. / макс.: {pool_stats['avg_wait_ms']:.1f} / {pool_stats['max_wait_ms']:.1f} мс\n"
+    
+    cache_stats = user_cache.stats()
+    settings_text += "\n👤 <b>Кэш пользователей:</b>\n"
+    settings_text += f"   • Записей: {cache_stats['size']} / {cache_stats['max_size']} (TTL {Config.USER_CACHE_TTL} с)\n"
+    settings_text += f"   • Попадания: {cache_stats['hit_rate'] * 100:.1f}% ({cache_stats['hits']} / {cache_stats['hits'] + cache_stats['misses']})\n"
+    
+    activity_stats = activity_tracker.stats
+    settings_text += f"\n🕐 <b>Запись активности:</b> каждые {Config.ACTIVITY_FLUSH_INTERVAL} с\n"
+    settings_text += f"   • В буфере: {activity_tracker.pending} (задержка {activity_tracker.lag_seconds:.1f} с)\n"
+    settings_text += f"   • Последняя запись: {activity_stats['last_flush_size']} польз. за {activity_stats['last_flush_ms']:.1f} мс\n"
+    
+    qr_stats = qr_cache.stats()
+    delivery = delivery_stats.stats()
+    settings_text += f"\n📎 <b>Выдача конфигураций:</b> {delivery['deliveries']} (загрузок файлов: {delivery['uploads']})\n"
+    settings_text += f"   • Вызовов API в среднем: {delivery['avg_api_calls']:.1f}\n"
+    settings_text += f"   • Время ср. / макс.: {delivery['avg_latency_ms']:.0f} / {delivery['max_latency_ms']:.0f} мс\n"
+    settings_text += f"   • Кэш QR-кодов: {qr_stats['hit_rate'] * 100:.1f}% попаданий, рендер {qr_stats['avg_render_ms']:.1f} мс\n"
+    
     keyboard = [
         [
             InlineKeyboardButton("💰 Изменить тарифы", callback_data='admin_edit_prices'),
@@ -716,9 +705,14 @@ async def admin_back_to_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
+    if not is_admin(update.effective_user.id):
+        await query.edit_message_text(get_message('admin_not_authorized'))
+        return
+    
     # Clear any admin states
     context.user_data.pop('waiting_broadcast', None)
     context.user_data.pop('broadcast_message', None)
+    context.user_data.pop('broadcast_segment', None)
     
     # Show fresh admin panel
     await admin_panel_refresh(update, context)
\ No newline at end of file
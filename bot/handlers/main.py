@@ -1,32 +1,38 @@
 """Main handlers for VPN Telegram Bot"""
 
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select
 
-from bot.models.database import DatabaseManager, User, Subscription, Payment
+from bot.models.database import get_db_manager, User, Payment
+from bot.models.queries import get_user_with_subscription
 from bot.config.settings import Config, SUBSCRIPTION_PLANS, PAYMENT_METHODS
 from bot.utils.helpers import (
     generate_referral_code, 
     format_datetime, 
     format_date, 
-    calculate_end_date,
-    generate_vpn_config,
-    create_qr_code,
     get_user_display_name,
     update_user_activity,
     get_plan_emoji,
     get_server_flag,
     create_referral_link,
-    create_config_file,
-    get_random_server_location,
-    generate_config_filename,
-    calculate_referral_bonus,
     format_currency
 )
 from bot.utils.payments import payment_manager, PaymentError
+from bot.utils.cache import user_cache, UserSnapshot
+from bot.utils.activity import activity_tracker
+from bot.utils.billing import (
+    complete_payment,
+    fail_payment,
+    claim_provider_check,
+    payment_success_message,
+    notify_referrer,
+    send_vpn_config,
+    get_latest_subscription
+)
 from locales.ru import get_message, format_price_per_month, format_savings
 
 logger = logging.getLogger(__name__)
@@ -34,16 +40,21 @@ logger = logging.getLogger(__name__)
 # Conversation states
 SELECTING_PLAN, SELECTING_PAYMENT_METHOD, WAITING_PAYMENT = range(3)
 
-# Initialize database
-db_manager = DatabaseManager(Config.DATABASE_URL)
-db_manager.create_tables()
+# Schema is migrated in post_init, see bot.models.migrations
+db_manager = get_db_manager()
 
 
-def get_or_create_user(telegram_user) -> User:
-    """Get or create user in database"""
-    session = db_manager.get_session()
-    try:
-        user = session.query(User).filter_by(telegram_id=telegram_user.id).first()
+async def get_or_create_user(telegram_user) -> UserSnapshot:
+    """Get or create user, served from the user cache when possible"""
+    activity_tracker.touch(telegram_user.id)
+    
+    snapshot = user_cache.get(telegram_user.id)
+    if snapshot is not None:
+        return snapshot
+    
+    version = user_cache.version
+    async with db_manager.get_async_session() as session:
+        user = await get_user_with_subscription(session, telegram_user.id)
         
         if not user:
             user = User(
@@ -56,33 +67,30 @@ def get_or_create_user(telegram_user) -> User:
                 is_admin=telegram_user.id in Config.ADMIN_IDS
             )
             session.add(user)
-            session.commit()
-            session.refresh(user)
+            await session.commit()
             logger.info(f"New user created: {user.telegram_id}")
         
-        # Update user activity
-        user.last_activity = datetime.utcnow()
-        session.commit()
-        
-        return user
-    finally:
-        session.close()
+        snapshot = UserSnapshot.from_user(user)
+        user_cache.set(snapshot, version)
+        return snapshot
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /start command"""
-    user = get_or_create_user(update.effective_user)
+    user = await get_or_create_user(update.effective_user)
     
     # Handle referral code
     if context.args and user.referrer_id is None:
         referral_code = context.args[0]
-        session = db_manager.get_session()
-        try:
-            referrer = session.query(User).filter_by(referral_code=referral_code).first()
+        async with db_manager.get_async_session() as session:
+            result = await session.execute(select(User).filter_by(referral_code=referral_code))
+            referrer = result.scalar_one_or_none()
             if referrer and referrer.telegram_id != user.telegram_id:
-                user.referrer_id = referrer.id
+                db_user = await session.get(User, user.id)
+                db_user.referrer_id = referrer.id
                 referrer.total_referrals += 1
-                session.commit()
+                await session.commit()
+                user_cache.invalidate(user.telegram_id, referrer.telegram_id)
                 logger.info(f"User {user.telegram_id} referred by {referrer.telegram_id}")
                 
                 # Send notification to referrer
@@ -93,8 +101,6 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                     )
                 except Exception as e:
                     logger.warning(f"Failed to notify referrer: {e}")
-        finally:
-            session.close()
     
     # Check if returning user
     is_returning = user.created_at < datetime.utcnow() - timedelta(hours=1)
@@ -242,10 +248,10 @@ async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
     
     plan = SUBSCRIPTION_PLANS[plan_type]
-    user = get_or_create_user(update.effective_user)
+    user = await get_or_create_user(update.effective_user)
     
     # Create payment record
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
         payment = Payment(
             user_id=user.id,
@@ -255,12 +261,11 @@ async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             expires_at=datetime.utcnow() + timedelta(minutes=15)
         )
         session.add(payment)
-        session.commit()
-        session.refresh(payment)
+        await session.commit()
         
         # Create payment with provider
         try:
-            payment_data = payment_manager.create_payment(
+            payment_data = await payment_manager.create_payment(
                 method=payment_method,
                 amount=payment.amount,
                 order_id=f"vpn_{payment.id}",
@@ -270,8 +275,8 @@ async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             # Update payment with external data
             payment.payment_id = payment_data['payment_id']
             payment.payment_url = payment_data['payment_url']
-            session.commit()
-            
+            await session.commit()
+        
         except PaymentError as e:
             logger.error(f"Payment creation error: {e}")
             await query.edit_message_text(f"❌ {str(e)}")
@@ -299,13 +304,13 @@ async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         
         return WAITING_PAYMENT
-        
+    
     except Exception as e:
         logger.error(f"Payment creation error: {e}")
         await query.edit_message_text(get_message('error_general'))
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
 
 
 async def verify_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -315,111 +320,58 @@ async def verify_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     payment_id = int(query.data.replace('verify_payment_', ''))
     
-    session = db_manager.get_session()
+    session = db_manager.get_async_session()
     try:
-        payment = session.query(Payment).filter_by(id=payment_id).first()
+        payment = await session.get(Payment, payment_id)
         if not payment:
             await query.edit_message_text("❌ Платеж не найден")
             return ConversationHandler.END
         
+        # Payment may already be confirmed by provider webhook
+        if payment.status == 'completed':
+            await show_completed_payment(query, payment)
+            return ConversationHandler.END
+        
         # Check if payment expired
         if payment.is_expired:
             await query.edit_message_text(get_message('error_payment_timeout'))
             return ConversationHandler.END
         
-        # Verify payment with provider
-        payment_status = payment_manager.check_payment(payment.payment_method, payment.payment_id)
+        # Verify payment with provider, but not more often than the check interval
+        if payment.status == 'pending' and await claim_provider_check(payment.id):
+            payment_status = await payment_manager.check_payment(payment.payment_method, payment.payment_id)
+        else:
+            payment_status = payment.status
         
         if payment_status == 'completed':
-            # Payment successful - create subscription
-            payment.status = 'completed'
-            payment.completed_at = datetime.utcnow()
-            
-            # Get user and update stats
-            user = session.query(User).filter_by(id=payment.user_id).first()
-            user.total_spent += payment.amount_rubles
-            
-            # Deactivate old subscriptions
-            old_subs = session.query(Subscription).filter_by(
-                user_id=payment.user_id,
-                is_active=True
-            ).all()
-            for sub in old_subs:
-                sub.is_active = False
+            completion = await complete_payment(payment.id)
+            if completion is None:
+                # Completed concurrently (e.g. by webhook)
+                await show_completed_payment(query, payment)
+                return ConversationHandler.END
             
-            # Create VPN subscription
-            server_location = get_random_server_location()
-            subscription = Subscription(
-                user_id=payment.user_id,
-                plan_type=payment.plan_type,
-                end_date=calculate_end_date(payment.plan_type),
-                vpn_config=generate_vpn_config(user.telegram_id, server_location),
-                config_name=f"VPN_{SUBSCRIPTION_PLANS[payment.plan_type]['name']}",
-                server_location=server_location
-            )
-            session.add(subscription)
-            
-            # Process referral bonus
-            if user.referrer_id:
-                referrer = session.query(User).filter_by(id=user.referrer_id).first()
-                if referrer:
-                    bonus = calculate_referral_bonus(payment.amount)
-                    referrer.referral_balance += bonus / 100  # Convert to rubles
-                    session.commit()
-                    
-                    # Notify referrer
-                    try:
-                        await context.bot.send_message(
-                            chat_id=referrer.telegram_id,
-                            text=get_message('referral_bonus',
-                                amount=bonus / 100,
-                                friend_name=user.full_name
-                            )
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to notify referrer about bonus: {e}")
-            
-            session.commit()
-            
-            # Send success message
-            plan = SUBSCRIPTION_PLANS[payment.plan_type]
-            success_message = get_message('payment_success',
-                plan_name=plan['name'],
-                end_date=format_date(subscription.end_date),
-                server_location=f"{get_server_flag(server_location)} {server_location}"
-            )
-            
-            await query.edit_message_text(success_message, parse_mode='HTML')
-            
-            # Send VPN config as file
-            config_filename = generate_config_filename(user.telegram_id, payment.plan_type)
-            config_file = create_config_file(subscription.vpn_config, config_filename)
-            
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=config_file,
-                filename=config_filename,
-                caption=get_message('vpn_config_info'),
-                parse_mode='HTML'
-            )
-            
-            # Generate and send QR code
-            qr_buffer = create_qr_code(subscription.vpn_config)
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=qr_buffer,
-                caption=get_message('config_qr'),
-                parse_mode='HTML'
+            # Success message with menu buttons replaces the payment message while the
+            # config album is sent; the referrer is notified in parallel
+            await asyncio.gather(
+                send_vpn_config(
+                    context.bot,
+                    update.effective_chat.id,
+                    completion['user'].telegram_id,
+                    completion['subscription'],
+                    get_message('vpn_config_info'),
+                    query.edit_message_text(
+                        text=payment_success_message(completion['subscription']),
+                        reply_markup=completed_payment_keyboard(),
+                        parse_mode='HTML'
+                    )
+                ),
+                notify_referrer(context.bot, completion)
             )
-            
-            # Send main menu
-            await main_menu(update, context)
-            
+        
         elif payment_status == 'failed':
-            payment.status = 'failed'
-            session.commit()
+            await fail_payment(payment.id)
             await query.edit_message_text(get_message('payment_failed'), parse_mode='HTML')
-            
+        
         else:  # pending or unknown
             time_left = int((payment.expires_at - datetime.utcnow()).total_seconds() / 60)
             if time_left > 0:
@@ -442,13 +394,34 @@ async def verify_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 await query.edit_message_text(get_message('error_payment_timeout'))
         
         return ConversationHandler.END
-        
+    
     except Exception as e:
         logger.error(f"Payment verification error: {e}")
         await query.edit_message_text(get_message('error_general'))
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
+
+
+async def show_completed_payment(query, payment: Payment) -> None:
+    """Show result of payment already completed by webhook"""
+    subscription = await get_latest_subscription(payment.user_id)
+    text = payment_success_message(subscription) if subscription else get_message('payment_failed')
+    
+    await query.edit_message_text(
+        text=text,
+        reply_markup=completed_payment_keyboard(),
+        parse_mode='HTML'
+    )
+
+
+def completed_payment_keyboard() -> InlineKeyboardMarkup:
+    """Buttons under payment success message"""
+    keyboard = [
+        [InlineKeyboardButton(get_message('btn_config'), callback_data='my_config')],
+        [InlineKeyboardButton(get_message('btn_main_menu'), callback_data='main_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
 
 
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -456,7 +429,7 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     query = update.callback_query
     await query.answer()
     
-    user = get_or_create_user(update.effective_user)
+    user = await get_or_create_user(update.effective_user)
     
     # Get subscription info
     if user.has_active_subscription:
@@ -501,39 +474,28 @@ async def show_my_config(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     
-    user = get_or_create_user(update.effective_user)
+    user = await get_or_create_user(update.effective_user)
     
     if not user.has_active_subscription:
         await query.edit_message_text(get_message('error_no_subscription'))
         return
     
-    subscription = user.active_subscription
-    
-    # Send config info
-    await query.edit_message_text(
-        text=get_message('vpn_config_info'),
-        parse_mode='HTML'
-    )
-    
-    # Send config file
-    config_filename = generate_config_filename(user.telegram_id, subscription.plan_type)
-    config_file = create_config_file(subscription.vpn_config, config_filename)
-    
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=config_file,
-        filename=config_filename,
-        caption=f"📱 Конфигурация VPN\n🌍 Сервер: {get_server_flag(subscription.server_location)} {subscription.server_location}",
-        parse_mode='HTML'
-    )
+    subscription = await get_latest_subscription(user.id)
+    if subscription is None:
+        await query.edit_message_text(get_message('error_no_subscription'))
+        return
     
-    # Send QR code
-    qr_buffer = create_qr_code(subscription.vpn_config)
-    await context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=qr_buffer,
-        caption=get_message('config_qr'),
-        parse_mode='HTML'
+    # Config info replaces the menu while config file and QR code are sent
+    await send_vpn_config(
+        context.bot,
+        update.effective_chat.id,
+        user.telegram_id,
+        subscription,
+        f"📱 Конфигурация VPN\n🌍 Сервер: {get_server_flag(subscription.server_location)} {subscription.server_location}",
+        query.edit_message_text(
+            text=get_message('vpn_config_info'),
+            parse_mode='HTML'
+        )
     )
 
 
@@ -542,7 +504,7 @@ async def show_referral_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
-    user = get_or_create_user(update.effective_user)
+    user = await get_or_create_user(update.effective_user)
     
     # Get bot username for referral link
     bot_info = await context.bot.get_me()
@@ -616,7 +578,7 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if query:
         await query.answer()
     
-    user = get_or_create_user(update.effective_user)
+    user = await get_or_create_user(update.effective_user)
     
     keyboard = [
         [InlineKeyboardButton(get_message('btn_buy_vpn'), callback_data='buy_vpn')],
@@ -40,14 +40,20 @@ from bot.handlers.admin import (
     admin_callback_handler,
     handle_broadcast_message,
     admin_back_to_panel,
-    admin_broadcast_confirm
+    admin_broadcast_confirm,
+    admin_broadcast_cancel,
+    admin_broadcast_segment
 )
 from bot.utils.helpers import setup_logging
+from bot.utils.updates import ChatOrderedUpdateProcessor
 
 # Setup logging
 setup_logging()
 logger = logging.getLogger(__name__)
 
+# Update types the bot handles
+ALLOWED_UPDATES = ["message", "callback_query"]
+
 
 def create_application() -> Application:
     """Create and configure the bot application"""
@@ -55,7 +61,14 @@ def create_application() -> Application:
     Config.validate()
     
     # Create application
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(Config.BOT_TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(Config.UPDATE_CONCURRENCY))
+    )
+    if Config.TELEGRAM_API_URL:
+        builder = builder.base_url(Config.TELEGRAM_API_URL)
+    application = builder.build()
     
     # Purchase conversation handler
     purchase_conversation = ConversationHandler(
@@ -93,10 +106,12 @@ def create_application() -> Application:
     application.add_handler(CallbackQueryHandler(show_support, pattern='^support$'))
     application.add_handler(CallbackQueryHandler(main_menu, pattern='^main_menu$'))
     
-    # Admin handlers
-    application.add_handler(CallbackQueryHandler(admin_callback_handler, pattern='^admin_'))
+    # Admin handlers (specific patterns before the generic admin_ dispatcher)
     application.add_handler(CallbackQueryHandler(admin_back_to_panel, pattern='^admin_back$'))
     application.add_handler(CallbackQueryHandler(admin_broadcast_confirm, pattern='^admin_broadcast_confirm$'))
+    application.add_handler(CallbackQueryHandler(admin_broadcast_cancel, pattern=r'^admin_broadcast_cancel_\d+$'))
+    application.add_handler(CallbackQueryHandler(admin_broadcast_segment, pattern='^admin_broadcast_segment_'))
+    application.add_handler(CallbackQueryHandler(admin_callback_handler, pattern='^admin_'))
     
     # Broadcast message handler (for admins)
     application.add_handler(MessageHandler(
@@ -104,6 +119,53 @@ def create_application() -> Application:
         handle_broadcast_message
     ))
     
+    # Background payment reconciliation, activity flushing, stats rollups, key, address and server upkeep
+    if application.job_queue:
+        from bot.utils.reconciliation import reconcile_payments_job
+        from bot.utils.activity import flush_activity_job
+        from bot.utils.rollups import rollup_stats_job
+        from bot.utils.keys import release_stale_keys_job
+        from bot.utils.addresses import release_expired_addresses_job
+        from bot.utils.servers import refresh_servers_job
+        application.job_queue.run_repeating(
+            reconcile_payments_job,
+            interval=Config.PAYMENT_RECONCILE_INTERVAL,
+            first=Config.PAYMENT_RECONCILE_INTERVAL,
+            name='payment_reconciliation'
+        )
+        application.job_queue.run_repeating(
+            flush_activity_job,
+            interval=Config.ACTIVITY_FLUSH_INTERVAL,
+            first=Config.ACTIVITY_FLUSH_INTERVAL,
+            name='activity_flush'
+        )
+        application.job_queue.run_repeating(
+            rollup_stats_job,
+            interval=Config.STATS_ROLLUP_INTERVAL,
+            first=30,
+            name='stats_rollup'
+        )
+        application.job_queue.run_repeating(
+            release_stale_keys_job,
+            interval=Config.VPN_KEY_RESERVATION_TTL,
+            first=Config.VPN_KEY_RESERVATION_TTL,
+            name='vpn_key_release'
+        )
+        application.job_queue.run_repeating(
+            release_expired_addresses_job,
+            interval=Config.ADDRESS_RELEASE_INTERVAL,
+            first=Config.ADDRESS_RELEASE_INTERVAL,
+            name='address_release'
+        )
+        application.job_queue.run_repeating(
+            refresh_servers_job,
+            interval=Config.SERVER_REFRESH_INTERVAL,
+            first=Config.SERVER_REFRESH_INTERVAL,
+            name='server_refresh'
+        )
+    else:
+        logger.warning("Job queue is not available, background jobs disabled")
+    
     # Error handler
     application.add_error_handler(error_handler)
     
@@ -130,11 +192,37 @@ async def post_init(application: Application) -> None:
     """Post initialization tasks"""
     logger.info("🚀 VPN Bot initialization started")
     
-    # Initialize database
-    from bot.models.database import DatabaseManager
-    db_manager = DatabaseManager(Config.DATABASE_URL)
-    db_manager.create_tables()
-    logger.info("✅ Database initialized successfully")
+    # Check schema revision, migrating when the database is behind
+    from bot.models.database import get_db_manager
+    from bot.models.migrations import ensure_schema_async
+    db_manager = get_db_manager()
+    revision = await ensure_schema_async(db_manager, auto_migrate=Config.DB_AUTO_MIGRATE)
+    logger.info(f"✅ Database initialized successfully (schema revision {revision})")
+    
+    # Continue broadcasts interrupted by the previous shutdown
+    from bot.utils.broadcast import broadcast_manager
+    resumed = await broadcast_manager.resume(application.bot)
+    if resumed:
+        logger.info(f"✅ Resumed broadcasts: {resumed}")
+    
+    # Return keys reserved by a previous process that never assigned them
+    from bot.utils.keys import key_allocator, keypair_pool
+    await key_allocator.release_stale()
+    
+    # Pre-generate WireGuard key pairs in the background
+    keypair_pool.schedule_refill()
+    
+    # Load server registry used for peer placement
+    from bot.utils.servers import server_registry
+    await server_registry.load()
+    
+    # Start payment provider webhook receiver
+    if Config.PAYMENT_WEBHOOK_ENABLED:
+        from bot.utils.payments import payment_manager
+        from bot.utils.webhooks import PaymentWebhookServer
+        webhook_server = PaymentWebhookServer(application.bot, payment_manager)
+        await webhook_server.start()
+        application.bot_data['payment_webhook_server'] = webhook_server
     
     # Get bot info
     bot_info = await application.bot.get_me()
@@ -188,13 +276,57 @@ async def post_shutdown(application: Application) -> None:
                 )
             except Exception as e:
                 logger.warning(f"Failed to send shutdown message to admin {admin_id}: {e}")
-                
+    
     except Exception as e:
         logger.error(f"Error during shutdown: {e}")
     
+    # Stop payment webhook receiver
+    webhook_server = application.bot_data.get('payment_webhook_server')
+    if webhook_server:
+        await webhook_server.stop()
+    
+    # Stop broadcasts at their last checkpoint, they resume on next start
+    from bot.utils.broadcast import broadcast_manager
+    await broadcast_manager.stop()
+    
+    # Write buffered user activity before closing the database
+    from bot.utils.activity import activity_tracker
+    await activity_tracker.flush()
+    
+    # Return prefetched VPN keys to the pool
+    from bot.utils.keys import key_allocator
+    await key_allocator.release()
+    
+    # Release pooled database and payment provider connections
+    from bot.models.database import close_db_managers
+    from bot.utils.payments import payment_manager
+    await payment_manager.close()
+    await close_db_managers()
+    
+    # Stop QR code render and key generation workers
+    from bot.utils.cache import qr_cache
+    from bot.utils.keys import keypair_pool
+    qr_cache.shutdown()
+    keypair_pool.shutdown()
+    
     logger.info("✅ VPN Bot shutdown completed")
 
 
+def webhook_options() -> dict:
+    """Get Application.run_webhook arguments from configuration"""
+    url_path = Config.WEBHOOK_PATH.strip('/')
+    return {
+        'listen': Config.WEBHOOK_LISTEN,
+        'port': Config.WEBHOOK_PORT,
+        'url_path': url_path,
+        'webhook_url': f"{Config.WEBHOOK_URL.rstrip('/')}/{url_path}" if Config.WEBHOOK_URL else None,
+        'secret_token': Config.WEBHOOK_SECRET_TOKEN or None,
+        'max_connections': Config.WEBHOOK_MAX_CONNECTIONS,
+        'allowed_updates': ALLOWED_UPDATES,
+        'drop_pending_updates': True
+    }
+
+
 def main():
     """Main function to run the bot"""
     logger.info("🚀 Starting VPN Telegram Bot...")
@@ -208,13 +340,18 @@ def main():
         application.post_shutdown = post_shutdown
         
         # Run the bot
-        logger.info("⚡ Bot is starting polling...")
-        application.run_polling(
-            allowed_updates=["message", "callback_query"],
-            drop_pending_updates=True,
-            close_loop=False
-        )
-        
+        if Config.BOT_MODE == 'webhook':
+            options = webhook_options()
+            logger.info(f"⚡ Bot is starting webhook on {options['listen']}:{options['port']}/{options['url_path']}...")
+            application.run_webhook(close_loop=False, **options)
+        else:
+            logger.info("⚡ Bot is starting polling...")
+            application.run_polling(
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True,
+                close_loop=False
+            )
+    
     except KeyboardInterrupt:
         logger.info("🛑 Bot stopped by user (Ctrl+C)")
     except Exception as e:
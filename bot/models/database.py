@@ -1,10 +1,19 @@
 """Database models for VPN Telegram Bot"""
 
+import logging
+import threading
+import time
 from datetime import datetime, timedelta
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Float
+from typing import Optional, Dict, Any
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Float, JSON, Index, PrimaryKeyConstraint, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -19,7 +28,7 @@ class User(Base):
     first_name = Column(String(255))
     last_name = Column(String(255))
     language_code = Column(String(10), default='ru')
-    is_active = Column(Boolean, default=True)
+    is_active = Column(Boolean, default=True)  # False once Telegram reports the chat unreachable
     is_admin = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -34,8 +43,26 @@ class User(Base):
     total_spent = Column(Float, default=0.0)       # Общая потраченная сумма
     last_activity = Column(DateTime, default=datetime.utcnow)
     
+    # Current subscription (denormalized, maintained on payment completion)
+    current_subscription_id = Column(Integer)
+    subscription_end = Column(DateTime)
+    
+    __table_args__ = (
+        Index('ix_users_created_at', 'created_at'),
+        Index('ix_users_last_activity', 'last_activity'),
+        Index('ix_users_referrer_id', 'referrer_id'),
+        Index('ix_users_subscription_end', 'subscription_end'),
+        Index('ix_users_is_active', 'is_active'),
+    )
+    
     # Relationships
     subscriptions = relationship("Subscription", back_populates="user")
+    current_subscription = relationship(
+        "Subscription",
+        primaryjoin="foreign(User.current_subscription_id) == Subscription.id",
+        viewonly=True,
+        uselist=False
+    )
     payments = relationship("Payment", back_populates="user")
     referrals = relationship("User", remote_side=[id])
     
@@ -50,35 +77,20 @@ class User(Base):
     
     @property
     def active_subscription(self):
-        """Get user's active subscription"""
-        return next((sub for sub in self.subscriptions if sub.is_active and not sub.is_expired), None)
+        """Get user's active subscription (load with current_subscription eager loaded)"""
+        if not self.has_active_subscription:
+            return None
+        sub = self.current_subscription
+        return sub if sub and sub.is_active and not sub.is_expired else None
     
     @property
     def has_active_subscription(self):
-        """Check if user has active subscription"""
-        return self.active_subscription is not None
+        """Check if user has active subscription without loading it"""
+        return self.subscription_end is not None and self.subscription_end > datetime.utcnow()
 
 
-class Subscription(Base):
-    """Subscription model"""
-    __tablename__ = 'subscriptions'
-    
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    plan_type = Column(String(50), nullable=False)  # 1_month, 3_months, etc.
-    start_date = Column(DateTime, default=datetime.utcnow)
-    end_date = Column(DateTime, nullable=False)
-    is_active = Column(Boolean, default=True)
-    vpn_config = Column(Text)  # VPN configuration data
-    config_name = Column(String(255))  # Имя конфигурации
-    server_location = Column(String(100))  # Локация сервера
-    created_at = Column(DateTime, default=datetime.utcnow)
-    
-    # Relationships
-    user = relationship("User", back_populates="subscriptions")
-    
-    def __repr__(self):
-        return f"<Subscription(user_id={self.user_id}, plan={self.plan_type}, active={self.is_active})>"
+class SubscriptionPeriodMixin:
+    """Expiry helpers for objects with end_date"""
     
     @property
     def is_expired(self):
@@ -111,6 +123,52 @@ class Subscription(Base):
             return f"{hours} ч."
 
 
+class Subscription(SubscriptionPeriodMixin, Base):
+    """Subscription model"""
+    __tablename__ = 'subscriptions'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    plan_type = Column(String(50), nullable=False)  # 1_month, 3_months, etc.
+    start_date = Column(DateTime, default=datetime.utcnow)
+    end_date = Column(DateTime, nullable=False)
+    is_active = Column(Boolean, default=True)
+    vpn_config = Column(Text)  # VPN configuration data
+    config_name = Column(String(255))  # Имя конфигурации
+    server_location = Column(String(100))  # Локация сервера
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Telegram file_id of uploaded config and QR code documents, valid while
+    # vpn_config hashes to files_config_hash
+    config_file_id = Column(String(255))
+    qr_file_id = Column(String(255))
+    files_config_hash = Column(String(64))
+    
+    # WireGuard address from the server's IP pool, cleared once released
+    client_ip = Column(String(45))
+    # Counted in servers.active_peers of server_location until expired or replaced
+    server_slot = Column(Boolean, default=False)
+    
+    __table_args__ = (
+        Index('ix_subscriptions_user_active_end', 'user_id', 'is_active', 'end_date'),
+        # Only active subscriptions are counted by end date
+        Index('ix_subscriptions_active_end', 'end_date',
+              sqlite_where=is_active == True, postgresql_where=is_active == True),
+        # Expired subscriptions still holding an address
+        Index('ix_subscriptions_client_ip_end', 'end_date',
+              sqlite_where=client_ip.isnot(None), postgresql_where=client_ip.isnot(None)),
+        # Expired subscriptions still counted as server peers
+        Index('ix_subscriptions_server_slot_end', 'end_date',
+              sqlite_where=server_slot == True, postgresql_where=server_slot == True),
+    )
+    
+    # Relationships
+    user = relationship("User", back_populates="subscriptions")
+    
+    def __repr__(self):
+        return f"<Subscription(user_id={self.user_id}, plan={self.plan_type}, active={self.is_active})>"
+
+
 class Payment(Base):
     """Payment model"""
     __tablename__ = 'payments'
@@ -123,10 +181,17 @@ class Payment(Base):
     payment_method = Column(String(50))  # yoomoney, qiwi, crypto
     payment_id = Column(String(255))  # External payment ID
     payment_url = Column(String(500))  # Payment URL for user
-    status = Column(String(20), default='pending')  # pending, completed, failed, cancelled
+    status = Column(String(20), default='pending')  # pending, completed, failed, cancelled, expired
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime)
     expires_at = Column(DateTime)  # Время истечения счета
+    checked_at = Column(DateTime)  # Last provider status check requested by the user
+    
+    __table_args__ = (
+        Index('ix_payments_status_completed_at', 'status', 'completed_at'),
+        Index('ix_payments_status_expires_at', 'status', 'expires_at'),
+        Index('ix_payments_created_at', 'created_at'),
+    )
     
     # Relationships
     user = relationship("User", back_populates="payments")
@@ -157,10 +222,48 @@ class VPNKey(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     used_at = Column(DateTime)
     
+    __table_args__ = (
+        Index('ix_vpn_keys_is_used_location', 'is_used', 'server_location'),
+    )
+    
     def __repr__(self):
         return f"<VPNKey(id={self.id}, is_used={self.is_used}, location={self.server_location})>"
 
 
+class Server(Base):
+    """VPN server, active_peers is kept up to date as subscriptions start and end"""
+    __tablename__ = 'servers'
+    
+    id = Column(Integer, primary_key=True)
+    location = Column(String(100), unique=True, nullable=False)  # Matches subscriptions.server_location
+    endpoint = Column(String(255), nullable=False)  # host:port of the WireGuard interface
+    public_key = Column(String(44))  # WireGuard public key of the server, base64
+    flag = Column(String(16), default='🌍')
+    capacity = Column(Integer, nullable=False)  # Peers the server takes at most
+    active_peers = Column(Integer, default=0, nullable=False)
+    is_enabled = Column(Boolean, default=True, nullable=False)  # Disabled servers get no new peers
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<Server(location={self.location}, peers={self.active_peers}/{self.capacity})>"
+
+
+class IPPool(Base):
+    """WireGuard client addresses of a server, one bit per address of network"""
+    __tablename__ = 'ip_pools'
+    
+    server_location = Column(String(100), primary_key=True)
+    network = Column(String(43), nullable=False)  # CIDR the bitmap covers, e.g. 10.8.0.0/16
+    bitmap = Column(LargeBinary, nullable=False)  # Bit i set: network address + i is assigned
+    allocated = Column(Integer, default=0, nullable=False)
+    version = Column(Integer, default=0, nullable=False)  # Bumped by every write, for optimistic locking
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<IPPool(location={self.server_location}, network={self.network}, allocated={self.allocated})>"
+
+
 class ReferralPayout(Base):
     """Referral payout model"""
     __tablename__ = 'referral_payouts'
@@ -194,37 +297,296 @@ class AdminLog(Base):
         return f"<AdminLog(admin_id={self.admin_id}, action={self.action})>"
 
 
+class Broadcast(Base):
+    """Broadcast job, progress is checkpointed so sending resumes after restart"""
+    __tablename__ = 'broadcasts'
+    
+    id = Column(Integer, primary_key=True)
+    admin_id = Column(Integer, nullable=False)  # Telegram ID of the admin who started it
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(10), default='HTML')
+    status = Column(String(20), default='pending')  # pending, running, completed, cancelled
+    segment = Column(String(20), default='all')  # Audience, see bot.utils.segments
+    segment_param = Column(String(50))  # Days for 'inactive', plan type for 'plan'
+    total = Column(Integer, default=0)  # Recipients when the broadcast was created
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    unreachable = Column(Integer, default=0)  # Failed sends to blocked / deleted chats, users deactivated
+    skipped = Column(Integer, default=0)  # Inactive users left out of the segment (saved sends)
+    last_user_id = Column(Integer, default=0)  # Keyset cursor: users.id of the last processed recipient
+    progress_chat_id = Column(Integer)  # Admin message updated with progress
+    progress_message_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_broadcasts_status', 'status'),
+    )
+    
+    def __repr__(self):
+        return f"<Broadcast(id={self.id}, status={self.status}, sent={self.sent}/{self.total})>"
+    
+    @property
+    def is_finished(self):
+        """Check if broadcast will not send anything else"""
+        return self.status in ('completed', 'cancelled')
+
+
+class BroadcastRecipient(Base):
+    """Recipient of a broadcast, materialized when the broadcast is created"""
+    __tablename__ = 'broadcast_recipients'
+    
+    broadcast_id = Column(Integer, ForeignKey('broadcasts.id'), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    telegram_id = Column(Integer, nullable=False)
+    
+    __table_args__ = (
+        # Keyset pagination by (broadcast_id, user_id) reads the primary key only
+        PrimaryKeyConstraint('broadcast_id', 'user_id'),
+    )
+    
+    def __repr__(self):
+        return f"<BroadcastRecipient(broadcast_id={self.broadcast_id}, user_id={self.user_id})>"
+
+
 class BotStats(Base):
     """Bot statistics model"""
     __tablename__ = 'bot_stats'
     
     id = Column(Integer, primary_key=True)
-    date = Column(DateTime, default=datetime.utcnow)
+    date = Column(DateTime, default=datetime.utcnow)  # Start of the rolled up day (UTC)
     total_users = Column(Integer, default=0)
     active_subscriptions = Column(Integer, default=0)
     daily_revenue = Column(Float, default=0.0)
     new_users = Column(Integer, default=0)
     new_payments = Column(Integer, default=0)
+    by_plan = Column(JSON)  # {plan_type: {"payments": n, "revenue": rubles}}
+    by_method = Column(JSON)  # {payment_method: {"payments": n, "revenue": rubles}}
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('uq_bot_stats_date', 'date', unique=True),
+    )
     
     def __repr__(self):
         return f"<BotStats(date={self.date.date()}, users={self.total_users})>"
 
 
+class PoolMetrics:
+    """Connection pool checkout/wait counters"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def attach(self, engine):
+        """Subscribe to pool events of the engine"""
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        if isinstance(engine.pool, _MeteredPoolMixin):
+            engine.pool.metrics = self
+    
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+    
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+    
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(self.checked_out - 1, 0)
+    
+    def record_wait(self, seconds: float):
+        """Record time spent waiting for a pooled connection"""
+        with self._lock:
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Get current metrics values"""
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'avg_wait_ms': self.total_wait / self.checkouts * 1000 if self.checkouts else 0.0,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+
+class _MeteredPoolMixin:
+    """Reports pool checkout wait time to PoolMetrics"""
+    
+    metrics: Optional[PoolMetrics] = None
+    
+    def _do_get(self):
+        if self.metrics is None:
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.record_wait(time.perf_counter() - started)
+
+
+class MeteredQueuePool(_MeteredPoolMixin, QueuePool):
+    """Queue pool for the sync engine with wait metrics"""
+
+
+class MeteredAsyncQueuePool(_MeteredPoolMixin, AsyncAdaptedQueuePool):
+    """Queue pool for the async engine with wait metrics"""
+
+
+def async_database_url(database_url: str) -> str:
+    """Convert database URL to its asyncio driver (aiosqlite / asyncpg)"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    elif backend == 'postgresql':
+        url = url.set(drivername='postgresql+asyncpg')
+    return url.render_as_string(hide_password=False)
+
+
+def _pool_options(database_url: str, pool_size: int, max_overflow: int,
+                  pool_timeout: int, pool_recycle: int, pool_pre_ping: bool,
+                  poolclass=MeteredQueuePool) -> Dict[str, Any]:
+    """Build engine pool arguments for the database URL"""
+    url = make_url(database_url)
+    options = {'pool_pre_ping': pool_pre_ping}
+    
+    # In-memory SQLite lives inside a single connection, so it cannot be pooled
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return options
+    
+    options.update({
+        'poolclass': poolclass,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle
+    })
+    return options
+
+
 class DatabaseManager:
     """Database management class"""
     
-    def __init__(self, database_url: str):
-        self.engine = create_engine(database_url)
+    def __init__(self, database_url: str, pool_size: int = 5, max_overflow: int = 10,
+                 pool_timeout: int = 30, pool_recycle: int = 1800, pool_pre_ping: bool = True):
+        self.database_url = database_url
+        pool_args = (pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping)
+        
+        # Sync engine for scripts and schema management
+        self.engine = create_engine(database_url, **_pool_options(database_url, *pool_args))
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         
+        # Async engine used by bot handlers, so queries never block the event loop
+        self.async_engine = create_async_engine(
+            async_database_url(database_url),
+            **_pool_options(database_url, *pool_args, poolclass=MeteredAsyncQueuePool)
+        )
+        self.AsyncSessionLocal = async_sessionmaker(
+            self.async_engine,
+            autoflush=False,
+            expire_on_commit=False
+        )
+        
+        self.metrics = PoolMetrics()
+        self.metrics.attach(self.async_engine.sync_engine)
+        self.sync_metrics = PoolMetrics()
+        self.sync_metrics.attach(self.engine)
+    
     def create_tables(self):
         """Create all database tables"""
         Base.metadata.create_all(bind=self.engine)
-        
+    
+    async def create_tables_async(self):
+        """Create all database tables using the async engine"""
+        async with self.async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    
     def get_session(self):
         """Get database session"""
         return self.SessionLocal()
-        
+    
+    def get_async_session(self) -> AsyncSession:
+        """Get async database session (use as `async with`)"""
+        return self.AsyncSessionLocal()
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """Get async connection pool status and checkout/wait metrics"""
+        stats = self.metrics.snapshot()
+        pool = self.async_engine.pool
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'pool_size': pool.size(),
+                'idle': pool.checkedin(),
+                'overflow': pool.overflow()
+            })
+        return stats
+    
     def close(self):
         """Close database connection"""
-        self.engine.dispose()
\ No newline at end of file
+        self.engine.dispose()
+    
+    async def close_async(self):
+        """Close sync and async database connections"""
+        await self.async_engine.dispose()
+        self.engine.dispose()
+
+
+# Process-wide database managers, one per database URL
+_db_managers: Dict[str, DatabaseManager] = {}
+_db_managers_lock = threading.Lock()
+
+
+def get_db_manager(database_url: Optional[str] = None) -> DatabaseManager:
+    """Get shared database manager (engine and pool) for the database URL"""
+    from bot.config.settings import Config
+    
+    database_url = database_url or Config.DATABASE_URL
+    manager = _db_managers.get(database_url)
+    if manager is not None:
+        return manager
+    
+    with _db_managers_lock:
+        manager = _db_managers.get(database_url)
+        if manager is None:
+            manager = DatabaseManager(
+                database_url,
+                pool_size=Config.DB_POOL_SIZE,
+                max_overflow=Config.DB_MAX_OVERFLOW,
+                pool_timeout=Config.DB_POOL_TIMEOUT,
+                pool_recycle=Config.DB_POOL_RECYCLE,
+                pool_pre_ping=Config.DB_POOL_PRE_PING
+            )
+            _db_managers[database_url] = manager
+            logger.info(f"Database engine created (pool_size={Config.DB_POOL_SIZE}, "
+                        f"max_overflow={Config.DB_MAX_OVERFLOW})")
+    return manager
+
+
+async def close_db_managers():
+    """Dispose all shared database engines"""
+    with _db_managers_lock:
+        managers = list(_db_managers.values())
+        _db_managers.clear()
+    for manager in managers:
+        await manager.close_async()
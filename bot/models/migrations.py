@@ -0,0 +1,116 @@
+"""Alembic migrations for VPN Telegram Bot"""
+
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from alembic import command, op
+from alembic.config import Config as AlembicConfig
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect
+
+from bot.models.database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ALEMBIC_INI = os.path.join(PROJECT_ROOT, 'alembic.ini')
+
+# Revision matching tables created by create_all before migrations existed
+BASELINE_REVISION = '0001'
+
+
+class SchemaOutdatedError(RuntimeError):
+    """Database revision differs from the migrations shipped with the code"""
+
+
+def alembic_config(database_url: Optional[str] = None) -> AlembicConfig:
+    """Alembic config pointing at the project migrations"""
+    config = AlembicConfig(ALEMBIC_INI)
+    config.set_main_option('script_location', os.path.join(PROJECT_ROOT, 'migrations'))
+    if database_url:
+        config.set_main_option('sqlalchemy.url', database_url.replace('%', '%%'))
+    # Keep bot logging configuration when migrating at startup
+    config.attributes['configure_logger'] = False
+    return config
+
+
+def head_revision() -> str:
+    """Latest revision of the migration scripts"""
+    return ScriptDirectory.from_config(alembic_config()).get_current_head()
+
+
+def current_revision(connection) -> Optional[str]:
+    """Revision stored in alembic_version, None for unversioned databases"""
+    return MigrationContext.configure(connection).get_current_revision()
+
+
+def ensure_schema(db_manager: DatabaseManager, auto_migrate: bool = True) -> str:
+    """
+    Bring database schema to the head revision.
+    
+    When the database is already at head only alembic_version is read;
+    tables are not reflected.
+    """
+    head = head_revision()
+    with db_manager.engine.connect() as connection:
+        current = current_revision(connection)
+        if current == head:
+            return current
+        legacy = current is None and inspect(connection).has_table('users')
+    
+    config = alembic_config(db_manager.database_url)
+    if legacy:
+        # Created by create_all: later revisions skip what already exists
+        logger.info(f"Unversioned database found, stamping revision {BASELINE_REVISION}")
+        command.stamp(config, BASELINE_REVISION)
+        current = BASELINE_REVISION
+    
+    if current is not None and not auto_migrate:
+        raise SchemaOutdatedError(
+            f"Database schema is at revision {current}, code expects {head}. Run `alembic upgrade head`"
+        )
+    
+    logger.info(f"Migrating database schema {current or 'empty'} -> {head}")
+    command.upgrade(config, 'head')
+    # Pooled connections may have cached the old schema (SQLite pragmas do not reload it)
+    db_manager.engine.dispose()
+    return head
+
+
+async def ensure_schema_async(db_manager: DatabaseManager, auto_migrate: bool = True) -> str:
+    """ensure_schema without blocking the event loop"""
+    return await asyncio.to_thread(ensure_schema, db_manager, auto_migrate)
+
+
+def create_index_online(name: str, table: str, columns, **kw):
+    """
+    Create index without blocking writes.
+    
+    On PostgreSQL the index is built CONCURRENTLY outside the migration
+    transaction; elsewhere a plain CREATE INDEX is used. Existing indexes
+    are left alone so interrupted migrations can be rerun.
+    """
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **kw)
+    else:
+        op.create_index(name, table, columns, if_not_exists=True, **kw)
+
+
+def drop_index_online(name: str, table: str):
+    """Drop index without blocking writes"""
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        op.drop_index(name, table_name=table, if_exists=True)
+
+
+def has_column(table: str, column: str) -> bool:
+    """Check column existence from inside a migration (always False when emitting SQL)"""
+    if op.get_context().as_sql:
+        return False
+    return column in {c['name'] for c in inspect(op.get_bind()).get_columns(table)}
@@ -0,0 +1,26 @@
+"""Common user queries for VPN Telegram Bot"""
+
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from bot.models.database import User, Subscription
+
+
+def users_with_subscription():
+    """SELECT of users with their current subscription joined in the same statement"""
+    return select(User).options(joinedload(User.current_subscription))
+
+
+async def get_user_with_subscription(session, telegram_id: int) -> Optional[User]:
+    """Load user and current subscription by telegram_id in one query"""
+    result = await session.execute(users_with_subscription().filter_by(telegram_id=telegram_id))
+    return result.scalar_one_or_none()
+
+
+def set_current_subscription(user: User, subscription: Optional[Subscription]):
+    """Update denormalized current subscription fields of user"""
+    user.current_subscription_id = subscription.id if subscription else None
+    user.subscription_end = subscription.end_date if subscription else None
+
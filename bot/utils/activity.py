@@ -0,0 +1,114 @@
+"""Write-behind user activity tracking for VPN Bot"""
+
+import logging
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from sqlalchemy import update, bindparam
+
+from bot.models.database import get_db_manager, DatabaseManager, User
+
+logger = logging.getLogger(__name__)
+
+users_table = User.__table__
+
+
+class ActivityTracker:
+    """
+    Buffers last_activity timestamps and writes them in bulk.
+    
+    A user who sends an update can be reached again, so the flush also
+    reactivates users deactivated by a failed broadcast.
+    """
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None):
+        self.db_manager = db_manager
+        self._pending: Dict[int, datetime] = {}
+        self._oldest_pending: Optional[float] = None
+        self.stats: Dict[str, Any] = {
+            'flushes': 0,
+            'flushed_total': 0,
+            'last_flush_size': 0,
+            'max_flush_size': 0,
+            'last_flush_ms': 0.0,
+            'last_flush_lag_seconds': 0.0,
+            'max_flush_lag_seconds': 0.0,
+            'last_flush_at': None,
+            'errors': 0
+        }
+    
+    @property
+    def pending(self) -> int:
+        """Number of users waiting to be flushed"""
+        return len(self._pending)
+    
+    @property
+    def lag_seconds(self) -> float:
+        """Age of the oldest buffered activity"""
+        if self._oldest_pending is None:
+            return 0.0
+        return time.monotonic() - self._oldest_pending
+    
+    def touch(self, telegram_id: int, when: Optional[datetime] = None):
+        """Record user activity, coalescing repeated touches of a user"""
+        when = when or datetime.utcnow()
+        previous = self._pending.get(telegram_id)
+        if previous is None or when > previous:
+            self._pending[telegram_id] = when
+        if self._oldest_pending is None:
+            self._oldest_pending = time.monotonic()
+    
+    async def flush(self) -> int:
+        """Write buffered activity with one executemany UPDATE"""
+        if not self._pending:
+            return 0
+        
+        batch, self._pending = self._pending, {}
+        lag = self.lag_seconds
+        self._oldest_pending = None
+        started = time.monotonic()
+        
+        # Sorted by key so concurrent writers lock rows in the same order
+        params = [{'b_telegram_id': telegram_id, 'b_last_activity': when}
+                  for telegram_id, when in sorted(batch.items())]
+        statement = (
+            update(users_table)
+            .where(users_table.c.telegram_id == bindparam('b_telegram_id'))
+            .values(last_activity=bindparam('b_last_activity'), is_active=True)
+        )
+        
+        db_manager = self.db_manager or get_db_manager()
+        try:
+            async with db_manager.get_async_session() as session:
+                await session.execute(statement, params)
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Failed to flush user activity ({len(batch)} users): {e}")
+            self.stats['errors'] += 1
+            # Put batch back without overwriting newer activity
+            for telegram_id, when in batch.items():
+                self.touch(telegram_id, when)
+            return 0
+        
+        size = len(batch)
+        self.stats.update({
+            'flushes': self.stats['flushes'] + 1,
+            'flushed_total': self.stats['flushed_total'] + size,
+            'last_flush_size': size,
+            'max_flush_size': max(self.stats['max_flush_size'], size),
+            'last_flush_ms': (time.monotonic() - started) * 1000,
+            'last_flush_lag_seconds': lag,
+            'max_flush_lag_seconds': max(self.stats['max_flush_lag_seconds'], lag),
+            'last_flush_at': datetime.utcnow()
+        })
+        return size
+
+
+# Global activity tracker instance
+activity_tracker = ActivityTracker()
+
+
+async def flush_activity_job(context) -> None:
+    """Job queue callback flushing buffered user activity"""
+    await activity_tracker.flush()
@@ -0,0 +1,241 @@
+"""WireGuard client address allocation for VPN Bot"""
+
+import ipaddress
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Optional, Dict, Any, Deque, Iterable, Tuple
+
+from sqlalchemy import select, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from bot.config.settings import Config
+from bot.models.database import get_db_manager, DatabaseManager, IPPool, Subscription
+
+logger = logging.getLogger(__name__)
+
+# Optimistic writes retried after a concurrent writer changed the pool; every
+# retry reloads the row, so a caller gives up after at most this many reloads
+MAX_ATTEMPTS = 10
+
+
+class AddressPoolExhausted(RuntimeError):
+    """Every client address of the server network is assigned"""
+
+
+class AddressBitmap:
+    """
+    In-memory copy of an IPPool row.
+    
+    Offsets below high_water are tracked by the bitmap and the queue of
+    free ones, offsets from high_water on have never been handed out, so
+    take and put are O(1). Offset 0 (network), 1 (server) and the last
+    one (broadcast) are never handed out.
+    """
+    
+    def __init__(self, network: str, bitmap: bytes, version: int):
+        self.network = ipaddress.ip_network(network)
+        self.size = self.network.num_addresses
+        self.bitmap = bytearray(bitmap) or bytearray((self.size + 7) // 8)
+        self.version = version
+        self.allocated = 0
+        self.high_water = 2
+        self.free: Deque[int] = deque()
+        
+        # One pass over the bitmap on load, never afterwards
+        for offset in range(2, self.size - 1):
+            if self.bitmap[offset >> 3] & (1 << (offset & 7)):
+                self.allocated += 1
+                self.high_water = offset + 1
+        self.free.extend(
+            offset for offset in range(2, self.high_water)
+            if not self.bitmap[offset >> 3] & (1 << (offset & 7))
+        )
+    
+    def take(self) -> int:
+        """Mark a free offset as assigned and return it"""
+        if self.free:
+            offset = self.free.popleft()
+        elif self.high_water < self.size - 1:
+            offset = self.high_water
+            self.high_water += 1
+        else:
+            raise AddressPoolExhausted(f"No free addresses left in {self.network}")
+        self.bitmap[offset >> 3] |= 1 << (offset & 7)
+        self.allocated += 1
+        return offset
+    
+    def put(self, offset: int) -> bool:
+        """Mark offset as free, False if it was not assigned"""
+        if not 2 <= offset < self.size - 1 or not self.bitmap[offset >> 3] & (1 << (offset & 7)):
+            return False
+        self.bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+        self.allocated -= 1
+        self.free.append(offset)
+        return True
+    
+    def address(self, offset: int) -> str:
+        return str(self.network.network_address + offset)
+    
+    def offset(self, address: str) -> Optional[int]:
+        ip = ipaddress.ip_address(address)
+        if ip not in self.network:
+            return None
+        return int(ip) - int(self.network.network_address)
+
+
+class AddressAllocator:
+    """
+    Hands out WireGuard client addresses of every server from its IPPool row.
+    
+    The bitmap of each server is cached in memory; every change is written
+    back inside the caller's transaction by an UPDATE conditional on the
+    row version. A writer that lost the race (another process, or a rolled
+    back transaction that left the cache ahead of the database) reloads the
+    row and tries again, so an address is never assigned twice.
+    
+    Each write replaces the whole bitmap (8 KiB for a /16) and bumps one
+    version per server, so allocations on the same server are serialized:
+    on PostgreSQL the row lock is held until the purchase commits and the
+    waiting writer then loses the version check. Writing only the changed
+    byte would not help, both databases rewrite the row (SQLite the page)
+    and the version check still conflicts. This is cheap while purchases
+    per server are far apart; a process that keeps losing raises
+    RuntimeError after MAX_ATTEMPTS reloads, and stats['conflicts'] shows
+    when splitting the pool into per-range rows becomes worth it.
+    """
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None, network: Optional[str] = None,
+                 batch_size: int = 500):
+        self.db_manager = db_manager
+        self.network = network or Config.WG_CLIENT_NETWORK
+        self.batch_size = batch_size
+        self._pools: Dict[str, AddressBitmap] = {}
+        self.stats: Dict[str, Any] = {
+            'allocated': 0,
+            'released': 0,
+            'conflicts': 0,
+            'reloads': 0
+        }
+    
+    def _db(self) -> DatabaseManager:
+        return self.db_manager or get_db_manager()
+    
+    def clear(self):
+        """Forget cached bitmaps, they are reloaded on next use"""
+        self._pools.clear()
+    
+    async def _load(self, session, location: str) -> AddressBitmap:
+        row = (await session.execute(
+            select(IPPool.network, IPPool.bitmap, IPPool.version).where(IPPool.server_location == location)
+        )).one_or_none()
+        if row is None:
+            # Concurrent first allocations both insert, the loser is ignored
+            dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(session.bind.dialect.name)
+            values = dict(server_location=location, network=self.network, bitmap=b'', allocated=0, version=0)
+            if dialect:
+                await session.execute(dialect.insert(IPPool).values(**values).on_conflict_do_nothing())
+            else:
+                await session.execute(insert(IPPool).values(**values))
+            return await self._load(session, location)
+        
+        network, bitmap, version = row
+        if network != self.network:
+            logger.warning(f"IP pool of {location} keeps its network {network}, {self.network} is configured")
+        pool = AddressBitmap(network, bitmap, version)
+        self._pools[location] = pool
+        self.stats['reloads'] += 1
+        return pool
+    
+    async def _store(self, session, location: str, pool: AddressBitmap) -> bool:
+        """Write the whole cached bitmap if nobody changed the row since it was read"""
+        expected = pool.version
+        pool.version += 1
+        result = await session.execute(
+            update(IPPool)
+            .where(IPPool.server_location == location, IPPool.version == expected)
+            .values(bitmap=bytes(pool.bitmap), allocated=pool.allocated, version=expected + 1,
+                    updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            return True
+        
+        self.stats['conflicts'] += 1
+        if self._pools.get(location) is pool:
+            del self._pools[location]
+        return False
+    
+    async def allocate(self, session, location: str) -> str:
+        """Assign a free client address of location within session's transaction"""
+        for _ in range(MAX_ATTEMPTS):
+            pool = self._pools.get(location) or await self._load(session, location)
+            offset = pool.take()
+            if await self._store(session, location, pool):
+                self.stats['allocated'] += 1
+                return pool.address(offset)
+        raise RuntimeError(f"IP pool of {location} changed {MAX_ATTEMPTS} times in a row, giving up allocation")
+    
+    async def release(self, session, addresses: Iterable[Tuple[str, str]]) -> int:
+        """Free (location, address) pairs within session's transaction, one write per location"""
+        by_location: Dict[str, list] = {}
+        for location, address in addresses:
+            by_location.setdefault(location, []).append(address)
+        
+        released = 0
+        for location, location_addresses in by_location.items():
+            for _ in range(MAX_ATTEMPTS):
+                pool = self._pools.get(location) or await self._load(session, location)
+                freed = 0
+                for address in location_addresses:
+                    offset = pool.offset(address)
+                    freed += offset is not None and pool.put(offset)
+                if not freed or await self._store(session, location, pool):
+                    released += freed
+                    break
+            else:
+                raise RuntimeError(f"IP pool of {location} changed {MAX_ATTEMPTS} times in a row, giving up release")
+        
+        self.stats['released'] += released
+        return released
+    
+    async def release_expired(self, now: Optional[datetime] = None) -> int:
+        """Free addresses of expired subscriptions, in batches"""
+        now = now or datetime.utcnow()
+        released = 0
+        while True:
+            async with self._db().get_async_session() as session:
+                rows = (await session.execute(
+                    select(Subscription.id, Subscription.server_location, Subscription.client_ip)
+                    .where(Subscription.client_ip.isnot(None), Subscription.end_date <= now)
+                    .limit(self.batch_size)
+                )).all()
+                if not rows:
+                    break
+                
+                released += await self.release(session, [(row.server_location, row.client_ip) for row in rows])
+                await session.execute(
+                    update(Subscription)
+                    .where(Subscription.id.in_([row.id for row in rows]))
+                    .values(client_ip=None)
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+            if len(rows) < self.batch_size:
+                break
+        
+        if released:
+            logger.info(f"Released {released} client addresses of expired subscriptions")
+        return released
+
+
+# Global address allocator instance
+address_allocator = AddressAllocator()
+
+
+async def release_expired_addresses_job(context) -> None:
+    """Job queue callback freeing addresses of expired subscriptions"""
+    try:
+        await address_allocator.release_expired()
+    except Exception as e:
+        logger.error(f"Failed to release client addresses: {e}")
@@ -0,0 +1,413 @@
+"""Payment completion and VPN config delivery for VPN Bot"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple, Awaitable
+
+from sqlalchemy import select, update, or_
+from telegram import InputMediaDocument
+from telegram.error import BadRequest
+
+from bot.models.database import get_db_manager, User, Subscription, Payment
+from bot.models.queries import set_current_subscription
+from bot.config.settings import Config, SUBSCRIPTION_PLANS
+from bot.utils.cache import user_cache, qr_cache
+from bot.utils.keys import key_allocator, keypair_pool
+from bot.utils.addresses import address_allocator
+from bot.utils.servers import server_registry
+from bot.utils.helpers import (
+    format_date,
+    calculate_end_date,
+    generate_vpn_config,
+    get_server_flag,
+    create_config_file,
+    get_random_server_location,
+    generate_config_filename,
+    calculate_referral_bonus,
+    config_hash
+)
+from locales.ru import get_message
+
+logger = logging.getLogger(__name__)
+
+# Payment statuses a provider confirmation may still complete
+COMPLETABLE_STATUSES = ('pending', 'expired')
+
+
+def parse_order_id(order_id: str) -> Optional[int]:
+    """Get Payment.id from provider order id (vpn_<id>)"""
+    if not order_id or not order_id.startswith('vpn_'):
+        return None
+    try:
+        return int(order_id.replace('vpn_', '', 1))
+    except ValueError:
+        return None
+
+
+async def paid_in_full(payment_id: int, amount: Optional[int], currency: Optional[str]) -> bool:
+    """Whether a provider reported amount (kopecks) covers the payment"""
+    async with get_db_manager().get_async_session() as session:
+        expected = await session.scalar(select(Payment.amount).where(Payment.id == payment_id))
+    if expected is None:
+        return False
+    if currency != 'RUB' or amount is None or amount < expected:
+        logger.warning(f"Payment {payment_id} reported as paid with {amount} kopecks in {currency}, "
+                       f"{expected} RUB kopecks due; left pending")
+        return False
+    return True
+
+
+async def complete_payment(payment_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Mark pending payment as completed and create VPN subscription.
+    
+    Returns None if the payment was already completed or has failed.
+    """
+    completions = await complete_payments([payment_id])
+    return completions[0] if completions else None
+
+
+async def complete_payments(payment_ids: List[int]) -> List[Dict[str, Any]]:
+    """
+    Mark pending payments as completed and create their VPN subscriptions.
+    
+    The status transition is a single conditional UPDATE ... RETURNING, so a
+    payment confirmed concurrently by webhook, manual check and reconciliation
+    is processed only once. Expired payments are claimed too: the provider
+    confirmed the money arrived after we stopped waiting. Completed and
+    failed payments are skipped.
+    """
+    if not payment_ids:
+        return []
+    
+    async with get_db_manager().get_async_session() as session:
+        claimed_ids = (await session.execute(
+            update(Payment)
+            .where(Payment.id.in_(payment_ids), Payment.status.in_(COMPLETABLE_STATUSES))
+            .values(status='completed', completed_at=datetime.utcnow())
+            .returning(Payment.id)
+        )).scalars().all()
+        if not claimed_ids:
+            await session.rollback()
+            return []
+        
+        payments = (await session.execute(
+            select(Payment).where(Payment.id.in_(claimed_ids)).order_by(Payment.id)
+        )).scalars().all()
+        
+        completions = []
+        for payment in payments:
+            completions.append(await _fulfil_payment(session, payment))
+        
+        await session.commit()
+        for completion in completions:
+            # Balance, spending and subscription changed
+            user_cache.invalidate(
+                completion['user'].telegram_id,
+                completion['referrer'].telegram_id if completion['referrer'] else None
+            )
+            logger.info(f"Payment {completion['payment'].id} completed, "
+                        f"subscription {completion['subscription'].id} created")
+        return completions
+
+
+async def _fulfil_payment(session, payment: Payment) -> Dict[str, Any]:
+    """Create subscription and referral bonus for completed payment"""
+    # Get user and update stats
+    user = await session.get(User, payment.user_id)
+    user.total_spent += payment.amount_rubles
+    
+    # Deactivate old subscriptions, returning their addresses and server slots
+    old_subs = (await session.execute(
+        select(Subscription).filter_by(user_id=payment.user_id, is_active=True)
+    )).scalars().all()
+    await address_allocator.release(
+        session, [(sub.server_location, sub.client_ip) for sub in old_subs if sub.client_ip]
+    )
+    await server_registry.release(session, [sub.server_location for sub in old_subs if sub.server_slot])
+    for sub in old_subs:
+        sub.is_active = False
+        sub.client_ip = None
+        sub.server_slot = False
+    
+    # Place on the least loaded server, taking a pooled key when the location has one
+    server_location = await server_registry.place(session)
+    server_slot = server_location is not None
+    if not server_slot:
+        logger.warning(f"No server with spare capacity for payment {payment.id}, placing at random")
+        server_location = get_random_server_location()
+    key = await key_allocator.allocate(session, user.id, server_location)
+    client_ip = None if key else await address_allocator.allocate(session, server_location)
+    subscription = Subscription(
+        user_id=payment.user_id,
+        plan_type=payment.plan_type,
+        end_date=calculate_end_date(payment.plan_type),
+        vpn_config=key.key_data if key else generate_vpn_config(client_ip, server_location, keypair_pool.get()),
+        config_name=f"VPN_{SUBSCRIPTION_PLANS[payment.plan_type]['name']}",
+        server_location=server_location,
+        client_ip=client_ip,
+        server_slot=server_slot
+    )
+    session.add(subscription)
+    await session.flush()
+    set_current_subscription(user, subscription)
+    
+    # Process referral bonus
+    referrer = None
+    bonus = 0
+    if user.referrer_id:
+        referrer = await session.get(User, user.referrer_id)
+        if referrer:
+            bonus = calculate_referral_bonus(payment.amount)
+            referrer.referral_balance += bonus / 100  # Convert to rubles
+    
+    return {
+        'payment': payment,
+        'user': user,
+        'subscription': subscription,
+        'referrer': referrer,
+        'bonus': bonus
+    }
+
+
+async def claim_provider_check(payment_id: int) -> bool:
+    """
+    Record a user-requested provider status check of a pending payment.
+    
+    Returns False when the previous check is younger than
+    PAYMENT_CHECK_MIN_INTERVAL; the time is kept on the payment row so
+    the limit holds across workers.
+    """
+    now = datetime.utcnow()
+    async with get_db_manager().get_async_session() as session:
+        claimed = (await session.execute(
+            update(Payment)
+            .where(
+                Payment.id == payment_id,
+                Payment.status == 'pending',
+                or_(Payment.checked_at.is_(None),
+                    Payment.checked_at <= now - timedelta(seconds=Config.PAYMENT_CHECK_MIN_INTERVAL))
+            )
+            .values(checked_at=now)
+            .returning(Payment.id)
+            .execution_options(synchronize_session=False)
+        )).scalar_one_or_none()
+        await session.commit()
+    return claimed is not None
+
+
+async def fail_payment(payment_id: int) -> bool:
+    """Mark pending payment as failed"""
+    return await set_pending_status([payment_id], 'failed') > 0
+
+
+async def set_pending_status(payment_ids: List[int], status: str) -> int:
+    """Move pending payments to failed/expired status in one UPDATE"""
+    if not payment_ids:
+        return 0
+    
+    async with get_db_manager().get_async_session() as session:
+        result = await session.execute(
+            update(Payment)
+            .where(Payment.id.in_(payment_ids), Payment.status == 'pending')
+            .values(status=status)
+        )
+        await session.commit()
+        return result.rowcount
+
+
+def payment_success_message(subscription: Subscription) -> str:
+    """Build payment success message for subscription"""
+    plan = SUBSCRIPTION_PLANS[subscription.plan_type]
+    return get_message('payment_success',
+        plan_name=plan['name'],
+        end_date=format_date(subscription.end_date),
+        server_location=f"{get_server_flag(subscription.server_location)} {subscription.server_location}"
+    )
+
+
+async def notify_referrer(bot, completion: Dict[str, Any]):
+    """Notify referrer about earned bonus"""
+    referrer = completion['referrer']
+    if not referrer:
+        return
+    
+    try:
+        await bot.send_message(
+            chat_id=referrer.telegram_id,
+            text=get_message('referral_bonus',
+                amount=completion['bonus'] / 100,
+                friend_name=completion['user'].full_name
+            )
+        )
+    except Exception as e:
+        logger.warning(f"Failed to notify referrer about bonus: {e}")
+
+
+def uploaded_file_ids(subscription: Subscription) -> Dict[str, Optional[str]]:
+    """file_id of config and QR documents uploaded for the current config"""
+    if not subscription.vpn_config or subscription.files_config_hash != config_hash(subscription.vpn_config):
+        # Never uploaded, or config changed since the upload
+        return {'document': None, 'qr': None}
+    return {'document': subscription.config_file_id, 'qr': subscription.qr_file_id}
+
+
+async def save_file_ids(subscription: Subscription, document: Optional[str], qr: Optional[str]):
+    """Remember file_id Telegram assigned to uploaded config files"""
+    values = {
+        'config_file_id': document,
+        'qr_file_id': qr,
+        'files_config_hash': config_hash(subscription.vpn_config)
+    }
+    async with get_db_manager().get_async_session() as session:
+        await session.execute(
+            update(Subscription)
+            .where(Subscription.id == subscription.id, Subscription.vpn_config == subscription.vpn_config)
+            .values(**values)
+        )
+        await session.commit()
+    for key, value in values.items():
+        setattr(subscription, key, value)
+
+
+class DeliveryStats:
+    """Bot API calls and latency of config deliveries"""
+    
+    def __init__(self):
+        self.deliveries = 0
+        self.api_calls = 0
+        self.uploads = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+    
+    def record(self, report: Dict[str, Any]):
+        self.deliveries += 1
+        self.api_calls += report['api_calls']
+        self.uploads += report['uploaded']
+        self.total_ms += report['latency_ms']
+        self.max_ms = max(self.max_ms, report['latency_ms'])
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get delivery statistics"""
+        return {
+            'deliveries': self.deliveries,
+            'uploads': self.uploads,
+            'avg_api_calls': self.api_calls / self.deliveries if self.deliveries else 0.0,
+            'avg_latency_ms': self.total_ms / self.deliveries if self.deliveries else 0.0,
+            'max_latency_ms': self.max_ms
+        }
+
+
+# Global config delivery statistics
+delivery_stats = DeliveryStats()
+
+
+def config_album(document, qr, caption: str, filename: Optional[str] = None) -> List[InputMediaDocument]:
+    """Config file and QR code as one media group"""
+    return [
+        InputMediaDocument(document, caption=caption, parse_mode='HTML', filename=filename),
+        InputMediaDocument(qr, caption=get_message('config_qr'), parse_mode='HTML', filename='vpn_qr.png')
+    ]
+
+
+async def _send_config_album(bot, chat_id: int, telegram_id: int, subscription: Subscription,
+                             caption: str) -> Tuple[int, bool]:
+    """Send config album by file_id or upload it, returns (API calls, uploaded)"""
+    file_ids = uploaded_file_ids(subscription)
+    calls = 0
+    if file_ids['document'] and file_ids['qr']:
+        calls += 1
+        try:
+            await bot.send_media_group(
+                chat_id=chat_id,
+                media=config_album(file_ids['document'], file_ids['qr'], caption)
+            )
+            return calls, False
+        except BadRequest as e:
+            # E.g. ids of another bot token, or a QR stored as photo before albums
+            logger.warning(f"Cached config files of subscription {subscription.id} rejected, uploading again: {e}")
+    
+    config_filename = generate_config_filename(telegram_id, subscription.plan_type)
+    # QR code is rendered once per config, off the event loop
+    qr_png = await qr_cache.get(subscription.vpn_config)
+    messages = await bot.send_media_group(
+        chat_id=chat_id,
+        media=config_album(
+            create_config_file(subscription.vpn_config, config_filename),
+            qr_png,
+            caption,
+            filename=config_filename
+        )
+    )
+    calls += 1
+    await save_file_ids(subscription, messages[0].document.file_id, messages[1].document.file_id)
+    return calls, True
+
+
+async def send_vpn_config(bot, chat_id: int, telegram_id: int, subscription: Subscription, caption: str,
+                          *concurrent: Awaitable) -> Dict[str, Any]:
+    """
+    Send VPN config file and QR code to chat in one sendMediaGroup call.
+    
+    Telegram groups documents only with documents, so the QR PNG is sent
+    as a document next to the .conf file; both are sent by file_id once
+    uploaded. Awaitables in concurrent are independent Bot API calls (e.g.
+    editing the pressed message) run alongside the album. Returns the
+    number of API calls and end-to-end latency of the delivery.
+    """
+    started = time.monotonic()
+    results = await asyncio.gather(
+        _send_config_album(bot, chat_id, telegram_id, subscription, caption),
+        *concurrent
+    )
+    album_calls, uploaded = results[0]
+    
+    report = {
+        'api_calls': album_calls + len(concurrent),
+        'latency_ms': (time.monotonic() - started) * 1000,
+        'uploaded': uploaded
+    }
+    delivery_stats.record(report)
+    logger.info(f"Config delivered to {chat_id}: {report['api_calls']} API calls in "
+                f"{report['latency_ms']:.0f} ms{' (uploaded)' if uploaded else ''}")
+    return report
+
+
+async def deliver_completed_payment(bot, completion: Dict[str, Any]):
+    """Push success message and VPN config to the user who paid"""
+    user = completion['user']
+    subscription = completion['subscription']
+    
+    async def deliver():
+        try:
+            # Success message has to stay above the config album
+            await bot.send_message(
+                chat_id=user.telegram_id,
+                text=payment_success_message(subscription),
+                parse_mode='HTML'
+            )
+            await send_vpn_config(
+                bot,
+                user.telegram_id,
+                user.telegram_id,
+                subscription,
+                get_message('vpn_config_info')
+            )
+        except Exception as e:
+            logger.error(f"Failed to deliver config to user {user.telegram_id}: {e}")
+    
+    await asyncio.gather(deliver(), notify_referrer(bot, completion))
+
+
+async def get_latest_subscription(user_id: int) -> Optional[Subscription]:
+    """Get most recent active subscription of user"""
+    async with get_db_manager().get_async_session() as session:
+        result = await session.execute(
+            select(Subscription)
+            .filter_by(user_id=user_id, is_active=True)
+            .order_by(Subscription.created_at.desc())
+            .limit(1)
+        )
+        return result.scalar_one_or_none()
@@ -0,0 +1,413 @@
+"""Rate-limited, resumable broadcasts for VPN Bot"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import select, update, delete, insert, literal
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, Forbidden, TelegramError
+
+from bot.config.settings import Config, SUBSCRIPTION_PLANS
+from bot.models.database import get_db_manager, DatabaseManager, User, Broadcast, BroadcastRecipient
+from bot.utils.segments import SEGMENTS, INACTIVE_DAYS, recipients_query, count_unreachable
+from locales.ru import get_message
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of a send; blocked and chat_not_found mean the chat will never accept messages
+SENT = 'sent'
+BLOCKED = 'blocked'
+CHAT_NOT_FOUND = 'chat_not_found'
+RETRY_AFTER = 'retry_after'
+TRANSIENT = 'transient'
+FAILED = 'failed'
+UNREACHABLE = (BLOCKED, CHAT_NOT_FOUND)
+
+
+def classify_error(error: Exception) -> str:
+    """Map a Telegram error to a send outcome"""
+    if isinstance(error, RetryAfter):
+        return RETRY_AFTER
+    if isinstance(error, Forbidden):
+        # Bot blocked, user deactivated, bot kicked from the group
+        return BLOCKED
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        if 'chat not found' in message or 'user not found' in message or 'deactivated' in message:
+            return CHAT_NOT_FOUND
+        return FAILED
+    # BadRequest subclasses NetworkError, so it is handled first
+    if isinstance(error, (TimedOut, NetworkError)):
+        return TRANSIENT
+    return FAILED
+
+
+class TokenBucket:
+    """Async token bucket, shared by all concurrent senders"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Stop handing out tokens, e.g. after Telegram answered RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+    
+    async def acquire(self):
+        """Wait for one token"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatRateLimiter:
+    """Keeps a minimum interval between messages to the same chat"""
+    
+    def __init__(self, interval: float, max_chats: int = 10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_allowed: "OrderedDict[int, float]" = OrderedDict()
+    
+    async def wait(self, chat_id: int):
+        """Reserve the next slot of chat and sleep until it comes"""
+        now = time.monotonic()
+        ready = self._next_allowed.get(chat_id, now)
+        self._next_allowed[chat_id] = max(now, ready) + self.interval
+        self._next_allowed.move_to_end(chat_id)
+        
+        # Forget chats whose slot has passed long ago
+        while len(self._next_allowed) > self.max_chats:
+            self._next_allowed.popitem(last=False)
+        
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+
+class BroadcastManager:
+    """
+    Sends broadcasts in the background.
+    
+    Recipients of the chosen segment are materialized into
+    broadcast_recipients by one INSERT ... SELECT when the broadcast is
+    created, then read in keyset-paginated batches by user id; after every
+    batch the cursor and counters are written to the broadcast row, so a
+    restarted bot continues where it stopped (at most one batch is resent).
+    """
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None, rate: Optional[float] = None,
+                 chat_interval: Optional[float] = None, concurrency: Optional[int] = None,
+                 batch_size: Optional[int] = None, max_retries: Optional[int] = None,
+                 progress_interval: Optional[float] = None):
+        self.db_manager = db_manager
+        self.bucket = TokenBucket(rate or Config.BROADCAST_RATE)
+        self.chat_limiter = ChatRateLimiter(
+            chat_interval if chat_interval is not None else Config.BROADCAST_CHAT_INTERVAL
+        )
+        self.concurrency = concurrency or Config.BROADCAST_CONCURRENCY
+        self.batch_size = batch_size or Config.BROADCAST_BATCH_SIZE
+        self.max_retries = max_retries if max_retries is not None else Config.BROADCAST_MAX_RETRIES
+        self.progress_interval = (progress_interval if progress_interval is not None
+                                  else Config.BROADCAST_PROGRESS_INTERVAL)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.stats: Dict[str, Any] = {
+            SENT: 0,
+            BLOCKED: 0,
+            CHAT_NOT_FOUND: 0,
+            RETRY_AFTER: 0,
+            TRANSIENT: 0,
+            FAILED: 0,
+            'deactivated': 0,
+            'skipped': 0
+        }
+    
+    def _session(self):
+        return (self.db_manager or get_db_manager()).get_async_session()
+    
+    @property
+    def running(self) -> List[int]:
+        """IDs of broadcasts being sent by this process"""
+        return [broadcast_id for broadcast_id, task in self._tasks.items() if not task.done()]
+    
+    async def create(self, admin_id: int, text: str, parse_mode: str = 'HTML',
+                     progress_chat_id: Optional[int] = None, progress_message_id: Optional[int] = None,
+                     segment: str = 'all', segment_param: Optional[str] = None) -> Broadcast:
+        """Store a new broadcast job together with its recipients"""
+        async with self._session() as session:
+            broadcast = Broadcast(
+                admin_id=admin_id,
+                text=text,
+                parse_mode=parse_mode,
+                status='pending',
+                segment=segment,
+                segment_param=segment_param,
+                sent=0,
+                failed=0,
+                unreachable=0,
+                last_user_id=0,
+                progress_chat_id=progress_chat_id,
+                progress_message_id=progress_message_id
+            )
+            session.add(broadcast)
+            await session.flush()
+            
+            recipients = recipients_query(segment, segment_param)
+            result = await session.execute(
+                insert(BroadcastRecipient).from_select(
+                    ['broadcast_id', 'user_id', 'telegram_id'],
+                    recipients.with_only_columns(literal(broadcast.id), *recipients.selected_columns)
+                )
+            )
+            broadcast.total = result.rowcount
+            broadcast.skipped = await count_unreachable(session, segment, segment_param)
+            await session.commit()
+            self.stats['skipped'] += broadcast.skipped
+            return broadcast
+    
+    def start(self, bot, broadcast_id: int) -> asyncio.Task:
+        """Send broadcast in a background task"""
+        task = self._tasks.get(broadcast_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self.run(bot, broadcast_id), name=f"broadcast-{broadcast_id}")
+            task.add_done_callback(self._run_done)
+            self._tasks[broadcast_id] = task
+        return task
+    
+    @staticmethod
+    def _run_done(task: asyncio.Task):
+        # Progress is checkpointed per batch; a failed broadcast stays running and resumes on next start
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Broadcast task {task.get_name()} failed: {task.exception()}")
+    
+    async def resume(self, bot) -> List[int]:
+        """Restart broadcasts interrupted by a shutdown"""
+        async with self._session() as session:
+            ids = (await session.execute(
+                select(Broadcast.id).where(Broadcast.status.in_(('pending', 'running'))).order_by(Broadcast.id)
+            )).scalars().all()
+        for broadcast_id in ids:
+            logger.info(f"Resuming broadcast #{broadcast_id}")
+            self.start(bot, broadcast_id)
+        return list(ids)
+    
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Stop broadcast after the batch being sent"""
+        async with self._session() as session:
+            result = await session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast_id, Broadcast.status.in_(('pending', 'running')))
+                .values(status='cancelled', finished_at=datetime.utcnow())
+            )
+            if result.rowcount:
+                await session.execute(
+                    delete(BroadcastRecipient).where(BroadcastRecipient.broadcast_id == broadcast_id)
+                )
+            await session.commit()
+            return result.rowcount > 0
+    
+    async def wait(self):
+        """Wait until broadcasts being sent are finished"""
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+    
+    async def stop(self):
+        """Cancel sending tasks; their broadcasts resume on next start"""
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+    
+    async def _load_batch(self, broadcast_id: int, after_id: int) -> List[Tuple[int, int]]:
+        """Next recipients after the cursor as (users.id, telegram_id)"""
+        async with self._session() as session:
+            rows = await session.execute(
+                select(BroadcastRecipient.user_id, BroadcastRecipient.telegram_id)
+                .where(BroadcastRecipient.broadcast_id == broadcast_id, BroadcastRecipient.user_id > after_id)
+                .order_by(BroadcastRecipient.user_id)
+                .limit(self.batch_size)
+            )
+            return [tuple(row) for row in rows]
+    
+    async def _checkpoint(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                          unreachable: int, unreachable_user_ids: List[int]) -> Optional[str]:
+        """Save progress and deactivate unreachable users, returns current status (admin may have cancelled)"""
+        async with self._session() as session:
+            if unreachable_user_ids:
+                # One UPDATE per batch; later broadcasts skip these users
+                await session.execute(
+                    update(User)
+                    .where(User.id.in_(unreachable_user_ids))
+                    .values(is_active=False)
+                    .execution_options(synchronize_session=False)
+                )
+            status = await session.scalar(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast_id)
+                .values(last_user_id=last_user_id, sent=sent, failed=failed, unreachable=unreachable,
+                        updated_at=datetime.utcnow())
+                .returning(Broadcast.status)
+            )
+            await session.commit()
+            return status
+    
+    async def _send(self, bot, chat_id: int, text: str, parse_mode: Optional[str]) -> str:
+        """Send one message within rate limits, retrying flood control and network errors"""
+        for attempt in range(self.max_retries + 1):
+            await self.chat_limiter.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                return SENT
+            except TelegramError as e:
+                outcome = classify_error(e)
+                self.stats[outcome] += 1
+                if outcome == RETRY_AFTER:
+                    # Flood control applies to the whole bot, so every sender waits
+                    self.bucket.pause(float(e.retry_after))
+                elif outcome == TRANSIENT:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                else:
+                    logger.warning(f"Broadcast to {chat_id} failed ({outcome}): {e}")
+                    return outcome
+        
+        logger.warning(f"Broadcast to {chat_id} failed after {self.max_retries} retries")
+        self.stats[FAILED] += 1
+        return FAILED
+    
+    async def _report_progress(self, bot, broadcast: Broadcast, text: str, reply_markup=None):
+        if not broadcast.progress_chat_id or not broadcast.progress_message_id:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=broadcast.progress_chat_id,
+                message_id=broadcast.progress_message_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode='HTML'
+            )
+        except TelegramError as e:
+            logger.debug(f"Broadcast progress not updated: {e}")
+    
+    async def run(self, bot, broadcast_id: int) -> Optional[Broadcast]:
+        """Send broadcast from its saved cursor to the last user"""
+        async with self._session() as session:
+            broadcast = await session.get(Broadcast, broadcast_id)
+            if broadcast is None or broadcast.is_finished:
+                return broadcast
+            broadcast.status = 'running'
+            broadcast.started_at = broadcast.started_at or datetime.utcnow()
+            await session.commit()
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def send(chat_id: int) -> bool:
+            async with semaphore:
+                return await self._send(bot, chat_id, broadcast.text, broadcast.parse_mode)
+        
+        last_user_id, sent, failed = broadcast.last_user_id or 0, broadcast.sent or 0, broadcast.failed or 0
+        unreachable = broadcast.unreachable or 0
+        status = 'running'
+        last_progress = time.monotonic()
+        started = time.monotonic()
+        
+        while status == 'running':
+            batch = await self._load_batch(broadcast_id, last_user_id)
+            if not batch:
+                break
+            
+            outcomes = await asyncio.gather(*[send(telegram_id) for _, telegram_id in batch])
+            delivered = outcomes.count(SENT)
+            unreachable_user_ids = [user_id for (user_id, _), outcome in zip(batch, outcomes)
+                                    if outcome in UNREACHABLE]
+            sent += delivered
+            failed += len(outcomes) - delivered
+            unreachable += len(unreachable_user_ids)
+            self.stats[SENT] += delivered
+            self.stats['deactivated'] += len(unreachable_user_ids)
+            last_user_id = batch[-1][0]
+            
+            status = await self._checkpoint(broadcast_id, last_user_id, sent, failed,
+                                            unreachable, unreachable_user_ids)
+            
+            if time.monotonic() - last_progress >= self.progress_interval:
+                last_progress = time.monotonic()
+                done = sent + failed
+                await self._report_progress(bot, broadcast, get_message('broadcast_progress',
+                    id=broadcast_id, total=broadcast.total, sent=sent, failed=failed,
+                    percent=min(100.0, done / broadcast.total * 100) if broadcast.total else 100.0
+                ), broadcast_cancel_keyboard(broadcast_id))
+        
+        async with self._session() as session:
+            broadcast = await session.get(Broadcast, broadcast_id)
+            if broadcast.status == 'running':
+                broadcast.status = 'completed'
+                broadcast.finished_at = datetime.utcnow()
+            # Recipient list is only needed while sending
+            await session.execute(
+                delete(BroadcastRecipient).where(BroadcastRecipient.broadcast_id == broadcast_id)
+            )
+            await session.commit()
+        
+        logger.info(f"Broadcast #{broadcast_id} {broadcast.status}: sent={sent} failed={failed} "
+                    f"unreachable={unreachable} skipped={broadcast.skipped or 0} "
+                    f"in {time.monotonic() - started:.1f}s")
+        
+        result_text = get_message('broadcast_success', sent=sent, total=sent + failed)
+        if broadcast.status == 'cancelled':
+            result_text = get_message('broadcast_cancelled', sent=sent, total=broadcast.total)
+        if failed:
+            result_text += f"\n❌ Не удалось отправить: {failed}"
+        result_text += get_message('broadcast_pruned',
+            unreachable=unreachable,
+            skipped=broadcast.skipped or 0
+        )
+        await self._report_progress(bot, broadcast, result_text, InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅️ Назад в админку", callback_data='admin_back')]
+        ]))
+        return broadcast
+
+
+def broadcast_cancel_keyboard(broadcast_id: int) -> InlineKeyboardMarkup:
+    """Keyboard of a running broadcast progress message"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("⏹ Остановить рассылку", callback_data=f'admin_broadcast_cancel_{broadcast_id}')]
+    ])
+
+
+def broadcast_segment_keyboard(selected: str = 'all') -> InlineKeyboardMarkup:
+    """Audience choice shown while the admin writes the broadcast"""
+    def button(title: str, value: str) -> InlineKeyboardButton:
+        mark = "• " if value == selected else ""
+        return InlineKeyboardButton(f"{mark}{title}", callback_data=f'admin_broadcast_segment_{value}')
+    
+    keyboard = [
+        [button(SEGMENTS['all'], 'all'), button(SEGMENTS['active'], 'active')],
+        [button(SEGMENTS['expired'], 'expired'), button(SEGMENTS['referrers'], 'referrers')],
+        [button(f"💤 {days} дн.", f'inactive:{days}') for days in INACTIVE_DAYS],
+        [button(f"{plan['emoji']} {plan['name']}", f'plan:{plan_type}') for plan_type, plan in SUBSCRIPTION_PLANS.items()],
+        [InlineKeyboardButton("⬅️ Назад в админку", callback_data='admin_back')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Global broadcast manager instance
+broadcast_manager = BroadcastManager()
@@ -0,0 +1,349 @@
+"""In-memory caches for VPN Bot"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from bot.config.settings import Config
+from bot.models.database import SubscriptionPeriodMixin
+from bot.utils.helpers import render_qr_png, config_hash
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SubscriptionSummary(SubscriptionPeriodMixin):
+    """Immutable summary of user's active subscription"""
+    id: int
+    plan_type: str
+    end_date: datetime
+    server_location: Optional[str]
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Immutable snapshot of user data needed by menu handlers"""
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    referral_code: Optional[str]
+    referrer_id: Optional[int]
+    referral_balance: float
+    total_referrals: int
+    total_spent: float
+    is_active: bool
+    created_at: datetime
+    subscription: Optional[SubscriptionSummary]
+    
+    @classmethod
+    def from_user(cls, user) -> 'UserSnapshot':
+        """Create snapshot from User with loaded subscriptions"""
+        sub = user.active_subscription
+        return cls(
+            id=user.id,
+            telegram_id=user.telegram_id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            referral_code=user.referral_code,
+            referrer_id=user.referrer_id,
+            referral_balance=user.referral_balance or 0.0,
+            total_referrals=user.total_referrals or 0,
+            total_spent=user.total_spent or 0.0,
+            is_active=user.is_active,
+            created_at=user.created_at,
+            subscription=SubscriptionSummary(
+                id=sub.id,
+                plan_type=sub.plan_type,
+                end_date=sub.end_date,
+                server_location=sub.server_location
+            ) if sub else None
+        )
+    
+    @property
+    def full_name(self) -> str:
+        """Get user's full name"""
+        parts = [self.first_name, self.last_name]
+        return ' '.join(filter(None, parts)) or self.username or f"User {self.telegram_id}"
+    
+    @property
+    def active_subscription(self) -> Optional[SubscriptionSummary]:
+        """Get active subscription summary, None once it has expired"""
+        if self.subscription is None or self.subscription.is_expired:
+            return None
+        return self.subscription
+    
+    @property
+    def has_active_subscription(self) -> bool:
+        """Check if user has active subscription"""
+        return self.active_subscription is not None
+
+
+class UserCache:
+    """TTL/LRU cache of user snapshots keyed by telegram_id"""
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[int, tuple]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._version = 0
+    
+    @property
+    def version(self) -> int:
+        """Counter changed by every invalidation, read before loading a snapshot"""
+        return self._version
+    
+    def get(self, telegram_id: int) -> Optional[UserSnapshot]:
+        """Get cached snapshot or None if missing/expired"""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        snapshot, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[telegram_id]
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(telegram_id)
+        self.hits += 1
+        return snapshot
+    
+    def set(self, snapshot: UserSnapshot, version: Optional[int] = None):
+        """
+        Store snapshot, evicting least recently used entries.
+        
+        Snapshot loaded before an invalidation (version changed) is not stored.
+        """
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        if version is not None and version != self._version:
+            return
+        self._entries[snapshot.telegram_id] = (snapshot, time.monotonic() + self.ttl)
+        self._entries.move_to_end(snapshot.telegram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, *telegram_ids: Optional[int]):
+        """Drop cached snapshots of users"""
+        self._version += 1
+        for telegram_id in telegram_ids:
+            if self._entries.pop(telegram_id, None) is not None:
+                self.invalidations += 1
+    
+    def clear(self):
+        """Drop all cached snapshots"""
+        self._version += 1
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+
+class QRCodeCache:
+    """
+    LRU cache of rendered QR code PNGs keyed by SHA-256 of the encoded data.
+    
+    Misses are rendered in an executor so qrcode/Pillow never run on the
+    event loop; concurrent requests for the same data share one render.
+    With a directory configured, PNGs are also kept on disk (least recently
+    used files are removed above disk_size) and survive restarts.
+    """
+    
+    def __init__(self, max_size: int = 256, directory: Optional[str] = None, disk_size: int = 10000,
+                 executor: str = 'thread', workers: int = 2):
+        self.max_size = max_size
+        self.directory = directory or None
+        self.disk_size = disk_size
+        self.executor_kind = executor
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._rendering: Dict[str, asyncio.Future] = {}
+        self._disk_files: Optional[int] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.render_seconds = 0.0
+    
+    @staticmethod
+    def key(data: str) -> str:
+        """Cache key of QR code data"""
+        return config_hash(data)
+    
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='qr-render')
+        return self._executor
+    
+    def _remember(self, key: str, png: bytes):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = png
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+    
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+            os.utime(path)  # Mark as recently used for pruning
+            return png
+        except FileNotFoundError:
+            return None
+    
+    def _write_disk(self, key: str, png: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+        
+        if self._disk_files is None:
+            self._disk_files = sum(1 for name in os.listdir(self.directory) if name.endswith('.png'))
+        else:
+            self._disk_files += 1
+        if self._disk_files > self.disk_size:
+            self._prune_disk()
+    
+    def _prune_disk(self):
+        """Remove least recently used files, leaving 10% headroom so pruning is rare"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.png')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        keep = int(self.disk_size * 0.9)
+        for entry in entries[:max(0, len(entries) - keep)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        self._disk_files = min(len(entries), keep)
+    
+    async def _load(self, key: str, data: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        if self.directory:
+            png = await loop.run_in_executor(None, self._read_disk, key)
+            if png is not None:
+                self.disk_hits += 1
+                return png
+        
+        self.misses += 1
+        started = time.monotonic()
+        png = await loop.run_in_executor(self._get_executor(), render_qr_png, data)
+        self.render_seconds += time.monotonic() - started
+        
+        if self.directory:
+            try:
+                await loop.run_in_executor(None, self._write_disk, key, png)
+            except OSError as e:
+                logger.warning(f"Failed to store QR code on disk: {e}")
+        return png
+    
+    async def get(self, data: str) -> bytes:
+        """PNG bytes of QR code encoding data"""
+        key = self.key(data)
+        png = self._entries.get(key)
+        if png is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return png
+        
+        future = self._rendering.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, data))
+            self._rendering[key] = future
+            future.add_done_callback(lambda done: self._loaded(key, done))
+        else:
+            # Another request is rendering the same config
+            self.hits += 1
+        
+        # Shielded: a cancelled request must not abort the render others wait for
+        return await asyncio.shield(future)
+    
+    def _loaded(self, key: str, future: asyncio.Future):
+        self._rendering.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self._remember(key, future.result())
+    
+    def invalidate(self, data: str):
+        """Drop cached PNG of data"""
+        key = self.key(data)
+        self._entries.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self._disk_path(key))
+                if self._disk_files:
+                    self._disk_files -= 1
+            except FileNotFoundError:
+                pass
+    
+    def clear(self):
+        """Drop PNGs kept in memory"""
+        self._entries.clear()
+    
+    def shutdown(self):
+        """Stop render workers"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'avg_render_ms': self.render_seconds / self.misses * 1000 if self.misses else 0.0
+        }
+
+
+# Global user cache instance
+user_cache = UserCache(max_size=Config.USER_CACHE_SIZE, ttl=Config.USER_CACHE_TTL)
+
+# Global QR code cache instance
+qr_cache = QRCodeCache(
+    max_size=Config.QR_CACHE_SIZE,
+    directory=Config.QR_CACHE_DIR,
+    disk_size=Config.QR_CACHE_DISK_SIZE,
+    executor=Config.QR_RENDER_EXECUTOR,
+    workers=Config.QR_RENDER_WORKERS
+)
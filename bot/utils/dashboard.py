@@ -0,0 +1,90 @@
+"""Admin dashboard metrics for VPN Bot"""
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select, func, case
+
+from bot.config.settings import Config
+from bot.models.database import get_db_manager, DatabaseManager, User, Subscription, Payment, VPNKey
+
+
+class DashboardMetrics:
+    """Computes admin panel metrics in one query and caches them briefly"""
+    
+    def __init__(self, ttl: Optional[float] = None, db_manager: Optional[DatabaseManager] = None):
+        self.db_manager = db_manager
+        self.ttl = ttl if ttl is not None else Config.ADMIN_DASHBOARD_CACHE_TTL
+        self._metrics: Optional[Dict[str, Any]] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.queries = 0
+    
+    @staticmethod
+    def build_query(now: datetime):
+        """Single SELECT returning all dashboard metrics"""
+        today = datetime.combine(now.date(), datetime.min.time())
+        start_of_month = today.replace(day=1)
+        
+        # Separate counts so each one is answered from its own index
+        total_users = select(func.count(User.id)).scalar_subquery()
+        active_users = select(func.count(User.id)).where(
+            User.last_activity >= now - timedelta(days=7)
+        ).scalar_subquery()
+        new_users = select(func.count(User.id)).where(User.created_at >= today).scalar_subquery()
+        
+        revenue = select(
+            func.coalesce(func.sum(case((Payment.completed_at >= today, Payment.amount), else_=0)), 0)
+            .label('daily_revenue'),
+            func.coalesce(func.sum(Payment.amount), 0).label('monthly_revenue')
+        ).where(
+            Payment.status == 'completed',
+            Payment.completed_at >= start_of_month
+        ).subquery()
+        
+        active_subscriptions = select(func.count(Subscription.id)).where(
+            Subscription.is_active == True,
+            Subscription.end_date > now
+        ).scalar_subquery()
+        
+        available_keys = select(func.count(VPNKey.id)).where(VPNKey.is_used == False).scalar_subquery()
+        
+        return select(
+            total_users.label('total_users'),
+            active_users.label('active_users'),
+            new_users.label('new_users'),
+            revenue.c.daily_revenue,
+            revenue.c.monthly_revenue,
+            active_subscriptions.label('active_subscriptions'),
+            available_keys.label('available_keys')
+        )
+    
+    async def get(self, force: bool = False) -> Dict[str, Any]:
+        """Get metrics, recomputing them when the cached copy is older than ttl"""
+        if not force and self._metrics is not None and time.monotonic() < self._expires_at:
+            return self._metrics
+        
+        async with self._lock:
+            # Another admin may have refreshed metrics while we waited
+            if not force and self._metrics is not None and time.monotonic() < self._expires_at:
+                return self._metrics
+            
+            now = datetime.utcnow()
+            async with (self.db_manager or get_db_manager()).get_async_session() as session:
+                row = (await session.execute(self.build_query(now))).mappings().one()
+            self.queries += 1
+            
+            metrics = dict(row)
+            metrics['daily_revenue'] = (metrics['daily_revenue'] or 0) / 100  # Convert from kopecks
+            metrics['monthly_revenue'] = (metrics['monthly_revenue'] or 0) / 100
+            metrics['updated_at'] = now
+            
+            self._metrics = metrics
+            self._expires_at = time.monotonic() + self.ttl
+            return metrics
+
+
+# Global dashboard metrics instance
+dashboard_metrics = DashboardMetrics()
@@ -6,10 +6,12 @@ import hashlib
 import logging
 import os
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, List
 import qrcode
 from io import BytesIO
 import base64
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, PublicFormat, NoEncryption
 
 logger = logging.getLogger(__name__)
 
@@ -55,24 +57,20 @@ def generate_referral_code(length: int = 8) -> str:
     return ''.join(random.choice(chars) for _ in range(length))
 
 
-def generate_vpn_config(user_id: int, server_location: str = "Netherlands") -> str:
-    """Generate VPN configuration for user"""
-    # Generate unique keys for user
-    private_key = generate_private_key()
-    public_key = generate_public_key(private_key)
-    
-    # Assign unique IP address
-    ip_suffix = (user_id % 254) + 1
-    client_ip = f"10.0.0.{ip_suffix}/32"
+def generate_vpn_config(client_ip: str, server_location: str = "Netherlands",
+                        keypair: Optional[Tuple[str, str]] = None) -> str:
+    """Generate VPN configuration for client address assigned by the server's IP pool"""
+    # Generate unique keys for user unless a pre-generated pair is given
+    private_key, public_key = keypair or generate_keypair()
     
     config_template = f"""[Interface]
 PrivateKey = {private_key}
-Address = {client_ip}
+Address = {client_ip}/32
 DNS = 1.1.1.1, 8.8.8.8
 MTU = 1420
 
 [Peer]
-PublicKey = SERVER_PUBLIC_KEY_PLACEHOLDER
+PublicKey = {get_server_public_key(server_location)}
 Endpoint = {get_server_endpoint(server_location)}
 AllowedIPs = 0.0.0.0/0
 PersistentKeepalive = 25
@@ -81,22 +79,38 @@ PersistentKeepalive = 25
 
 
 def generate_private_key() -> str:
-    """Generate WireGuard private key (simplified for demo)"""
-    # In production, use proper WireGuard key generation
-    key_bytes = os.urandom(32)
+    """Generate WireGuard (X25519) private key, base64 encoded like `wg genkey`"""
+    key_bytes = X25519PrivateKey.generate().private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
     return base64.b64encode(key_bytes).decode('utf-8')
 
 
 def generate_public_key(private_key: str) -> str:
-    """Generate public key from private key (simplified for demo)"""
-    # In production, use proper WireGuard key derivation
-    hash_obj = hashlib.sha256(private_key.encode())
-    key_bytes = hash_obj.digest()
+    """Derive WireGuard public key from base64 private key, like `wg pubkey`"""
+    key = X25519PrivateKey.from_private_bytes(base64.b64decode(private_key))
+    key_bytes = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
     return base64.b64encode(key_bytes).decode('utf-8')
 
 
+def generate_keypair() -> Tuple[str, str]:
+    """Generate WireGuard (private, public) key pair"""
+    private_key = generate_private_key()
+    return private_key, generate_public_key(private_key)
+
+
+def generate_keypairs(count: int) -> List[Tuple[str, str]]:
+    """Generate count key pairs (CPU bound, run in an executor)"""
+    return [generate_keypair() for _ in range(count)]
+
+
 def get_server_endpoint(location: str) -> str:
-    """Get server endpoint for location"""
+    """Get server endpoint for location from the server registry"""
+    from bot.utils.servers import server_registry
+    
+    server = server_registry.get(location)
+    if server:
+        return server['endpoint']
+    
+    # Defaults until the registry is loaded
     servers = {
         "Netherlands": "nl.vpnserver.com:51820",
         "Germany": "de.vpnserver.com:51820",
@@ -108,8 +122,13 @@ def get_server_endpoint(location: str) -> str:
     return servers.get(location, "nl.vpnserver.com:51820")
 
 
-def create_qr_code(data: str) -> BytesIO:
-    """Create QR code from data"""
+def config_hash(config: str) -> str:
+    """SHA-256 of VPN config, identifies files rendered from it"""
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()
+
+
+def render_qr_png(data: str) -> bytes:
+    """Render QR code of data as PNG bytes (CPU bound, safe to run in a worker process)"""
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -122,8 +141,12 @@ def create_qr_code(data: str) -> BytesIO:
     img = qr.make_image(fill_color="black", back_color="white")
     img_buffer = BytesIO()
     img.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
-    return img_buffer
+    return img_buffer.getvalue()
+
+
+def create_qr_code(data: str) -> BytesIO:
+    """Create QR code from data"""
+    return BytesIO(render_qr_png(data))
 
 
 def format_datetime(dt: datetime) -> str:
@@ -239,8 +262,22 @@ def get_plan_emoji(plan_type: str) -> str:
     return emojis.get(plan_type, '📦')
 
 
+def get_server_public_key(location: str) -> str:
+    """Get WireGuard public key of the server at location"""
+    from bot.utils.servers import server_registry
+    
+    server = server_registry.get(location)
+    return server['public_key'] if server and server['public_key'] else "SERVER_PUBLIC_KEY_PLACEHOLDER"
+
+
 def get_server_flag(location: str) -> str:
     """Get flag emoji for server location"""
+    from bot.utils.servers import server_registry
+    
+    server = server_registry.get(location)
+    if server and server['flag']:
+        return server['flag']
+    
     flags = {
         "Netherlands": "🇳🇱",
         "Germany": "🇩🇪",
@@ -260,53 +297,35 @@ def create_referral_link(referral_code: str, bot_username: str) -> str:
     return f"https://t.me/{bot_username}?start={referral_code}"
 
 
-def log_admin_action(admin_id: int, action: str, target_user_id: Optional[int] = None, details: Optional[str] = None):
+async def log_admin_action(admin_id: int, action: str, target_user_id: Optional[int] = None, details: Optional[str] = None):
     """Log admin action to database"""
-    from bot.models.database import DatabaseManager, AdminLog
-    from bot.config.settings import Config
-    
-    db_manager = DatabaseManager(Config.DATABASE_URL)
-    session = db_manager.get_session()
+    from bot.models.database import get_db_manager, AdminLog
     
-    try:
-        log_entry = AdminLog(
-            admin_id=admin_id,
-            action=action,
-            target_user_id=target_user_id,
-            details=details
-        )
-        session.add(log_entry)
-        session.commit()
-        logger.info(f"Admin action logged: {admin_id} - {action}")
-    except Exception as e:
-        logger.error(f"Failed to log admin action: {e}")
-        session.rollback()
-    finally:
-        session.close()
-
-
-def update_user_activity(user_id: int):
-    """Update user's last activity timestamp"""
-    from bot.models.database import DatabaseManager, User
-    from bot.config.settings import Config
-    
-    db_manager = DatabaseManager(Config.DATABASE_URL)
-    session = db_manager.get_session()
+    async with get_db_manager().get_async_session() as session:
+        try:
+            log_entry = AdminLog(
+                admin_id=admin_id,
+                action=action,
+                target_user_id=target_user_id,
+                details=details
+            )
+            session.add(log_entry)
+            await session.commit()
+            logger.info(f"Admin action logged: {admin_id} - {action}")
+        except Exception as e:
+            logger.error(f"Failed to log admin action: {e}")
+            await session.rollback()
+
+
+async def update_user_activity(user_id: int):
+    """Record user's activity, written to database in batches"""
+    from bot.utils.activity import activity_tracker
     
-    try:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if user:
-            user.last_activity = datetime.utcnow()
-            session.commit()
-    except Exception as e:
-        logger.error(f"Failed to update user activity: {e}")
-        session.rollback()
-    finally:
-        session.close()
+    activity_tracker.touch(user_id)
 
 
 def get_random_server_location() -> str:
-    """Get random server location for load balancing"""
+    """Get random server location (fallback when no registered server has spare capacity)"""
     locations = ["Netherlands", "Germany", "France", "United States", "Japan", "Singapore"]
     return random.choice(locations)
 
@@ -324,49 +343,20 @@ class StatsCalculator:
     """Statistics calculation utilities"""
     
     @staticmethod
-    def calculate_daily_stats():
+    async def calculate_daily_stats():
         """Calculate daily statistics"""
-        from bot.models.database import DatabaseManager, User, Payment, Subscription
-        from bot.config.settings import Config
-        
-        db_manager = DatabaseManager(Config.DATABASE_URL)
-        session = db_manager.get_session()
+        from bot.utils.stats import stats_engine
         
         try:
-            today = datetime.utcnow().date()
-            
-            # New users today
-            new_users = session.query(User).filter(
-                User.created_at >= today
-            ).count()
-            
-            # Successful payments today
-            successful_payments = session.query(Payment).filter(
-                Payment.created_at >= today,
-                Payment.status == 'completed'
-            ).count()
-            
-            # Daily revenue
-            revenue_result = session.query(Payment).filter(
-                Payment.created_at >= today,
-                Payment.status == 'completed'
-            ).all()
-            
-            daily_revenue = sum(p.amount_rubles for p in revenue_result)
-            
-            # Active subscriptions
-            active_subscriptions = session.query(Subscription).filter(
-                Subscription.is_active == True,
-                Subscription.end_date > datetime.utcnow()
-            ).count()
-            
+            today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+            summary = await stats_engine.summary(today)
             return {
-                'new_users': new_users,
-                'successful_payments': successful_payments,
-                'daily_revenue': daily_revenue,
-                'active_subscriptions': active_subscriptions
+                'new_users': summary['new_users'],
+                'successful_payments': summary['payments'],
+                'daily_revenue': summary['revenue'],
+                'active_subscriptions': summary['active_subscriptions']
             }
-            
+        
         except Exception as e:
             logger.error(f"Failed to calculate daily stats: {e}")
             return {
@@ -375,8 +365,6 @@ class StatsCalculator:
                 'daily_revenue': 0.0,
                 'active_subscriptions': 0
             }
-        finally:
-            session.close()
 
 
 # Import payment manager
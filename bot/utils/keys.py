@@ -0,0 +1,259 @@
+"""VPN key pool allocation for VPN Bot"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Deque, Tuple
+
+from sqlalchemy import select, update
+
+from bot.config.settings import Config
+from bot.models.database import get_db_manager, DatabaseManager, VPNKey
+from bot.utils.helpers import generate_keypair, generate_keypairs
+
+logger = logging.getLogger(__name__)
+
+
+class KeyAllocator:
+    """
+    Hands out unused VPNKey rows, each to exactly one user.
+    
+    Keys are reserved in small batches by one atomic statement (is_used set,
+    assigned_user_id still empty): an UPDATE over a FOR UPDATE SKIP LOCKED
+    subquery committed on its own on PostgreSQL, a conditional UPDATE ...
+    RETURNING inside the purchase transaction on SQLite, whose single
+    writer lock is already held by it.
+    Reserved IDs wait in a per-location buffer, so concurrent purchases pop
+    different keys without touching the same rows; the final assignment is
+    a conditional UPDATE inside the caller's transaction. Reservations
+    older than reservation_ttl (left by a crashed process or a rolled back
+    purchase) go back to the pool.
+    """
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None, prefetch: Optional[int] = None,
+                 reservation_ttl: Optional[int] = None):
+        self.db_manager = db_manager
+        self.prefetch = prefetch or Config.VPN_KEY_PREFETCH
+        self.reservation_ttl = reservation_ttl or Config.VPN_KEY_RESERVATION_TTL
+        self._buffers: Dict[str, Deque[Tuple[int, float]]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.stats: Dict[str, Any] = {
+            'allocated': 0,
+            'reserved': 0,
+            'refills': 0,
+            'exhausted': 0,
+            'lost': 0,
+            'released': 0
+        }
+    
+    def _db(self) -> DatabaseManager:
+        return self.db_manager or get_db_manager()
+    
+    def buffered(self, location: Optional[str] = None) -> int:
+        """Number of reserved keys waiting in memory"""
+        if location is not None:
+            return len(self._buffers.get(location, ()))
+        return sum(len(buffer) for buffer in self._buffers.values())
+    
+    def reserve_statement(self, location: str, count: int, dialect: str):
+        """Single statement reserving up to count unused keys of location, returns their IDs"""
+        candidates = (
+            select(VPNKey.id)
+            .where(VPNKey.is_used == False, VPNKey.server_location == location)
+            .order_by(VPNKey.id)
+            .limit(count)
+        )
+        if dialect == 'postgresql':
+            # Rows locked by a concurrent reservation are skipped instead of waited for
+            candidates = candidates.with_for_update(skip_locked=True)
+        
+        return (
+            update(VPNKey)
+            .where(VPNKey.id.in_(candidates.scalar_subquery()), VPNKey.is_used == False)
+            .values(is_used=True, used_at=datetime.utcnow())
+            .returning(VPNKey.id)
+            .execution_options(synchronize_session=False)
+        )
+    
+    async def _refill(self, session, location: str) -> int:
+        """Reserve a batch of keys into the location buffer"""
+        dialect = session.bind.dialect.name
+        statement = self.reserve_statement(location, self.prefetch, dialect)
+        if dialect == 'sqlite':
+            ids = (await session.execute(statement)).scalars().all()
+        else:
+            async with self._db().get_async_session() as own_session:
+                ids = (await own_session.execute(statement)).scalars().all()
+                await own_session.commit()
+        
+        reserved_at = time.monotonic()
+        self._buffers.setdefault(location, deque()).extend((key_id, reserved_at) for key_id in sorted(ids))
+        self.stats['refills'] += 1
+        self.stats['reserved'] += len(ids)
+        return len(ids)
+    
+    async def _next_id(self, session, location: str) -> Optional[int]:
+        buffer = self._buffers.setdefault(location, deque())
+        lock = self._locks.setdefault(location, asyncio.Lock())
+        while True:
+            # Reservations near their TTL may be swept back into the pool
+            while buffer and time.monotonic() - buffer[0][1] > self.reservation_ttl / 2:
+                buffer.popleft()
+                self.stats['lost'] += 1
+            if buffer:
+                return buffer.popleft()[0]
+            
+            async with lock:
+                if buffer:
+                    continue
+                if not await self._refill(session, location):
+                    self.stats['exhausted'] += 1
+                    return None
+    
+    async def allocate(self, session, user_id: int, location: str) -> Optional[VPNKey]:
+        """
+        Assign a free key of location to user within session's transaction.
+        
+        Returns None when the pool of the location is empty.
+        """
+        while True:
+            key_id = await self._next_id(session, location)
+            if key_id is None:
+                return None
+            
+            key = (await session.execute(
+                update(VPNKey)
+                .where(VPNKey.id == key_id, VPNKey.is_used == True, VPNKey.assigned_user_id.is_(None))
+                .values(assigned_user_id=user_id, used_at=datetime.utcnow())
+                .returning(VPNKey)
+                .execution_options(synchronize_session=False)
+            )).scalar_one_or_none()
+            if key is not None:
+                self.stats['allocated'] += 1
+                return key
+            
+            # Reservation was swept as stale or rolled back meanwhile
+            self.stats['lost'] += 1
+    
+    async def release(self) -> int:
+        """Return buffered reservations to the pool (on shutdown)"""
+        ids = [key_id for buffer in self._buffers.values() for key_id, _ in buffer]
+        self._buffers.clear()
+        if not ids:
+            return 0
+        return await self._unreserve(VPNKey.id.in_(ids))
+    
+    async def release_stale(self) -> int:
+        """Return reservations older than reservation_ttl to the pool"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.reservation_ttl)
+        return await self._unreserve(VPNKey.used_at < cutoff)
+    
+    async def _unreserve(self, criterion) -> int:
+        async with self._db().get_async_session() as session:
+            result = await session.execute(
+                update(VPNKey)
+                .where(VPNKey.is_used == True, VPNKey.assigned_user_id.is_(None), criterion)
+                .values(is_used=False, used_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        if result.rowcount:
+            self.stats['released'] += result.rowcount
+            logger.info(f"Returned {result.rowcount} reserved VPN keys to the pool")
+        return result.rowcount
+
+
+class KeypairPool:
+    """
+    Pre-generated WireGuard key pairs for the payment completion path.
+    
+    get() pops a ready pair; once fewer than low_water are left a refill
+    up to size runs in a worker thread, so X25519 generation stays off the
+    event loop. An empty pool falls back to generating inline.
+    """
+    
+    def __init__(self, size: Optional[int] = None, low_water: Optional[int] = None, batch_size: int = 32):
+        self.size = size if size is not None else Config.WG_KEYPAIR_POOL_SIZE
+        self.low_water = low_water if low_water is not None else Config.WG_KEYPAIR_POOL_LOW_WATER
+        self.batch_size = batch_size
+        self._pairs: Deque[Tuple[str, str]] = deque()
+        self._refill_task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.stats: Dict[str, Any] = {
+            'served': 0,
+            'inline': 0,
+            'generated': 0,
+            'refills': 0
+        }
+    
+    def __len__(self):
+        return len(self._pairs)
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='wg-keygen')
+        return self._executor
+    
+    def get(self) -> Tuple[str, str]:
+        """Take a (private, public) key pair, scheduling a refill when running low"""
+        if self._pairs:
+            pair = self._pairs.popleft()
+            self.stats['served'] += 1
+        else:
+            pair = generate_keypair()
+            self.stats['inline'] += 1
+        if len(self._pairs) < min(self.low_water, self.size):
+            self.schedule_refill()
+        return pair
+    
+    def schedule_refill(self) -> Optional[asyncio.Task]:
+        """Start a background refill unless one is running (no-op outside the event loop)"""
+        if self._refill_task is None or self._refill_task.done():
+            try:
+                self._refill_task = asyncio.get_running_loop().create_task(self.fill())
+            except RuntimeError:
+                return None
+        return self._refill_task
+    
+    async def fill(self) -> int:
+        """Generate pairs up to size in the worker thread, in batches"""
+        loop = asyncio.get_running_loop()
+        generated = 0
+        self.stats['refills'] += 1
+        while len(self._pairs) < self.size:
+            count = min(self.batch_size, self.size - len(self._pairs))
+            try:
+                self._pairs.extend(await loop.run_in_executor(self._get_executor(), generate_keypairs, count))
+            except Exception as e:
+                logger.error(f"Failed to generate WireGuard key pairs: {e}")
+                break
+            generated += count
+        self.stats['generated'] += generated
+        return generated
+    
+    def shutdown(self):
+        """Stop the key generation worker"""
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# Global key allocator instance
+key_allocator = KeyAllocator()
+
+# Global WireGuard key pair pool
+keypair_pool = KeypairPool()
+
+
+async def release_stale_keys_job(context) -> None:
+    """Job queue callback returning abandoned key reservations to the pool"""
+    try:
+        await key_allocator.release_stale()
+    except Exception as e:
+        logger.error(f"Failed to release stale VPN key reservations: {e}")
@@ -1,11 +1,14 @@
 """Payment processing utilities for VPN Bot"""
 
+import asyncio
 import logging
 import hashlib
 import hmac
 import json
-import requests
+import aiohttp
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_DOWN
 from typing import Optional, Dict, Any
 from urllib.parse import urlencode
 
@@ -19,21 +22,84 @@ class PaymentError(Exception):
     pass
 
 
-class YooMoneyPayment:
+@dataclass(frozen=True)
+class Notification:
+    """Verified provider notification"""
+    order_id: str
+    status: str
+    amount: Optional[int] = None  # Paid amount in kopecks
+    currency: Optional[str] = None  # ISO 4217 letter code
+
+
+def to_kopecks(value: Any) -> Optional[int]:
+    """Convert provider amount in rubles ('299.00') to kopecks, None if malformed"""
+    try:
+        return int((Decimal(str(value)) * 100).to_integral_value(rounding=ROUND_DOWN))
+    except (InvalidOperation, ValueError, OverflowError):
+        return None
+
+
+class PaymentProvider:
+    """Base payment processor with a shared keep-alive HTTP session"""
+    
+    name = 'provider'
+    default_base_url = ''
+    
+    def __init__(self, base_url: Optional[str] = None, limit: Optional[int] = None,
+                 timeout: Optional[float] = None, connect_timeout: Optional[float] = None):
+        self.base_url = base_url or self.default_base_url
+        self.limit = limit or Config.PAYMENT_HTTP_LIMIT
+        self.timeout = aiohttp.ClientTimeout(
+            total=timeout or Config.PAYMENT_HTTP_TIMEOUT,
+            connect=connect_timeout or Config.PAYMENT_HTTP_CONNECT_TIMEOUT
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        """Get provider HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+    
+    async def close(self):
+        """Close provider HTTP session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    def parse_notification(self, payload: Dict[str, Any], headers: Dict[str, str]) -> Notification:
+        """Verify provider notification and return its order, status and paid amount"""
+        raise PaymentError(f"Уведомления {self.name} не поддерживаются")
+
+
+# YooMoney reports ISO 4217 numeric currency codes
+YOOMONEY_CURRENCIES = {'643': 'RUB'}
+
+
+class YooMoneyPayment(PaymentProvider):
     """YooMoney payment processor"""
     
-    def __init__(self):
+    name = 'yoomoney'
+    default_base_url = "https://yoomoney.ru/api"
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.token = Config.YOOMONEY_TOKEN
-        self.base_url = "https://yoomoney.ru/api"
     
-    def create_payment(self, amount: int, order_id: str, description: str) -> Dict[str, Any]:
+    async def create_payment(self, amount: int, order_id: str, description: str) -> Dict[str, Any]:
         """Create YooMoney payment"""
         try:
             url = f"{self.base_url}/request-payment"
             data = {
                 'pattern_id': 'p2p',
                 'to': self.token,
-                'amount': amount / 100,  # Convert kopecks to rubles
+                'amount': str(amount / 100),  # Convert kopecks to rubles
                 'comment': description,
                 'message': description,
                 'label': order_id
@@ -44,10 +110,10 @@ class YooMoneyPayment:
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
             
-            response = requests.post(url, data=data, headers=headers, timeout=10)
-            response.raise_for_status()
+            async with self.get_session().post(url, data=data, headers=headers) as response:
+                response.raise_for_status()
+                result = await response.json(content_type=None)
             
-            result = response.json()
             if result.get('status') == 'success':
                 return {
                     'payment_id': result.get('request_id'),
@@ -57,15 +123,15 @@ class YooMoneyPayment:
                 }
             else:
                 raise PaymentError(f"YooMoney error: {result.get('error')}")
-                
-        except requests.RequestException as e:
-            logger.error(f"YooMoney API error: {e}")
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"YooMoney API error: {e!r}")
             raise PaymentError("Ошибка подключения к YooMoney")
         except Exception as e:
             logger.error(f"YooMoney payment creation error: {e}")
             raise PaymentError("Ошибка создания платежа YooMoney")
     
-    def check_payment(self, payment_id: str) -> str:
+    async def check_payment(self, payment_id: str) -> str:
         """Check YooMoney payment status"""
         try:
             url = f"{self.base_url}/operation-details"
@@ -75,10 +141,10 @@ class YooMoneyPayment:
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
             
-            response = requests.post(url, data=data, headers=headers, timeout=10)
-            response.raise_for_status()
+            async with self.get_session().post(url, data=data, headers=headers) as response:
+                response.raise_for_status()
+                result = await response.json(content_type=None)
             
-            result = response.json()
             status = result.get('status', 'unknown')
             
             if status == 'success':
@@ -87,20 +153,46 @@ class YooMoneyPayment:
                 return 'failed'
             else:
                 return 'pending'
-                
+        
         except Exception as e:
-            logger.error(f"YooMoney payment check error: {e}")
+            logger.error(f"YooMoney payment check error: {e!r}")
             return 'unknown'
+    
+    def parse_notification(self, payload: Dict[str, Any], headers: Dict[str, str]) -> Notification:
+        """Verify YooMoney HTTP notification (sha1_hash)"""
+        secret = Config.YOOMONEY_NOTIFICATION_SECRET
+        if not secret:
+            # An empty secret is public, anybody could sign a notification with it
+            raise PaymentError("Секрет уведомлений YooMoney не настроен")
+        fields = ['notification_type', 'operation_id', 'amount', 'currency', 'datetime', 'sender', 'codepro']
+        check_string = '&'.join([str(payload.get(field, '')) for field in fields] + [secret, str(payload.get('label', ''))])
+        expected = hashlib.sha1(check_string.encode('utf-8')).hexdigest()
+        
+        if not hmac.compare_digest(expected, str(payload.get('sha1_hash', ''))):
+            raise PaymentError("Неверная подпись уведомления YooMoney")
+        
+        # Signed amount is what was credited; withdraw_amount is not covered by sha1_hash
+        label = payload.get('label', '')
+        amount = to_kopecks(payload.get('amount'))
+        currency = YOOMONEY_CURRENCIES.get(str(payload.get('currency', '')), str(payload.get('currency', '')))
+        
+        # Protected (codepro) or unaccepted transfers are not credited yet
+        if str(payload.get('codepro', 'false')).lower() == 'true' or str(payload.get('unaccepted', 'false')).lower() == 'true':
+            return Notification(label, 'pending', amount, currency)
+        return Notification(label, 'completed', amount, currency)
 
 
-class QiwiPayment:
+class QiwiPayment(PaymentProvider):
     """QIWI payment processor"""
     
-    def __init__(self):
+    name = 'qiwi'
+    default_base_url = "https://api.qiwi.com"
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.token = Config.QIWI_TOKEN
-        self.base_url = "https://api.qiwi.com"
     
-    def create_payment(self, amount: int, order_id: str, description: str) -> Dict[str, Any]:
+    async def create_payment(self, amount: int, order_id: str, description: str) -> Dict[str, Any]:
         """Create QIWI payment"""
         try:
             url = f"{self.base_url}/partner/bill/v1/bills/{order_id}"
@@ -122,25 +214,25 @@ class QiwiPayment:
                 'Accept': 'application/json'
             }
             
-            response = requests.put(url, json=data, headers=headers, timeout=10)
-            response.raise_for_status()
+            async with self.get_session().put(url, json=data, headers=headers) as response:
+                response.raise_for_status()
+                result = await response.json(content_type=None)
             
-            result = response.json()
             return {
                 'payment_id': result['billId'],
                 'payment_url': result['payUrl'],
                 'amount': amount,
                 'expires_at': datetime.utcnow() + timedelta(minutes=15)
             }
-            
-        except requests.RequestException as e:
-            logger.error(f"QIWI API error: {e}")
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"QIWI API error: {e!r}")
             raise PaymentError("Ошибка подключения к QIWI")
         except Exception as e:
             logger.error(f"QIWI payment creation error: {e}")
             raise PaymentError("Ошибка создания платежа QIWI")
     
-    def check_payment(self, payment_id: str) -> str:
+    async def check_payment(self, payment_id: str) -> str:
         """Check QIWI payment status"""
         try:
             url = f"{self.base_url}/partner/bill/v1/bills/{payment_id}"
@@ -149,10 +241,10 @@ class QiwiPayment:
                 'Accept': 'application/json'
             }
             
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
+            async with self.get_session().get(url, headers=headers) as response:
+                response.raise_for_status()
+                result = await response.json(content_type=None)
             
-            result = response.json()
             status = result.get('status', {}).get('value', 'unknown')
             
             if status == 'PAID':
@@ -161,19 +253,53 @@ class QiwiPayment:
                 return 'failed'
             else:
                 return 'pending'
-                
+        
         except Exception as e:
-            logger.error(f"QIWI payment check error: {e}")
+            logger.error(f"QIWI payment check error: {e!r}")
             return 'unknown'
+    
+    def parse_notification(self, payload: Dict[str, Any], headers: Dict[str, str]) -> Notification:
+        """Verify QIWI bill notification (X-Api-Signature-SHA256)"""
+        if not Config.QIWI_SECRET_KEY:
+            raise PaymentError("Секрет уведомлений QIWI не настроен")
+        
+        bill = payload.get('bill', {})
+        amount = bill.get('amount', {})
+        status = bill.get('status', {}).get('value', '')
+        check_string = '|'.join([
+            str(amount.get('currency', '')),
+            str(amount.get('value', '')),
+            str(bill.get('billId', '')),
+            str(bill.get('siteId', '')),
+            str(status)
+        ])
+        expected = hmac.new(
+            Config.QIWI_SECRET_KEY.encode('utf-8'),
+            check_string.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        
+        if not hmac.compare_digest(expected, headers.get('X-Api-Signature-SHA256', '')):
+            raise PaymentError("Неверная подпись уведомления QIWI")
+        
+        paid = (to_kopecks(amount.get('value')), amount.get('currency'))
+        if status == 'PAID':
+            return Notification(bill.get('billId', ''), 'completed', *paid)
+        elif status in ['REJECTED', 'EXPIRED']:
+            return Notification(bill.get('billId', ''), 'failed', *paid)
+        return Notification(bill.get('billId', ''), 'pending', *paid)
 
 
-class CryptomusPayment:
+class CryptomusPayment(PaymentProvider):
     """Cryptomus cryptocurrency payment processor"""
     
-    def __init__(self):
+    name = 'crypto'
+    default_base_url = "https://api.cryptomus.com/v1"
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.api_key = Config.CRYPTOMUS_API_KEY
         self.merchant_id = Config.CRYPTOMUS_MERCHANT_ID
-        self.base_url = "https://api.cryptomus.com/v1"
     
     def _generate_signature(self, data: dict) -> str:
         """Generate signature for Cryptomus API"""
@@ -186,17 +312,29 @@ class CryptomusPayment:
         ).hexdigest()
         return signature
     
-    def create_payment(self, amount: int, order_id: str, description: str) -> Dict[str, Any]:
+    async def _post(self, path: str, data: dict) -> Dict[str, Any]:
+        """Send signed request to Cryptomus API"""
+        headers = {
+            'merchant': self.merchant_id,
+            'sign': self._generate_signature(data),
+            'Content-Type': 'application/json'
+        }
+        body = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        
+        async with self.get_session().post(f"{self.base_url}{path}", data=body.encode('utf-8'),
+                                           headers=headers) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+    
+    async def create_payment(self, amount: int, order_id: str, description: str) -> Dict[str, Any]:
         """Create cryptocurrency payment"""
         try:
-            url = f"{self.base_url}/payment"
-            
             data = {
                 'amount': str(amount / 100),  # Convert to rubles
                 'currency': 'RUB',
                 'order_id': order_id,
                 'merchant': self.merchant_id,
-                'url_callback': 'https://your-domain.com/webhook/cryptomus',
+                'url_callback': f"{Config.PAYMENT_WEBHOOK_BASE_URL}/webhook/cryptomus",
                 'url_return': 'https://t.me/your_bot',
                 'url_success': 'https://t.me/your_bot',
                 'is_payment_multiple': False,
@@ -204,16 +342,7 @@ class CryptomusPayment:
                 'to_currency': 'USDT'  # Default to USDT
             }
             
-            headers = {
-                'merchant': self.merchant_id,
-                'sign': self._generate_signature(data),
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = await self._post('/payment', data)
             if result.get('state') == 0:  # Success
                 payment_data = result.get('result', {})
                 return {
@@ -224,33 +353,23 @@ class CryptomusPayment:
                 }
             else:
                 raise PaymentError(f"Cryptomus error: {result.get('message')}")
-                
-        except requests.RequestException as e:
-            logger.error(f"Cryptomus API error: {e}")
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Cryptomus API error: {e!r}")
             raise PaymentError("Ошибка подключения к Cryptomus")
         except Exception as e:
             logger.error(f"Cryptomus payment creation error: {e}")
             raise PaymentError("Ошибка создания криптоплатежа")
     
-    def check_payment(self, payment_id: str) -> str:
+    async def check_payment(self, payment_id: str) -> str:
         """Check cryptocurrency payment status"""
         try:
-            url = f"{self.base_url}/payment/info"
             data = {
                 'merchant': self.merchant_id,
                 'uuid': payment_id
             }
             
-            headers = {
-                'merchant': self.merchant_id,
-                'sign': self._generate_signature(data),
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.post(url, json=data, headers=headers, timeout=10)
-            response.raise_for_status()
-            
-            result = response.json()
+            result = await self._post('/payment/info', data)
             if result.get('state') == 0:
                 payment_data = result.get('result', {})
                 status = payment_data.get('payment_status')
@@ -263,50 +382,68 @@ class CryptomusPayment:
                     return 'pending'
             
             return 'unknown'
-            
+        
         except Exception as e:
-            logger.error(f"Cryptomus payment check error: {e}")
+            logger.error(f"Cryptomus payment check error: {e!r}")
             return 'unknown'
+    
+    def parse_notification(self, payload: Dict[str, Any], headers: Dict[str, str]) -> Notification:
+        """Verify Cryptomus webhook signature"""
+        data = dict(payload)
+        signature = str(data.pop('sign', ''))
+        
+        if not hmac.compare_digest(self._generate_signature(data), signature):
+            raise PaymentError("Неверная подпись уведомления Cryptomus")
+        
+        # Invoice amount and currency; paid_over means the payer sent at least that much
+        paid = (to_kopecks(data.get('amount')), data.get('currency'))
+        status = data.get('status') or data.get('payment_status')
+        if status in ['paid', 'paid_over']:
+            return Notification(data.get('order_id', ''), 'completed', *paid)
+        elif status in ['fail', 'cancel', 'system_fail', 'wrong_amount']:
+            return Notification(data.get('order_id', ''), 'failed', *paid)
+        return Notification(data.get('order_id', ''), 'pending', *paid)
 
 
 class PaymentManager:
     """Main payment manager class"""
     
-    def __init__(self):
-        self.yoomoney = YooMoneyPayment() if Config.YOOMONEY_TOKEN else None
-        self.qiwi = QiwiPayment() if Config.QIWI_TOKEN else None
-        self.cryptomus = CryptomusPayment() if Config.CRYPTOMUS_API_KEY else None
+    def __init__(self, provider_options: Optional[Dict[str, Dict[str, Any]]] = None):
+        provider_options = provider_options or {}
+        self.yoomoney = YooMoneyPayment(**provider_options.get('yoomoney', {})) if Config.YOOMONEY_TOKEN else None
+        self.qiwi = QiwiPayment(**provider_options.get('qiwi', {})) if Config.QIWI_TOKEN else None
+        self.cryptomus = CryptomusPayment(**provider_options.get('crypto', {})) if Config.CRYPTOMUS_API_KEY else None
     
-    def create_payment(self, method: str, amount: int, order_id: str, description: str) -> Dict[str, Any]:
+    def get_provider(self, method: str) -> Optional[PaymentProvider]:
+        """Get payment processor for method"""
+        return {
+            'yoomoney': self.yoomoney,
+            'qiwi': self.qiwi,
+            'crypto': self.cryptomus
+        }.get(method)
+    
+    async def create_payment(self, method: str, amount: int, order_id: str, description: str) -> Dict[str, Any]:
         """Create payment with specified method"""
         try:
-            if method == 'yoomoney' and self.yoomoney:
-                return self.yoomoney.create_payment(amount, order_id, description)
-            elif method == 'qiwi' and self.qiwi:
-                return self.qiwi.create_payment(amount, order_id, description)
-            elif method == 'crypto' and self.cryptomus:
-                return self.cryptomus.create_payment(amount, order_id, description)
-            else:
+            provider = self.get_provider(method)
+            if provider is None:
                 raise PaymentError(f"Платежный метод {method} недоступен")
-                
+            return await provider.create_payment(amount, order_id, description)
+        
         except PaymentError:
             raise
         except Exception as e:
             logger.error(f"Payment creation error: {e}")
             raise PaymentError("Ошибка создания платежа")
     
-    def check_payment(self, method: str, payment_id: str) -> str:
+    async def check_payment(self, method: str, payment_id: str) -> str:
         """Check payment status"""
         try:
-            if method == 'yoomoney' and self.yoomoney:
-                return self.yoomoney.check_payment(payment_id)
-            elif method == 'qiwi' and self.qiwi:
-                return self.qiwi.check_payment(payment_id)
-            elif method == 'crypto' and self.cryptomus:
-                return self.cryptomus.check_payment(payment_id)
-            else:
+            provider = self.get_provider(method)
+            if provider is None:
                 return 'unknown'
-                
+            return await provider.check_payment(payment_id)
+        
         except Exception as e:
             logger.error(f"Payment check error: {e}")
             return 'unknown'
@@ -321,7 +458,13 @@ class PaymentManager:
         if self.cryptomus:
             methods.append('crypto')
         return methods
+    
+    async def close(self):
+        """Close HTTP sessions of all providers"""
+        for provider in (self.yoomoney, self.qiwi, self.cryptomus):
+            if provider is not None:
+                await provider.close()
 
 
 # Global payment manager instance
-payment_manager = PaymentManager()
\ No newline at end of file
+payment_manager = PaymentManager()
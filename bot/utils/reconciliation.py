@@ -0,0 +1,176 @@
+"""Background payment reconciliation for VPN Bot"""
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import select, update
+
+from bot.config.settings import Config
+from bot.models.database import get_db_manager, Payment
+from bot.utils.payments import PaymentManager, payment_manager
+from bot.utils.billing import complete_payments, set_pending_status, deliver_completed_payment
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentReconciler:
+    """Periodically checks pending payments with providers in batches"""
+    
+    def __init__(self, payment_manager: PaymentManager, batch_size: Optional[int] = None,
+                 concurrency: Optional[int] = None, grace_seconds: Optional[int] = None):
+        self.payment_manager = payment_manager
+        self.batch_size = batch_size or Config.PAYMENT_RECONCILE_BATCH_SIZE
+        self.concurrency = concurrency or Config.PAYMENT_RECONCILE_CONCURRENCY
+        self.grace = timedelta(seconds=grace_seconds if grace_seconds is not None else Config.PAYMENT_RECONCILE_GRACE)
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._lock = asyncio.Lock()
+        self.stats: Dict[str, Any] = {
+            'runs': 0,
+            'last_run_at': None,
+            'last_duration_ms': 0.0,
+            'checked': 0,
+            'completed': 0,
+            'failed': 0,
+            'expired': 0,
+            'lag_seconds': 0.0,
+            'oldest_pending_seconds': 0.0
+        }
+    
+    def _semaphore(self, method: str) -> asyncio.Semaphore:
+        """Get per-provider concurrency limiter"""
+        if method not in self._semaphores:
+            self._semaphores[method] = asyncio.Semaphore(self.concurrency)
+        return self._semaphores[method]
+    
+    async def _check(self, payment: Dict[str, Any]) -> str:
+        async with self._semaphore(payment['payment_method']):
+            return await self.payment_manager.check_payment(payment['payment_method'], payment['payment_id'])
+    
+    async def _load_batch(self, after_id: int, now: datetime) -> List[Dict[str, Any]]:
+        """Load next batch of pending payments registered with a provider"""
+        async with get_db_manager().get_async_session() as session:
+            rows = (await session.execute(
+                select(
+                    Payment.id,
+                    Payment.payment_method,
+                    Payment.payment_id,
+                    Payment.created_at,
+                    Payment.expires_at
+                ).where(
+                    Payment.status == 'pending',
+                    Payment.id > after_id,
+                    Payment.payment_id.isnot(None)
+                ).order_by(Payment.id).limit(self.batch_size)
+            )).mappings().all()
+            return [dict(row) for row in rows]
+    
+    async def _expire_stale(self, now: datetime) -> int:
+        """Expire payments never registered with a provider past the grace period in one UPDATE"""
+        async with get_db_manager().get_async_session() as session:
+            result = await session.execute(
+                update(Payment)
+                .where(Payment.status == 'pending', Payment.payment_id.is_(None),
+                       Payment.expires_at < now - self.grace)
+                .values(status='expired')
+            )
+            await session.commit()
+            return result.rowcount
+    
+    def _expired(self, expires_at: Optional[datetime], status: str, now: datetime) -> bool:
+        """
+        Whether a checked payment past expires_at should be expired.
+        
+        Only a definite "not paid" expires it; 'unknown' (timeout, provider
+        error) is checked again on the next pass. Past the grace period this
+        was the last check, e.g. after downtime, and the payment is expired
+        anyway; a later confirmation still completes it.
+        """
+        if not expires_at or expires_at >= now:
+            return False
+        return status == 'pending' or expires_at < now - self.grace
+    
+    async def run(self, bot=None) -> Dict[str, Any]:
+        """Run one reconciliation pass"""
+        if self._lock.locked():
+            return self.stats  # Previous pass is still running
+        
+        async with self._lock:
+            started = time.monotonic()
+            now = datetime.utcnow()
+            totals = {'checked': 0, 'completed': 0, 'failed': 0, 'expired': 0}
+            oldest_pending = None
+            after_id = 0
+            
+            totals['expired'] += await self._expire_stale(now)
+            
+            while True:
+                batch = await self._load_batch(after_id, now)
+                if not batch:
+                    break
+                after_id = batch[-1]['id']
+                
+                # Group by provider and check concurrently within per-provider limits
+                by_method = defaultdict(list)
+                for payment in batch:
+                    by_method[payment['payment_method']].append(payment)
+                
+                checks = [payment for payments in by_method.values() for payment in payments]
+                statuses = await asyncio.gather(*[self._check(payment) for payment in checks])
+                
+                completed_ids, failed_ids, expired_ids = [], [], []
+                for payment, status in zip(checks, statuses):
+                    if status == 'completed':
+                        completed_ids.append(payment['id'])
+                    elif status == 'failed':
+                        failed_ids.append(payment['id'])
+                    elif self._expired(payment['expires_at'], status, now):
+                        expired_ids.append(payment['id'])
+                    elif payment['created_at'] and (oldest_pending is None or payment['created_at'] < oldest_pending):
+                        oldest_pending = payment['created_at']
+                
+                completions = await complete_payments(completed_ids)
+                totals['checked'] += len(checks)
+                totals['completed'] += len(completions)
+                totals['failed'] += await set_pending_status(failed_ids, 'failed')
+                totals['expired'] += await set_pending_status(expired_ids, 'expired')
+                
+                if bot is not None:
+                    for completion in completions:
+                        await deliver_completed_payment(bot, completion)
+                
+                if len(batch) < self.batch_size:
+                    break
+            
+            finished = datetime.utcnow()
+            previous_run = self.stats['last_run_at']
+            self.stats.update({
+                'runs': self.stats['runs'] + 1,
+                'last_run_at': finished,
+                'last_duration_ms': (time.monotonic() - started) * 1000,
+                # Upper bound on how stale a pending payment status can be
+                'lag_seconds': (finished - previous_run).total_seconds() if previous_run else 0.0,
+                'oldest_pending_seconds': (finished - oldest_pending).total_seconds() if oldest_pending else 0.0,
+                **totals
+            })
+            
+            if totals['completed'] or totals['failed'] or totals['expired']:
+                logger.info(f"Payment reconciliation: checked={totals['checked']} completed={totals['completed']} "
+                            f"failed={totals['failed']} expired={totals['expired']} "
+                            f"in {self.stats['last_duration_ms']:.0f} ms")
+            return self.stats
+
+
+# Global payment reconciler instance
+payment_reconciler = PaymentReconciler(payment_manager)
+
+
+async def reconcile_payments_job(context) -> None:
+    """Job queue callback running payment reconciliation"""
+    try:
+        await payment_reconciler.run(context.bot)
+    except Exception as e:
+        logger.error(f"Payment reconciliation failed: {e}")
@@ -0,0 +1,159 @@
+"""Daily statistics rollups for VPN Bot"""
+
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select, func
+
+from bot.models.database import get_db_manager, DatabaseManager, User, Subscription, Payment, BotStats
+from bot.utils.stats import stats_engine
+
+logger = logging.getLogger(__name__)
+
+
+def day_start(moment: datetime) -> datetime:
+    """Get midnight of the day containing moment"""
+    return datetime.combine(moment.date(), datetime.min.time())
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {'payments': 0, 'revenue': 0.0, 'by_plan': {}, 'by_method': {}}
+
+
+def _add_breakdown(breakdown: Dict[str, Dict[str, Any]], key: str, payments: int, revenue: float):
+    entry = breakdown.setdefault(key or 'unknown', {'payments': 0, 'revenue': 0.0})
+    entry['payments'] += payments
+    entry['revenue'] += revenue
+
+
+async def aggregate_payments(session, start: datetime, end: Optional[datetime] = None) -> Dict[str, Any]:
+    """Count and sum completed payments in [start, end) grouped by plan and method"""
+    rows = await stats_engine.payment_stats(
+        start, end, group_by=('plan_type', 'payment_method'), session=session
+    )
+    
+    totals = _empty_totals()
+    for row in rows:
+        totals['payments'] += row['payments']
+        totals['revenue'] += row['revenue']
+        _add_breakdown(totals['by_plan'], row['plan_type'], row['payments'], row['revenue'])
+        _add_breakdown(totals['by_method'], row['payment_method'], row['payments'], row['revenue'])
+    return totals
+
+
+class StatsRollup:
+    """Writes one BotStats row per finished day and answers period stats from them"""
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None):
+        self.db_manager = db_manager
+    
+    def _session(self):
+        return (self.db_manager or get_db_manager()).get_async_session()
+    
+    async def rollup_day(self, session, day: datetime) -> BotStats:
+        """Compute and store rollup row for one day"""
+        end = day + timedelta(days=1)
+        payments = await aggregate_payments(session, day, end)
+        
+        new_users = await session.scalar(
+            select(func.count(User.id)).where(User.created_at >= day, User.created_at < end)
+        )
+        total_users = await session.scalar(select(func.count(User.id)).where(User.created_at < end))
+        active_subscriptions = await session.scalar(
+            select(func.count(Subscription.id)).where(
+                Subscription.is_active == True,
+                Subscription.start_date < end,
+                Subscription.end_date > end
+            )
+        )
+        
+        row = await session.scalar(select(BotStats).where(BotStats.date == day))
+        if row is None:
+            row = BotStats(date=day)
+            session.add(row)
+        row.total_users = total_users
+        row.new_users = new_users
+        row.active_subscriptions = active_subscriptions
+        row.new_payments = payments['payments']
+        row.daily_revenue = payments['revenue']
+        row.by_plan = payments['by_plan']
+        row.by_method = payments['by_method']
+        return row
+    
+    async def run(self, now: Optional[datetime] = None) -> int:
+        """Roll up every finished day not rolled up yet, returns number of days written"""
+        today = day_start(now or datetime.utcnow())
+        
+        async with self._session() as session:
+            last_day = await session.scalar(select(func.max(BotStats.date)))
+            if last_day is not None:
+                day = day_start(last_day) + timedelta(days=1)
+            else:
+                # First run: start from the earliest recorded activity
+                first_user = await session.scalar(select(func.min(User.created_at)))
+                first_payment = await session.scalar(select(func.min(Payment.completed_at)))
+                known = [moment for moment in (first_user, first_payment) if moment]
+                if not known:
+                    return 0
+                day = day_start(min(known))
+            
+            written = 0
+            while day < today:
+                await self.rollup_day(session, day)
+                written += 1
+                day += timedelta(days=1)
+            
+            await session.commit()
+        
+        if written:
+            logger.info(f"Stats rollup: {written} day(s) written")
+        return written
+    
+    async def period_stats(self, start: datetime) -> Dict[str, Any]:
+        """
+        Get payment totals since start.
+        
+        Finished days come from BotStats rows; only the part not rolled up
+        yet (normally just today) is aggregated from payments.
+        """
+        start_day = day_start(start)
+        
+        async with self._session() as session:
+            rows = (await session.execute(
+                select(BotStats).where(BotStats.date >= start_day).order_by(BotStats.date)
+            )).scalars().all()
+            
+            totals = _empty_totals()
+            live_start = start
+            for row in rows:
+                totals['payments'] += row.new_payments or 0
+                totals['revenue'] += row.daily_revenue or 0.0
+                for key, entry in (row.by_plan or {}).items():
+                    _add_breakdown(totals['by_plan'], key, entry['payments'], entry['revenue'])
+                for key, entry in (row.by_method or {}).items():
+                    _add_breakdown(totals['by_method'], key, entry['payments'], entry['revenue'])
+                live_start = max(live_start, row.date + timedelta(days=1))
+            
+            live = await aggregate_payments(session, live_start)
+        
+        totals['payments'] += live['payments']
+        totals['revenue'] += live['revenue']
+        for key, entry in live['by_plan'].items():
+            _add_breakdown(totals['by_plan'], key, entry['payments'], entry['revenue'])
+        for key, entry in live['by_method'].items():
+            _add_breakdown(totals['by_method'], key, entry['payments'], entry['revenue'])
+        totals['rolled_up_days'] = len(rows)
+        return totals
+
+
+# Global stats rollup instance
+stats_rollup = StatsRollup()
+
+
+async def rollup_stats_job(context) -> None:
+    """Job queue callback writing daily stats rollups"""
+    try:
+        await stats_rollup.run()
+    except Exception as e:
+        logger.error(f"Stats rollup failed: {e}")
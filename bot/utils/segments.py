@@ -0,0 +1,105 @@
+"""Broadcast audience segments for VPN Bot"""
+
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple
+
+from sqlalchemy import select, func
+
+from bot.config.settings import SUBSCRIPTION_PLANS
+from bot.models.database import User, Subscription
+
+# Segment key -> button title; parametrized segments take days / plan type
+SEGMENTS = {
+    'all': "👥 Все пользователи",
+    'active': "✅ Активные подписчики",
+    'expired': "⌛ Подписка истекла",
+    'inactive': "💤 Неактивные",
+    'plan': "📦 Тариф",
+    'referrers': "🎁 Есть рефералы",
+}
+
+# Choices offered in the admin keyboard for 'inactive'
+INACTIVE_DAYS = (7, 30, 90)
+
+
+def parse_segment(value: str) -> Tuple[str, Optional[str]]:
+    """Split 'inactive:30' into segment and parameter, validating both"""
+    segment, _, param = value.partition(':')
+    param = param or None
+    
+    if segment not in SEGMENTS:
+        raise ValueError(f"Unknown segment: {segment}")
+    if segment == 'inactive' and not (param and param.isdigit() and int(param) > 0):
+        raise ValueError(f"Segment 'inactive' needs a number of days, got {param!r}")
+    if segment == 'plan' and param not in SUBSCRIPTION_PLANS:
+        raise ValueError(f"Segment 'plan' needs a plan type, got {param!r}")
+    if segment not in ('inactive', 'plan') and param is not None:
+        raise ValueError(f"Segment '{segment}' takes no parameter")
+    return segment, param
+
+
+def describe_segment(segment: str, param: Optional[str] = None) -> str:
+    """Human-readable segment name"""
+    if segment == 'inactive':
+        return f"{SEGMENTS[segment]} {param} дн."
+    if segment == 'plan':
+        return f"{SEGMENTS[segment]} «{SUBSCRIPTION_PLANS[param]['name']}»"
+    return SEGMENTS[segment]
+
+
+def segment_criteria(segment: str, param: Optional[str] = None, now: Optional[datetime] = None,
+                     reachable_only: bool = True) -> List:
+    """
+    WHERE clauses on users selecting the segment.
+    
+    Every segment is answered from one index: users.subscription_end for
+    subscribers, users.last_activity for inactivity and users.referrer_id
+    for referrers; plan type is read through the current subscription row.
+    Users deactivated after blocking the bot are left out unless
+    reachable_only is False.
+    """
+    now = now or datetime.utcnow()
+    criteria = [User.is_active == True] if reachable_only else []
+    
+    if segment == 'all':
+        return criteria
+    if segment == 'active':
+        return criteria + [User.subscription_end > now]
+    if segment == 'expired':
+        return criteria + [User.subscription_end <= now]
+    if segment == 'inactive':
+        return criteria + [User.last_activity < now - timedelta(days=int(param))]
+    if segment == 'plan':
+        return criteria + [
+            User.subscription_end > now,
+            select(Subscription.id).where(
+                Subscription.id == User.current_subscription_id,
+                Subscription.plan_type == param
+            ).exists()
+        ]
+    if segment == 'referrers':
+        return criteria + [User.id.in_(select(User.referrer_id).where(User.referrer_id.isnot(None)))]
+    raise ValueError(f"Unknown segment: {segment}")
+
+
+def recipients_query(segment: str, param: Optional[str] = None, now: Optional[datetime] = None):
+    """SELECT of (users.id, telegram_id) for every user in the segment"""
+    return select(User.id, User.telegram_id).where(*segment_criteria(segment, param, now))
+
+
+async def count_segment(session, segment: str, param: Optional[str] = None) -> int:
+    """Number of reachable users in the segment"""
+    return await session.scalar(
+        select(func.count(User.id)).where(*segment_criteria(segment, param))
+    ) or 0
+
+
+async def count_unreachable(session, segment: str, param: Optional[str] = None,
+                            now: Optional[datetime] = None) -> int:
+    """Number of deactivated users the segment leaves out"""
+    return await session.scalar(
+        select(func.count(User.id)).where(
+            User.is_active == False,
+            *segment_criteria(segment, param, now, reachable_only=False)
+        )
+    ) or 0
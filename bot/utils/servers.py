@@ -0,0 +1,220 @@
+"""VPN server registry and placement for VPN Bot"""
+
+import heapq
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple, Iterable
+
+from sqlalchemy import select, update
+
+from bot.models.database import get_db_manager, DatabaseManager, Server, Subscription
+
+logger = logging.getLogger(__name__)
+
+# Placements retried after the picked server turned out full or disabled
+MAX_ATTEMPTS = 5
+
+# Server columns mirrored in the cache
+COLUMNS = (Server.location, Server.endpoint, Server.public_key, Server.flag,
+           Server.capacity, Server.active_peers, Server.is_enabled)
+
+
+class ServerRegistry:
+    """
+    In-memory copy of the servers table with least-loaded placement.
+    
+    Servers with spare capacity sit in a min-heap keyed by load
+    (active_peers / capacity). Every counter change pushes a fresh entry
+    and outdated ones are dropped when they reach the top, so picking and
+    updating a server are O(log n) without recounting subscriptions.
+    Counters are changed by atomic UPDATEs in the caller's transaction;
+    the database stays authoritative and the cache is reloaded
+    periodically to follow other processes and rolled back transactions.
+    """
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None, batch_size: int = 500):
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.loaded = False
+        self._servers: Dict[str, Dict[str, Any]] = {}
+        self._versions: Dict[str, int] = {}
+        self._heap: List[Tuple[float, str, int]] = []
+        self.stats: Dict[str, Any] = {
+            'placed': 0,
+            'released': 0,
+            'full': 0,
+            'reloads': 0
+        }
+    
+    def _db(self) -> DatabaseManager:
+        return self.db_manager or get_db_manager()
+    
+    def get(self, location: str) -> Optional[Dict[str, Any]]:
+        """Cached server of location"""
+        return self._servers.get(location)
+    
+    def servers(self) -> List[Dict[str, Any]]:
+        """Cached servers, least loaded first"""
+        return sorted(self._servers.values(), key=lambda server: (self._load(server), server['location']))
+    
+    @staticmethod
+    def _load(server: Dict[str, Any]) -> float:
+        return server['active_peers'] / server['capacity'] if server['capacity'] > 0 else float('inf')
+    
+    def _set(self, location: str, server: Optional[Dict[str, Any]]):
+        """Replace cached server, pushing a heap entry while it takes peers"""
+        version = self._versions.get(location, 0) + 1
+        self._versions[location] = version
+        if server is None:
+            self._servers.pop(location, None)
+            return
+        
+        self._servers[location] = server
+        if server['is_enabled'] and server['active_peers'] < server['capacity']:
+            heapq.heappush(self._heap, (self._load(server), location, version))
+        # Outdated entries are dropped lazily; rebuild once they dominate the heap
+        if len(self._heap) > 2 * len(self._servers) + 16:
+            self._rebuild()
+    
+    def _rebuild(self):
+        self._heap = [
+            (self._load(server), location, self._versions[location])
+            for location, server in self._servers.items()
+            if server['is_enabled'] and server['active_peers'] < server['capacity']
+        ]
+        heapq.heapify(self._heap)
+    
+    def _peek(self) -> Optional[str]:
+        """Least loaded server with spare capacity"""
+        while self._heap:
+            _, location, version = self._heap[0]
+            if self._versions.get(location) == version:
+                return location
+            heapq.heappop(self._heap)
+        return None
+    
+    def _row(self, row) -> Dict[str, Any]:
+        return {
+            'location': row.location,
+            'endpoint': row.endpoint,
+            'public_key': row.public_key,
+            'flag': row.flag,
+            'capacity': row.capacity,
+            'active_peers': row.active_peers,
+            'is_enabled': row.is_enabled
+        }
+    
+    async def load(self, session=None):
+        """Reload every server from the database"""
+        if session is None:
+            async with self._db().get_async_session() as session:
+                rows = (await session.execute(select(*COLUMNS))).all()
+        else:
+            rows = (await session.execute(select(*COLUMNS))).all()
+        
+        for location in set(self._servers) - {row.location for row in rows}:
+            self._set(location, None)
+        for row in rows:
+            self._set(row.location, self._row(row))
+        self._rebuild()
+        self.loaded = True
+        self.stats['reloads'] += 1
+    
+    async def place(self, session) -> Optional[str]:
+        """
+        Take a peer slot on the least loaded server within session's transaction.
+        
+        Returns the server location, None when no server has spare capacity.
+        """
+        if not self.loaded:
+            await self.load(session)
+        
+        for _ in range(MAX_ATTEMPTS):
+            location = self._peek()
+            if location is None:
+                break
+            
+            row = (await session.execute(
+                update(Server)
+                .where(Server.location == location, Server.is_enabled == True,
+                       Server.active_peers < Server.capacity)
+                .values(active_peers=Server.active_peers + 1)
+                .returning(Server.active_peers, Server.capacity)
+                .execution_options(synchronize_session=False)
+            )).one_or_none()
+            if row is not None:
+                self._set(location, {**self._servers[location], 'active_peers': row.active_peers,
+                                     'capacity': row.capacity})
+                self.stats['placed'] += 1
+                return location
+            
+            # Filled, disabled or removed by someone else meanwhile
+            row = (await session.execute(select(*COLUMNS).where(Server.location == location))).one_or_none()
+            self._set(location, self._row(row) if row else None)
+        
+        self.stats['full'] += 1
+        return None
+    
+    async def release(self, session, locations: Iterable[str]) -> int:
+        """Free one peer slot per location entry within session's transaction"""
+        released = 0
+        for location, count in Counter(locations).items():
+            row = (await session.execute(
+                update(Server)
+                .where(Server.location == location)
+                .values(active_peers=Server.active_peers - count)
+                .returning(Server.active_peers, Server.capacity, Server.is_enabled)
+                .execution_options(synchronize_session=False)
+            )).one_or_none()
+            if row is None:
+                continue
+            if location in self._servers:
+                self._set(location, {**self._servers[location], 'active_peers': row.active_peers,
+                                     'capacity': row.capacity, 'is_enabled': row.is_enabled})
+            released += count
+        
+        self.stats['released'] += released
+        return released
+    
+    async def release_expired(self, now: Optional[datetime] = None) -> int:
+        """Free peer slots of expired subscriptions, in batches"""
+        now = now or datetime.utcnow()
+        released = 0
+        while True:
+            async with self._db().get_async_session() as session:
+                rows = (await session.execute(
+                    select(Subscription.id, Subscription.server_location)
+                    .where(Subscription.server_slot == True, Subscription.end_date <= now)
+                    .limit(self.batch_size)
+                )).all()
+                if not rows:
+                    break
+                
+                released += await self.release(session, [row.server_location for row in rows])
+                await session.execute(
+                    update(Subscription)
+                    .where(Subscription.id.in_([row.id for row in rows]))
+                    .values(server_slot=False)
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+            if len(rows) < self.batch_size:
+                break
+        
+        if released:
+            logger.info(f"Released {released} server peer slots of expired subscriptions")
+        return released
+
+
+# Global server registry instance
+server_registry = ServerRegistry()
+
+
+async def refresh_servers_job(context) -> None:
+    """Job queue callback freeing expired peer slots and reloading the registry"""
+    try:
+        await server_registry.release_expired()
+        await server_registry.load()
+    except Exception as e:
+        logger.error(f"Failed to refresh server registry: {e}")
@@ -0,0 +1,188 @@
+"""SQL-side statistics engine for VPN Bot"""
+
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Sequence
+
+from sqlalchemy import select, func, literal_column
+
+from bot.models.database import get_db_manager, DatabaseManager, User, Subscription, Payment
+
+BUCKETS = ('hour', 'day', 'week')
+
+# Columns payment stats can be grouped by
+PAYMENT_GROUPS = {
+    'plan_type': Payment.plan_type,
+    'payment_method': Payment.payment_method,
+    'currency': Payment.currency,
+}
+
+
+def bucket_expression(column, bucket: str, dialect: str):
+    """SQL expression truncating a timestamp column to the start of its bucket"""
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket: {bucket}")
+    
+    if dialect == 'postgresql':
+        return func.date_trunc(bucket, column)
+    
+    # SQLite: text timestamps, weeks start on Monday like date_trunc
+    if bucket == 'hour':
+        return func.strftime('%Y-%m-%d %H:00:00', column)
+    if bucket == 'day':
+        return func.strftime('%Y-%m-%d 00:00:00', column)
+    return func.strftime('%Y-%m-%d 00:00:00', column, 'weekday 0', '-6 days')
+
+
+def bucket_start(moment: datetime, bucket: str) -> datetime:
+    """Python counterpart of bucket_expression"""
+    if bucket == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = datetime.combine(moment.date(), datetime.min.time())
+    if bucket == 'day':
+        return day
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    raise ValueError(f"Unknown bucket: {bucket}")
+
+
+def _as_datetime(value) -> datetime:
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def payment_stats_query(start: datetime, end: Optional[datetime] = None,
+                        group_by: Sequence[str] = (), bucket: Optional[str] = None,
+                        dialect: str = 'sqlite'):
+    """
+    Single SELECT counting and summing completed payments in [start, end).
+    
+    Rows carry one column per group_by key, an optional 'bucket' column and
+    the 'payments' / 'amount' aggregates (amount in kopecks).
+    """
+    columns = []
+    for key in group_by:
+        if key not in PAYMENT_GROUPS:
+            raise ValueError(f"Unknown payment group: {key}")
+        columns.append(PAYMENT_GROUPS[key].label(key))
+    if bucket:
+        columns.append(bucket_expression(Payment.completed_at, bucket, dialect).label('bucket'))
+    
+    criteria = [Payment.status == 'completed', Payment.completed_at >= start]
+    if end is not None:
+        criteria.append(Payment.completed_at < end)
+    
+    statement = select(
+        *columns,
+        func.count(Payment.id).label('payments'),
+        func.coalesce(func.sum(Payment.amount), 0).label('amount')
+    ).where(*criteria)
+    
+    if columns:
+        keys = [literal_column(column.name) for column in columns]
+        statement = statement.group_by(*keys).order_by(*keys)
+    return statement
+
+
+class StatsEngine:
+    """Runs aggregate reports in the database over arbitrary windows and buckets"""
+    
+    def __init__(self, db_manager: Optional[DatabaseManager] = None):
+        self.db_manager = db_manager
+    
+    def _db(self) -> DatabaseManager:
+        return self.db_manager or get_db_manager()
+    
+    @property
+    def dialect(self) -> str:
+        return self._db().async_engine.dialect.name
+    
+    async def payment_stats(self, start: datetime, end: Optional[datetime] = None,
+                            group_by: Sequence[str] = (), bucket: Optional[str] = None,
+                            session=None) -> List[Dict[str, Any]]:
+        """Payment count and revenue in rubles per group / bucket"""
+        statement = payment_stats_query(start, end, group_by, bucket, self.dialect)
+        if session is not None:
+            rows = (await session.execute(statement)).mappings().all()
+        else:
+            async with self._db().get_async_session() as session:
+                rows = (await session.execute(statement)).mappings().all()
+        
+        result = []
+        for row in rows:
+            entry = dict(row)
+            entry['revenue'] = (entry.pop('amount') or 0) / 100  # Convert from kopecks
+            if bucket:
+                entry['bucket'] = _as_datetime(entry['bucket'])
+            result.append(entry)
+        return result
+    
+    async def new_users(self, start: datetime, end: Optional[datetime] = None,
+                        bucket: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Number of registered users per bucket"""
+        criteria = [User.created_at >= start]
+        if end is not None:
+            criteria.append(User.created_at < end)
+        
+        if bucket:
+            key = bucket_expression(User.created_at, bucket, self.dialect).label('bucket')
+            statement = (
+                select(key, func.count(User.id).label('users'))
+                .where(*criteria)
+                .group_by(literal_column('bucket'))
+                .order_by(literal_column('bucket'))
+            )
+        else:
+            statement = select(func.count(User.id).label('users')).where(*criteria)
+        
+        async with self._db().get_async_session() as session:
+            rows = (await session.execute(statement)).mappings().all()
+        
+        result = [dict(row) for row in rows]
+        if bucket:
+            for entry in result:
+                entry['bucket'] = _as_datetime(entry['bucket'])
+        return result
+    
+    async def summary(self, start: datetime, end: Optional[datetime] = None,
+                      now: Optional[datetime] = None) -> Dict[str, Any]:
+        """New users, payments, revenue and active subscriptions in one query"""
+        now = now or datetime.utcnow()
+        
+        payment_criteria = [Payment.status == 'completed', Payment.completed_at >= start]
+        user_criteria = [User.created_at >= start]
+        if end is not None:
+            payment_criteria.append(Payment.completed_at < end)
+            user_criteria.append(User.created_at < end)
+        
+        payments = select(
+            func.count(Payment.id).label('payments'),
+            func.coalesce(func.sum(Payment.amount), 0).label('amount')
+        ).where(*payment_criteria).subquery()
+        
+        new_users = select(func.count(User.id)).where(*user_criteria).scalar_subquery()
+        active_subscriptions = select(func.count(Subscription.id)).where(
+            Subscription.is_active == True,
+            Subscription.end_date > now
+        ).scalar_subquery()
+        
+        statement = select(
+            new_users.label('new_users'),
+            payments.c.payments,
+            payments.c.amount,
+            active_subscriptions.label('active_subscriptions')
+        )
+        
+        async with self._db().get_async_session() as session:
+            row = (await session.execute(statement)).mappings().one()
+        
+        return {
+            'new_users': row['new_users'] or 0,
+            'payments': row['payments'] or 0,
+            'revenue': (row['amount'] or 0) / 100,  # Convert from kopecks
+            'active_subscriptions': row['active_subscriptions'] or 0
+        }
+
+
+# Global stats engine instance
+stats_engine = StatsEngine()
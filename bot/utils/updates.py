@@ -0,0 +1,70 @@
+"""Concurrent update processing for VPN Bot"""
+
+import asyncio
+from typing import Any, Awaitable, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates concurrently while keeping updates of one chat in order.
+    
+    Updates from different chats run in parallel up to max_concurrent_updates.
+    Updates from the same chat wait for each other, so ConversationHandler
+    state transitions of a user are never interleaved.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: Dict[Tuple[Optional[int], Optional[int]], Tuple[asyncio.Lock, int]] = {}
+    
+    @staticmethod
+    def ordering_key(update: object) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """Get (chat_id, user_id) key for update, None for updates without chat/user"""
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+    
+    @property
+    def active_chats(self) -> int:
+        """Number of chats with updates being processed or waiting"""
+        return len(self._chat_locks)
+    
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Wait for earlier updates of the same chat, then for a free slot"""
+        key = self.ordering_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        # Chat lock is taken before the global semaphore so waiting updates
+        # of a busy chat do not hold slots needed by other chats
+        lock, users = self._chat_locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._chat_locks[key] = (lock, users + 1)
+        
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            lock, users = self._chat_locks[key]
+            if users == 1:
+                del self._chat_locks[key]
+            else:
+                self._chat_locks[key] = (lock, users - 1)
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,129 @@
+"""Payment provider webhook receiver for VPN Bot"""
+
+import asyncio
+import json
+import logging
+from typing import Optional, Dict, Any, Set
+
+from aiohttp import web
+
+from bot.config.settings import Config
+from bot.utils.payments import PaymentManager, PaymentError, Notification
+from bot.utils.billing import (
+    parse_order_id,
+    paid_in_full,
+    complete_payment,
+    fail_payment,
+    deliver_completed_payment
+)
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentWebhookServer:
+    """Embedded aiohttp server receiving Cryptomus/QIWI/YooMoney notifications"""
+    
+    def __init__(self, bot, payment_manager: PaymentManager, host: Optional[str] = None, port: Optional[int] = None):
+        self.bot = bot
+        self.payment_manager = payment_manager
+        self.host = host or Config.PAYMENT_WEBHOOK_HOST
+        self.port = port if port is not None else Config.PAYMENT_WEBHOOK_PORT
+        self.runner: Optional[web.AppRunner] = None
+        self._deliveries: Set[asyncio.Task] = set()
+    
+    def create_app(self) -> web.Application:
+        """Create webhook aiohttp application"""
+        app = web.Application()
+        app.router.add_post('/webhook/cryptomus', self.handle_cryptomus)
+        app.router.add_post('/webhook/qiwi', self.handle_qiwi)
+        app.router.add_post('/webhook/yoomoney', self.handle_yoomoney)
+        return app
+    
+    async def start(self):
+        """Start listening for notifications"""
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Payment webhook server listening on {self.host}:{self.port}")
+    
+    async def stop(self):
+        """Stop webhook server, letting started deliveries finish"""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        await self.wait()
+    
+    async def wait(self):
+        """Wait until configs being delivered are sent"""
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+    
+    async def handle_cryptomus(self, request: web.Request) -> web.Response:
+        """Handle Cryptomus payment notification"""
+        try:
+            payload = json.loads(await request.text())
+        except ValueError:
+            return web.Response(status=400, text='Bad request')
+        return await self._handle('crypto', payload, request.headers)
+    
+    async def handle_qiwi(self, request: web.Request) -> web.Response:
+        """Handle QIWI bill notification"""
+        try:
+            payload = json.loads(await request.text())
+        except ValueError:
+            return web.Response(status=400, text='Bad request')
+        response = await self._handle('qiwi', payload, request.headers)
+        if response.status == 200:
+            # QIWI expects JSON error code 0 as acknowledgement
+            return web.json_response({'error': '0'})
+        return response
+    
+    async def handle_yoomoney(self, request: web.Request) -> web.Response:
+        """Handle YooMoney HTTP notification"""
+        payload = dict(await request.post())
+        return await self._handle('yoomoney', payload, request.headers)
+    
+    async def _handle(self, method: str, payload: Dict[str, Any], headers) -> web.Response:
+        """Verify notification and apply payment status"""
+        provider = self.payment_manager.get_provider(method)
+        if provider is None:
+            return web.Response(status=404, text='Unknown provider')
+        
+        try:
+            notification = provider.parse_notification(payload, headers)
+        except PaymentError as e:
+            logger.warning(f"Rejected {method} notification: {e}")
+            return web.Response(status=403, text='Invalid signature')
+        
+        payment_id = parse_order_id(notification.order_id)
+        if payment_id is None:
+            logger.warning(f"Unknown order in {method} notification: {notification.order_id}")
+            return web.Response(status=200, text='OK')
+        
+        await self.process_status(payment_id, notification)
+        return web.Response(status=200, text='OK')
+    
+    async def process_status(self, payment_id: int, notification: Notification):
+        """Complete or fail payment and schedule notifying the user"""
+        if notification.status == 'completed':
+            # Anyone can send a YooMoney transfer labelled vpn_<id>, only the full price counts
+            if not await paid_in_full(payment_id, notification.amount, notification.currency):
+                return
+            completion = await complete_payment(payment_id)
+            if completion is None:
+                return  # Already processed
+            # Payment is committed; the provider is acknowledged without waiting for Telegram
+            task = asyncio.create_task(self.deliver(completion), name=f"deliver-payment-{payment_id}")
+            self._deliveries.add(task)
+            task.add_done_callback(self._delivery_done)
+        elif notification.status == 'failed':
+            await fail_payment(payment_id)
+    
+    def _delivery_done(self, task: asyncio.Task):
+        self._deliveries.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to deliver {task.get_name()}: {task.exception()}")
+    
+    async def deliver(self, completion: Dict[str, Any]):
+        """Push success message and VPN config to the user"""
+        await deliver_completed_payment(self.bot, completion)
@@ -206,15 +206,38 @@ MESSAGES = {
         "📢 Массовая рассылка\n\n"
         "👥 Всего пользователей: {total_users}\n"
         "✅ Активных: {active_users}\n\n"
-        "📝 Отправьте сообщение для рассылки:"
+        "🎯 Аудитория: {segment}\n"
+        "📨 Получателей: {recipients}\n\n"
+        "Выберите аудиторию кнопками ниже и отправьте сообщение для рассылки:"
     ),
     'broadcast_confirm': (
         "📢 Подтвердите рассылку\n\n"
+        "🎯 Аудитория: {segment}\n"
         "👥 Получателей: {recipients}\n"
         "📝 Сообщение:\n\n{message}\n\n"
-        "⚠️ Отправить всем пользователям?"
+        "⚠️ Отправить сообщение выбранной аудитории?"
     ),
     'broadcast_success': "✅ Рассылка завершена! Отправлено {sent} сообщений из {total}.",
+    'broadcast_started': (
+        "📢 Рассылка #{id} запущена\n\n"
+        "🎯 Аудитория: {segment}\n"
+        "👥 Получателей: {total}\n"
+        "💾 Пропущено недоступных: {skipped}\n"
+        "⏱ Примерное время: {eta}\n\n"
+        "Прогресс сохраняется, после перезапуска бота рассылка продолжится."
+    ),
+    'broadcast_progress': (
+        "📢 Рассылка #{id} в процессе...\n\n"
+        "👥 Всего получателей: {total}\n"
+        "✅ Отправлено: {sent}\n"
+        "❌ Ошибок: {failed}\n"
+        "📊 Прогресс: {percent:.1f}%"
+    ),
+    'broadcast_cancelled': "⏹ Рассылка остановлена. Отправлено {sent} сообщений из {total}.",
+    'broadcast_pruned': (
+        "\n🚫 Заблокировали бота или удалены: {unreachable} (исключены из следующих рассылок)"
+        "\n💾 Сэкономлено отправок: {skipped}"
+    ),
     
     # Errors and warnings
     'error_general': "❌ Что-то пошло не так. Попробуйте позже или обратитесь в поддержку.",
@@ -0,0 +1,114 @@
+"""Initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2024-06-01 00:00:00
+
+Tables as originally created by Base.metadata.create_all.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('telegram_id', sa.Integer(), nullable=False, unique=True),
+        sa.Column('username', sa.String(255)),
+        sa.Column('first_name', sa.String(255)),
+        sa.Column('last_name', sa.String(255)),
+        sa.Column('language_code', sa.String(10)),
+        sa.Column('is_active', sa.Boolean()),
+        sa.Column('is_admin', sa.Boolean()),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('updated_at', sa.DateTime()),
+        sa.Column('referrer_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('referral_code', sa.String(20), unique=True),
+        sa.Column('referral_balance', sa.Float()),
+        sa.Column('total_referrals', sa.Integer()),
+        sa.Column('total_spent', sa.Float()),
+        sa.Column('last_activity', sa.DateTime()),
+    )
+    op.create_table(
+        'subscriptions',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('plan_type', sa.String(50), nullable=False),
+        sa.Column('start_date', sa.DateTime()),
+        sa.Column('end_date', sa.DateTime(), nullable=False),
+        sa.Column('is_active', sa.Boolean()),
+        sa.Column('vpn_config', sa.Text()),
+        sa.Column('config_name', sa.String(255)),
+        sa.Column('server_location', sa.String(100)),
+        sa.Column('created_at', sa.DateTime()),
+    )
+    op.create_table(
+        'payments',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.Column('currency', sa.String(3)),
+        sa.Column('plan_type', sa.String(50), nullable=False),
+        sa.Column('payment_method', sa.String(50)),
+        sa.Column('payment_id', sa.String(255)),
+        sa.Column('payment_url', sa.String(500)),
+        sa.Column('status', sa.String(20)),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('completed_at', sa.DateTime()),
+        sa.Column('expires_at', sa.DateTime()),
+    )
+    op.create_table(
+        'vpn_keys',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('key_data', sa.Text(), nullable=False),
+        sa.Column('server_location', sa.String(100)),
+        sa.Column('is_used', sa.Boolean()),
+        sa.Column('assigned_user_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('used_at', sa.DateTime()),
+    )
+    op.create_table(
+        'referral_payouts',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('amount', sa.Float(), nullable=False),
+        sa.Column('status', sa.String(20)),
+        sa.Column('payment_method', sa.String(50)),
+        sa.Column('payment_details', sa.String(500)),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('completed_at', sa.DateTime()),
+    )
+    op.create_table(
+        'admin_logs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('admin_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('action', sa.String(255), nullable=False),
+        sa.Column('target_user_id', sa.Integer(), sa.ForeignKey('users.id')),
+        sa.Column('details', sa.Text()),
+        sa.Column('ip_address', sa.String(45)),
+        sa.Column('created_at', sa.DateTime()),
+    )
+    op.create_table(
+        'bot_stats',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('date', sa.DateTime()),
+        sa.Column('total_users', sa.Integer()),
+        sa.Column('active_subscriptions', sa.Integer()),
+        sa.Column('daily_revenue', sa.Float()),
+        sa.Column('new_users', sa.Integer()),
+        sa.Column('new_payments', sa.Integer()),
+    )
+
+
+def downgrade():
+    for table in ('bot_stats', 'admin_logs', 'referral_payouts', 'vpn_keys',
+                  'payments', 'subscriptions', 'users'):
+        op.drop_table(table)
@@ -0,0 +1,48 @@
+"""Indexes for hot query predicates
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-06-10 00:00:00
+
+Covers the filters used by handlers, dashboard, rollups and payment
+reconciliation; test_query_plans.py fails if a query falls back to a
+full table scan.
+"""
+
+import sqlalchemy as sa
+
+from bot.models.migrations import create_index_online, drop_index_online
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_online('ix_users_created_at', 'users', ['created_at'])
+    create_index_online('ix_users_last_activity', 'users', ['last_activity'])
+    create_index_online('ix_users_referrer_id', 'users', ['referrer_id'])
+    
+    create_index_online('ix_subscriptions_user_active_end', 'subscriptions', ['user_id', 'is_active', 'end_date'])
+    create_index_online('ix_subscriptions_active_end', 'subscriptions', ['end_date'],
+                        sqlite_where=sa.text('is_active = 1'), postgresql_where=sa.text('is_active = true'))
+    
+    create_index_online('ix_payments_status_completed_at', 'payments', ['status', 'completed_at'])
+    create_index_online('ix_payments_status_expires_at', 'payments', ['status', 'expires_at'])
+    create_index_online('ix_payments_created_at', 'payments', ['created_at'])
+    
+    create_index_online('ix_vpn_keys_is_used_location', 'vpn_keys', ['is_used', 'server_location'])
+
+
+def downgrade():
+    drop_index_online('ix_vpn_keys_is_used_location', 'vpn_keys')
+    drop_index_online('ix_payments_created_at', 'payments')
+    drop_index_online('ix_payments_status_expires_at', 'payments')
+    drop_index_online('ix_payments_status_completed_at', 'payments')
+    drop_index_online('ix_subscriptions_active_end', 'subscriptions')
+    drop_index_online('ix_subscriptions_user_active_end', 'subscriptions')
+    drop_index_online('ix_users_referrer_id', 'users')
+    drop_index_online('ix_users_last_activity', 'users')
+    drop_index_online('ix_users_created_at', 'users')
@@ -0,0 +1,106 @@
+"""Denormalized current subscription and daily stats rollups
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-06-20 00:00:00
+
+Adds users.current_subscription_id / subscription_end and fills them from
+the latest active subscription, plus the breakdown columns and unique day
+of bot_stats. Columns that already exist (databases created with
+create_all) are skipped.
+"""
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from bot.models.migrations import create_index_online, drop_index_online, has_column
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('current_subscription_id', sa.Integer),
+    sa.column('subscription_end', sa.DateTime),
+)
+subscriptions = sa.table(
+    'subscriptions',
+    sa.column('id', sa.Integer),
+    sa.column('user_id', sa.Integer),
+    sa.column('is_active', sa.Boolean),
+    sa.column('end_date', sa.DateTime),
+)
+bot_stats = sa.table(
+    'bot_stats',
+    sa.column('id', sa.Integer),
+    sa.column('date', sa.DateTime),
+)
+
+
+def add_missing_columns(table, columns):
+    missing = [column for column in columns if not has_column(table, column.name)]
+    if missing:
+        with op.batch_alter_table(table) as batch:
+            for column in missing:
+                batch.add_column(column)
+
+
+def upgrade():
+    add_missing_columns('users', [
+        sa.Column('current_subscription_id', sa.Integer()),
+        sa.Column('subscription_end', sa.DateTime()),
+    ])
+    add_missing_columns('bot_stats', [
+        sa.Column('by_plan', sa.JSON()),
+        sa.Column('by_method', sa.JSON()),
+        sa.Column('updated_at', sa.DateTime()),
+    ])
+    
+    # Point users to their latest active subscription
+    latest = (
+        sa.select(subscriptions.c.id)
+        .where(
+            subscriptions.c.user_id == users.c.id,
+            subscriptions.c.is_active == sa.true(),
+            subscriptions.c.end_date > datetime.utcnow()
+        )
+        .order_by(subscriptions.c.end_date.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    op.execute(
+        users.update()
+        .where(users.c.current_subscription_id.is_(None))
+        .values(current_subscription_id=latest)
+    )
+    op.execute(
+        users.update()
+        .where(users.c.current_subscription_id.isnot(None), users.c.subscription_end.is_(None))
+        .values(subscription_end=(
+            sa.select(subscriptions.c.end_date)
+            .where(subscriptions.c.id == users.c.current_subscription_id)
+            .scalar_subquery()
+        ))
+    )
+    
+    # One rollup row per day
+    duplicates = sa.select(sa.func.min(bot_stats.c.id)).group_by(bot_stats.c.date)
+    op.execute(bot_stats.delete().where(bot_stats.c.id.notin_(duplicates)))
+    create_index_online('uq_bot_stats_date', 'bot_stats', ['date'], unique=True)
+
+
+def downgrade():
+    drop_index_online('uq_bot_stats_date', 'bot_stats')
+    with op.batch_alter_table('bot_stats') as batch:
+        batch.drop_column('updated_at')
+        batch.drop_column('by_method')
+        batch.drop_column('by_plan')
+    with op.batch_alter_table('users') as batch:
+        batch.drop_column('subscription_end')
+        batch.drop_column('current_subscription_id')
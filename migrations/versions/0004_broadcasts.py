@@ -0,0 +1,42 @@
+"""Broadcast jobs
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2024-07-01 00:00:00
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'broadcasts',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('admin_id', sa.Integer(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('parse_mode', sa.String(10)),
+        sa.Column('status', sa.String(20)),
+        sa.Column('total', sa.Integer()),
+        sa.Column('sent', sa.Integer()),
+        sa.Column('failed', sa.Integer()),
+        sa.Column('last_user_id', sa.Integer()),
+        sa.Column('progress_chat_id', sa.Integer()),
+        sa.Column('progress_message_id', sa.Integer()),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('started_at', sa.DateTime()),
+        sa.Column('finished_at', sa.DateTime()),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+    op.create_index('ix_broadcasts_status', 'broadcasts', ['status'])
+
+
+def downgrade():
+    op.drop_index('ix_broadcasts_status', table_name='broadcasts')
+    op.drop_table('broadcasts')
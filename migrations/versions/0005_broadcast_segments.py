@@ -0,0 +1,73 @@
+"""Broadcast segments and materialized recipients
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2024-07-08 00:00:00
+
+Adds the audience segment to broadcasts, the broadcast_recipients table
+and the users.subscription_end index used by subscriber segments.
+Unfinished broadcasts get the users they have not reached yet as
+recipients, matching the old "everyone" behaviour.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from bot.models.migrations import create_index_online, drop_index_online
+
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+broadcasts = sa.table(
+    'broadcasts',
+    sa.column('id', sa.Integer),
+    sa.column('status', sa.String),
+    sa.column('segment', sa.String),
+    sa.column('last_user_id', sa.Integer),
+)
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('telegram_id', sa.Integer),
+)
+
+
+def upgrade():
+    op.add_column('broadcasts', sa.Column('segment', sa.String(20)))
+    op.add_column('broadcasts', sa.Column('segment_param', sa.String(50)))
+    op.execute(broadcasts.update().values(segment='all'))
+    
+    op.create_table(
+        'broadcast_recipients',
+        sa.Column('broadcast_id', sa.Integer(), sa.ForeignKey('broadcasts.id'), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('telegram_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('broadcast_id', 'user_id'),
+    )
+    
+    unfinished = (
+        sa.select(broadcasts.c.id, users.c.id, users.c.telegram_id)
+        .select_from(broadcasts.join(users, users.c.id > sa.func.coalesce(broadcasts.c.last_user_id, 0)))
+        .where(broadcasts.c.status.in_(('pending', 'running')))
+    )
+    op.execute(
+        sa.table(
+            'broadcast_recipients',
+            sa.column('broadcast_id'),
+            sa.column('user_id'),
+            sa.column('telegram_id'),
+        ).insert().from_select(['broadcast_id', 'user_id', 'telegram_id'], unfinished)
+    )
+    
+    create_index_online('ix_users_subscription_end', 'users', ['subscription_end'])
+
+
+def downgrade():
+    drop_index_online('ix_users_subscription_end', 'users')
+    op.drop_table('broadcast_recipients')
+    with op.batch_alter_table('broadcasts') as batch:
+        batch.drop_column('segment_param')
+        batch.drop_column('segment')
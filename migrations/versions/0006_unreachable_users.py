@@ -0,0 +1,34 @@
+"""Skip unreachable users in broadcasts
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2024-07-15 00:00:00
+
+Adds the unreachable / skipped counters of broadcasts and an index on
+users.is_active, which every broadcast segment now filters on.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from bot.models.migrations import create_index_online, drop_index_online
+
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('broadcasts', sa.Column('unreachable', sa.Integer()))
+    op.add_column('broadcasts', sa.Column('skipped', sa.Integer()))
+    
+    create_index_online('ix_users_is_active', 'users', ['is_active'])
+
+
+def downgrade():
+    drop_index_online('ix_users_is_active', 'users')
+    with op.batch_alter_table('broadcasts') as batch:
+        batch.drop_column('skipped')
+        batch.drop_column('unreachable')
@@ -0,0 +1,31 @@
+"""Telegram file_id of delivered config files
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2024-07-22 00:00:00
+
+Stores file_id of the config document and QR photo uploaded for a
+subscription, so repeat deliveries do not upload them again.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('subscriptions', sa.Column('config_file_id', sa.String(255)))
+    op.add_column('subscriptions', sa.Column('qr_file_id', sa.String(255)))
+    op.add_column('subscriptions', sa.Column('files_config_hash', sa.String(64)))
+
+
+def downgrade():
+    with op.batch_alter_table('subscriptions') as batch:
+        batch.drop_column('files_config_hash')
+        batch.drop_column('qr_file_id')
+        batch.drop_column('config_file_id')
@@ -0,0 +1,45 @@
+"""WireGuard client address pools
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2024-07-29 00:00:00
+
+Adds the ip_pools table holding the address bitmap of every server, the
+address assigned to a subscription and the partial index used to find
+expired subscriptions whose address can be released. Existing configs
+keep their old addresses; pools start empty.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from bot.models.migrations import create_index_online, drop_index_online
+
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'ip_pools',
+        sa.Column('server_location', sa.String(100), primary_key=True),
+        sa.Column('network', sa.String(43), nullable=False),
+        sa.Column('bitmap', sa.LargeBinary(), nullable=False),
+        sa.Column('allocated', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+    op.add_column('subscriptions', sa.Column('client_ip', sa.String(45)))
+    create_index_online('ix_subscriptions_client_ip_end', 'subscriptions', ['end_date'],
+                        sqlite_where=sa.text('client_ip IS NOT NULL'),
+                        postgresql_where=sa.text('client_ip IS NOT NULL'))
+
+
+def downgrade():
+    drop_index_online('ix_subscriptions_client_ip_end', 'subscriptions')
+    with op.batch_alter_table('subscriptions') as batch:
+        batch.drop_column('client_ip')
+    op.drop_table('ip_pools')
@@ -0,0 +1,90 @@
+"""Server registry with active peer counters
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2024-08-05 00:00:00
+
+Adds the servers table, seeded with the locations that were hardcoded in
+bot.utils.helpers, and subscriptions.server_slot marking subscriptions
+counted in servers.active_peers. Active subscriptions are counted once
+here; afterwards the counters are updated as subscriptions start and end.
+"""
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from bot.models.migrations import create_index_online, drop_index_online
+
+
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+# Peers a seeded server takes until an admin sets its real capacity
+DEFAULT_CAPACITY = 1000
+
+SEED_SERVERS = [
+    ('Netherlands', 'nl.vpnserver.com:51820', '🇳🇱'),
+    ('Germany', 'de.vpnserver.com:51820', '🇩🇪'),
+    ('France', 'fr.vpnserver.com:51820', '🇫🇷'),
+    ('United States', 'us.vpnserver.com:51820', '🇺🇸'),
+    ('Japan', 'jp.vpnserver.com:51820', '🇯🇵'),
+    ('Singapore', 'sg.vpnserver.com:51820', '🇸🇬'),
+]
+
+subscriptions = sa.table(
+    'subscriptions',
+    sa.column('server_location', sa.String),
+    sa.column('is_active', sa.Boolean),
+    sa.column('end_date', sa.DateTime),
+    sa.column('server_slot', sa.Boolean),
+)
+
+
+def upgrade():
+    servers = op.create_table(
+        'servers',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('location', sa.String(100), nullable=False, unique=True),
+        sa.Column('endpoint', sa.String(255), nullable=False),
+        sa.Column('public_key', sa.String(44)),
+        sa.Column('flag', sa.String(16)),
+        sa.Column('capacity', sa.Integer(), nullable=False),
+        sa.Column('active_peers', sa.Integer(), nullable=False),
+        sa.Column('is_enabled', sa.Boolean(), nullable=False),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(servers, [
+        {'location': location, 'endpoint': endpoint, 'flag': flag, 'capacity': DEFAULT_CAPACITY,
+         'active_peers': 0, 'is_enabled': True, 'created_at': now, 'updated_at': now}
+        for location, endpoint, flag in SEED_SERVERS
+    ])
+    
+    op.add_column('subscriptions', sa.Column('server_slot', sa.Boolean()))
+    op.execute(
+        subscriptions.update()
+        .where(subscriptions.c.is_active == True, subscriptions.c.end_date > now,
+               subscriptions.c.server_location.in_([location for location, _, _ in SEED_SERVERS]))
+        .values(server_slot=True)
+    )
+    op.execute(
+        servers.update().values(active_peers=(
+            sa.select(sa.func.count())
+            .where(subscriptions.c.server_slot == True, subscriptions.c.server_location == servers.c.location)
+            .scalar_subquery()
+        ))
+    )
+    create_index_online('ix_subscriptions_server_slot_end', 'subscriptions', ['end_date'],
+                        sqlite_where=sa.text('server_slot = 1'), postgresql_where=sa.text('server_slot = true'))
+
+
+def downgrade():
+    drop_index_online('ix_subscriptions_server_slot_end', 'subscriptions')
+    with op.batch_alter_table('subscriptions') as batch:
+        batch.drop_column('server_slot')
+    op.drop_table('servers')
@@ -0,0 +1,27 @@
+"""Last provider status check of a payment
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2024-08-12 00:00:00
+
+Stores when a user last triggered a provider status check, replacing the
+per-process dict that rate-limited the "check payment" button.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('payments', sa.Column('checked_at', sa.DateTime()))
+
+
+def downgrade():
+    with op.batch_alter_table('payments') as batch:
+        batch.drop_column('checked_at')
@@ -6,7 +6,7 @@ Simple test script to validate VPN Bot functionality
 import os
 import sys
 import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -84,6 +84,115 @@ def test_database():
         return False
 
 
+def test_connection_pool():
+    """Test shared pooled database manager and its metrics"""
+    print("🏊 Testing connection pool...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import text
+        from bot.models.database import DatabaseManager, get_db_manager, close_db_managers
+        
+        async def run(tmp):
+            database_url = f"sqlite:///{os.path.join(tmp, 'pool.db')}"
+            
+            # One manager per URL for the whole process
+            db_manager = get_db_manager(database_url)
+            assert get_db_manager(database_url) is db_manager
+            other = get_db_manager(f"sqlite:///{os.path.join(tmp, 'other.db')}")
+            assert other is not db_manager
+            
+            # Every checkout is returned to the pool
+            for _ in range(3):
+                async with db_manager.get_async_session() as session:
+                    await session.execute(text('SELECT 1'))
+            stats = db_manager.pool_stats()
+            assert stats['checkouts'] >= 3 and stats['checkouts'] == stats['checkins']
+            assert stats['checked_out'] == 0 and stats['connects'] <= stats['pool_size']
+            
+            await close_db_managers()
+            assert get_db_manager(database_url) is not db_manager
+            await close_db_managers()
+            
+            # Exhausted pool makes the next session wait, which is measured
+            small = DatabaseManager(database_url, pool_size=1, max_overflow=0, pool_timeout=5)
+            try:
+                async def hold():
+                    async with small.get_async_session() as session:
+                        await session.execute(text('SELECT 1'))
+                        await asyncio.sleep(0.1)
+                
+                await asyncio.gather(hold(), hold())
+                stats = small.pool_stats()
+                assert stats['checkouts'] == 2 and stats['max_checked_out'] == 1
+                assert stats['pool_size'] == 1 and stats['idle'] == 1 and stats['max_wait_ms'] >= 50
+            finally:
+                await small.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(tmp))
+        
+        print("✅ Connection pool test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Connection pool test failed: {e!r}")
+        return False
+
+
+def test_async_session():
+    """Test async session round trip on aiosqlite"""
+    print("⚡ Testing async database sessions...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import select
+        from bot.models.database import DatabaseManager, async_database_url, User, Subscription
+        
+        assert async_database_url('sqlite:///bot.db') == 'sqlite+aiosqlite:///bot.db'
+        assert async_database_url('postgresql://u:p@db/vpn') == 'postgresql+asyncpg://u:p@db/vpn'
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            try:
+                await db_manager.create_tables_async()
+                async with db_manager.get_async_session() as session:
+                    user = User(telegram_id=777, username='async_user')
+                    session.add(user)
+                    await session.flush()
+                    session.add(Subscription(user_id=user.id, plan_type='1_month',
+                                             end_date=datetime.utcnow() + timedelta(days=30)))
+                    await session.commit()
+                
+                # Committed objects stay loaded outside their session
+                assert user.id is not None and user.username == 'async_user'
+                
+                async with db_manager.get_async_session() as session:
+                    found = await session.scalar(select(User).where(User.telegram_id == 777))
+                    subscriptions = (await session.execute(
+                        select(Subscription).where(Subscription.user_id == found.id)
+                    )).scalars().all()
+                assert found.id == user.id and found.username == 'async_user'
+                assert len(subscriptions) == 1 and subscriptions[0].plan_type == '1_month'
+                
+                # Rolled back changes never reach the database
+                async with db_manager.get_async_session() as session:
+                    session.add(User(telegram_id=778))
+                    await session.rollback()
+                async with db_manager.get_async_session() as session:
+                    assert await session.scalar(select(User).where(User.telegram_id == 778)) is None
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'async.db')))
+        
+        print("✅ Async session test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Async session test failed: {e!r}")
+        return False
+
+
 def test_localization():
     """Test localization"""
     print("🌐 Testing localization...")
@@ -148,6 +257,1289 @@ def test_utilities():
         return False
 
 
+def test_webhook_mode():
+    """Test webhook delivery configuration"""
+    print("🌐 Testing webhook mode configuration...")
+    
+    try:
+        from bot.config.settings import Config
+        from bot.main import webhook_options, ALLOWED_UPDATES
+        
+        saved = {name: getattr(Config, name) for name in ('BOT_MODE', 'WEBHOOK_URL', 'WEBHOOK_PATH', 'WEBHOOK_SECRET_TOKEN')}
+        try:
+            Config.BOT_MODE = 'webhook'
+            Config.WEBHOOK_URL = None
+            try:
+                Config.validate()
+                raise AssertionError("Webhook mode without WEBHOOK_URL accepted")
+            except ValueError:
+                pass
+            
+            Config.WEBHOOK_URL = 'https://example.com/'
+            Config.WEBHOOK_PATH = '/telegram/'
+            Config.WEBHOOK_SECRET_TOKEN = ''
+            Config.validate()
+            options = webhook_options()
+            assert options['url_path'] == 'telegram'
+            assert options['webhook_url'] == 'https://example.com/telegram'
+            assert options['secret_token'] is None
+            assert options['allowed_updates'] == ALLOWED_UPDATES
+        finally:
+            for name, value in saved.items():
+                setattr(Config, name, value)
+        
+        print("✅ Webhook mode test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Webhook mode test failed: {e}")
+        return False
+
+
+def test_update_ordering():
+    """Test concurrent update processing keeps per-chat order"""
+    print("🔀 Testing concurrent update ordering...")
+    
+    try:
+        import asyncio
+        import random
+        from telegram import Update
+        from bot.utils.updates import ChatOrderedUpdateProcessor
+        
+        async def run():
+            processor = ChatOrderedUpdateProcessor(8)
+            handled = {}
+            running = {'now': 0, 'max': 0}
+            
+            async def handle(chat_id, step):
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+                await asyncio.sleep(random.uniform(0, 0.01))
+                handled.setdefault(chat_id, []).append(step)
+                running['now'] -= 1
+            
+            tasks = []
+            for step in range(5):
+                for chat_id in range(20):
+                    update = Update.de_json({
+                        'update_id': step * 100 + chat_id,
+                        'message': {'message_id': step, 'date': 0, 'text': 'x',
+                                    'chat': {'id': chat_id, 'type': 'private'},
+                                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'U'}}
+                    }, None)
+                    tasks.append(asyncio.create_task(processor.process_update(update, handle(chat_id, step))))
+            await asyncio.gather(*tasks)
+            
+            assert all(steps == list(range(5)) for steps in handled.values())
+            assert 1 < running['max'] <= 8
+            assert processor.active_chats == 0
+        
+        asyncio.run(run())
+        print("✅ Update ordering test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Update ordering test failed: {e}")
+        return False
+
+
+def test_user_cache():
+    """Test user snapshot cache"""
+    print("👤 Testing user cache...")
+    
+    try:
+        import dataclasses
+        import time
+        from sqlalchemy.orm.attributes import set_committed_value
+        from bot.models.database import User, Subscription
+        from bot.utils.cache import UserCache, UserSnapshot
+        
+        user = User(id=1, telegram_id=111, first_name='Ivan', referral_code='ABC', referral_balance=0.0,
+                    total_referrals=0, total_spent=0.0, is_active=True, created_at=datetime.utcnow())
+        subscription = Subscription(id=5, plan_type='1_month', is_active=True, server_location='Germany',
+                                    end_date=datetime.utcnow() + timedelta(days=10))
+        user.current_subscription_id = subscription.id
+        user.subscription_end = subscription.end_date
+        set_committed_value(user, 'current_subscription', subscription)
+        snapshot = UserSnapshot.from_user(user)
+        assert snapshot.has_active_subscription and snapshot.active_subscription.days_remaining == 9
+        assert snapshot.full_name == 'Ivan'
+        try:
+            snapshot.referral_balance = 100
+            raise AssertionError("Snapshot is mutable")
+        except dataclasses.FrozenInstanceError:
+            pass
+        
+        # LRU eviction
+        cache = UserCache(max_size=2, ttl=60)
+        for telegram_id in (1, 2):
+            cache.set(dataclasses.replace(snapshot, telegram_id=telegram_id))
+        cache.get(1)
+        cache.set(dataclasses.replace(snapshot, telegram_id=3))
+        assert cache.get(2) is None and cache.get(1) is not None and cache.get(3) is not None
+        
+        # Invalidation and stale snapshot protection
+        version = cache.version
+        cache.invalidate(1)
+        assert cache.get(1) is None
+        cache.set(dataclasses.replace(snapshot, telegram_id=1), version)
+        assert cache.get(1) is None
+        
+        # TTL expiry
+        cache = UserCache(max_size=10, ttl=0.05)
+        cache.set(snapshot)
+        assert cache.get(111) is snapshot
+        time.sleep(0.1)
+        assert cache.get(111) is None
+        
+        print("✅ User cache test passed")
+        return True
+    except Exception as e:
+        print(f"❌ User cache test failed: {e!r}")
+        return False
+
+
+def test_activity_tracker():
+    """Test write-behind activity batching"""
+    print("🕐 Testing activity tracker...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import select
+        from bot.models.database import DatabaseManager, User
+        from bot.utils.activity import ActivityTracker
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            try:
+                async with db_manager.get_async_session() as session:
+                    for telegram_id in range(1, 51):
+                        session.add(User(telegram_id=telegram_id, last_activity=datetime(2024, 1, 1)))
+                    await session.commit()
+                
+                tracker = ActivityTracker(db_manager)
+                latest = datetime(2024, 6, 1)
+                for telegram_id in range(1, 41):
+                    tracker.touch(telegram_id, datetime(2024, 5, 1))
+                    tracker.touch(telegram_id, latest)
+                    tracker.touch(telegram_id, datetime(2024, 4, 1))  # Out of order touch is ignored
+                assert tracker.pending == 40
+                
+                assert await tracker.flush() == 40
+                assert tracker.pending == 0 and tracker.stats['last_flush_size'] == 40
+                assert await tracker.flush() == 0
+                
+                async with db_manager.get_async_session() as session:
+                    users = (await session.execute(select(User).order_by(User.telegram_id))).scalars().all()
+                assert all(user.last_activity == latest for user in users[:40])
+                assert all(user.last_activity == datetime(2024, 1, 1) for user in users[40:])
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'activity.db')))
+        
+        print("✅ Activity tracker test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Activity tracker test failed: {e!r}")
+        return False
+
+
+def test_current_subscription():
+    """Test user and current subscription load in one query"""
+    print("📦 Testing current subscription loading...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import event
+        from bot.models.database import DatabaseManager, User, Subscription
+        from bot.models.queries import get_user_with_subscription, set_current_subscription
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            try:
+                async with db_manager.get_async_session() as session:
+                    user = User(telegram_id=1)
+                    session.add_all([user, User(telegram_id=2)])
+                    await session.flush()
+                    current = Subscription(user_id=user.id, plan_type='3_months', server_location='Germany',
+                                           end_date=datetime.utcnow() + timedelta(days=80))
+                    session.add_all([
+                        Subscription(user_id=user.id, plan_type='1_month', is_active=False,
+                                     end_date=datetime.utcnow() + timedelta(days=5)),
+                        current
+                    ])
+                    await session.flush()
+                    set_current_subscription(user, current)
+                    await session.commit()
+                
+                statements = []
+                event.listen(db_manager.async_engine.sync_engine, 'before_cursor_execute',
+                             lambda *args: statements.append(args[2]))
+                async with db_manager.get_async_session() as session:
+                    subscriber = await get_user_with_subscription(session, 1)
+                    other = await get_user_with_subscription(session, 2)
+                
+                # Properties work on detached users without lazy loads
+                assert len(statements) == 2, statements
+                assert subscriber.has_active_subscription
+                assert subscriber.active_subscription.plan_type == '3_months'
+                assert not other.has_active_subscription and other.active_subscription is None
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'subscriptions.db')))
+        
+        print("✅ Current subscription test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Current subscription test failed: {e!r}")
+        return False
+
+
+def test_dashboard_metrics():
+    """Test admin dashboard metrics query and cache"""
+    print("📊 Testing dashboard metrics...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import event
+        from bot.models.database import DatabaseManager, User, Subscription, Payment, VPNKey
+        from bot.utils.dashboard import DashboardMetrics
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            now = datetime.utcnow()
+            try:
+                async with db_manager.get_async_session() as session:
+                    users = [User(telegram_id=i, created_at=now - timedelta(days=i * 20),
+                                  last_activity=now - timedelta(days=i * 5)) for i in range(3)]
+                    session.add_all(users)
+                    await session.flush()
+                    session.add_all([
+                        Subscription(user_id=users[0].id, plan_type='1_month', end_date=now + timedelta(days=3)),
+                        Subscription(user_id=users[1].id, plan_type='1_month', end_date=now - timedelta(days=3)),
+                        Payment(user_id=users[0].id, amount=29900, plan_type='1_month', status='completed',
+                                completed_at=now),
+                        Payment(user_id=users[1].id, amount=79900, plan_type='3_months', status='pending'),
+                        VPNKey(key_data='key', server_location='Germany', is_used=False)
+                    ])
+                    await session.commit()
+                
+                statements = []
+                event.listen(db_manager.async_engine.sync_engine, 'before_cursor_execute',
+                             lambda *args: statements.append(args[2]))
+                
+                dashboard = DashboardMetrics(ttl=60, db_manager=db_manager)
+                metrics = await dashboard.get()
+                assert len(statements) == 1
+                assert metrics['total_users'] == 3 and metrics['new_users'] == 1
+                assert metrics['active_users'] == 2 and metrics['active_subscriptions'] == 1
+                assert metrics['daily_revenue'] == 299 and metrics['monthly_revenue'] == 299
+                assert metrics['available_keys'] == 1
+                
+                # Concurrent refreshes are served by one query
+                await asyncio.gather(*[dashboard.get() for _ in range(10)])
+                assert len(statements) == 1 and dashboard.queries == 1
+                await dashboard.get(force=True)
+                assert dashboard.queries == 2
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'dashboard.db')))
+        
+        print("✅ Dashboard metrics test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Dashboard metrics test failed: {e!r}")
+        return False
+
+
+def test_stats_rollup():
+    """Test daily stats rollups and period totals"""
+    print("🗓️ Testing stats rollups...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import select
+        from bot.models.database import DatabaseManager, User, Payment, BotStats
+        from bot.utils.rollups import StatsRollup, day_start
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            now = datetime.utcnow()
+            today = day_start(now)
+            try:
+                async with db_manager.get_async_session() as session:
+                    user = User(telegram_id=1, created_at=today - timedelta(days=9))
+                    session.add(user)
+                    await session.flush()
+                    for days_ago in range(10):
+                        completed_at = today - timedelta(days=days_ago) + timedelta(hours=1) if days_ago else now
+                        session.add(Payment(user_id=user.id, amount=10000, plan_type='1_month',
+                                            payment_method='qiwi' if days_ago % 2 else 'crypto',
+                                            status='completed', completed_at=completed_at))
+                    await session.commit()
+                
+                rollup = StatsRollup(db_manager)
+                assert await rollup.run(now) == 9
+                assert await rollup.run(now) == 0
+                
+                async with db_manager.get_async_session() as session:
+                    rows = (await session.execute(select(BotStats).order_by(BotStats.date))).scalars().all()
+                assert len(rows) == 9 and rows[0].new_users == 1 and rows[-1].total_users == 1
+                assert all(row.new_payments == 1 and row.daily_revenue == 100 for row in rows)
+                
+                # Finished days come from rollups, today from payments
+                weekly = await rollup.period_stats(today - timedelta(days=6))
+                assert weekly['payments'] == 7 and weekly['revenue'] == 700
+                assert weekly['rolled_up_days'] == 6
+                total = await rollup.period_stats(datetime.min)
+                assert total['payments'] == 10 and total['revenue'] == 1000
+                assert total['by_method']['qiwi']['payments'] == 5
+                assert total['by_plan']['1_month']['revenue'] == 1000
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'rollups.db')))
+        
+        print("✅ Stats rollup test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Stats rollup test failed: {e!r}")
+        return False
+
+
+def test_stats_engine():
+    """Test SQL-side aggregation with time buckets"""
+    print("📐 Testing stats engine...")
+    
+    try:
+        import asyncio
+        from bot.models.database import DatabaseManager, User, Payment
+        from bot.utils.stats import StatsEngine, bucket_start
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            # Wednesday noon; the window spans two ISO weeks
+            base = datetime(2024, 5, 15, 12, 0)
+            try:
+                async with db_manager.get_async_session() as session:
+                    user = User(telegram_id=1, created_at=base)
+                    session.add(user)
+                    await session.flush()
+                    for hours, amount, plan, status in [
+                        (0, 10000, '1_month', 'completed'),
+                        (0.5, 25000, '3_months', 'completed'),
+                        (3, 10000, '1_month', 'completed'),
+                        (3, 99900, '1_month', 'pending'),
+                        (-72, 50000, '6_months', 'completed'),
+                    ]:
+                        session.add(Payment(user_id=user.id, amount=amount, plan_type=plan,
+                                            payment_method='crypto', status=status,
+                                            completed_at=base + timedelta(hours=hours)))
+                    await session.commit()
+                
+                engine = StatsEngine(db_manager)
+                start = base - timedelta(days=7)
+                
+                hourly = await engine.payment_stats(start, base + timedelta(days=1), bucket='hour')
+                assert [(row['bucket'], row['payments'], row['revenue']) for row in hourly] == [
+                    (base - timedelta(hours=72), 1, 500.0),
+                    (base, 2, 350.0),
+                    (base + timedelta(hours=3), 1, 100.0),
+                ]
+                
+                weekly = await engine.payment_stats(start, bucket='week', group_by=('plan_type',))
+                weeks = {(row['bucket'], row['plan_type']): row['payments'] for row in weekly}
+                monday = bucket_start(base, 'week')
+                assert monday == datetime(2024, 5, 13)
+                assert weeks == {
+                    (monday - timedelta(days=7), '6_months'): 1,
+                    (monday, '1_month'): 2,
+                    (monday, '3_months'): 1,
+                }
+                
+                daily = await engine.new_users(start, bucket='day')
+                assert daily == [{'bucket': bucket_start(base, 'day'), 'users': 1}]
+                
+                summary = await engine.summary(bucket_start(base, 'day'), now=base)
+                assert summary == {'new_users': 1, 'payments': 3, 'revenue': 450.0, 'active_subscriptions': 0}
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'stats.db')))
+        
+        print("✅ Stats engine test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Stats engine test failed: {e!r}")
+        return False
+
+
+def test_migrations():
+    """Test schema migrations and startup revision check"""
+    print("🗃️ Testing migrations...")
+    
+    try:
+        from alembic import command
+        from sqlalchemy import event, inspect, text
+        from bot.models.database import DatabaseManager
+        from bot.models.migrations import (
+            alembic_config, ensure_schema, head_revision, SchemaOutdatedError
+        )
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            # Fresh database is created from migrations
+            db_manager = DatabaseManager(f"sqlite:///{os.path.join(tmp, 'fresh.db')}")
+            assert ensure_schema(db_manager) == head_revision()
+            indexes = {index['name'] for index in inspect(db_manager.engine).get_indexes('payments')}
+            assert 'ix_payments_status_completed_at' in indexes
+            
+            # Up to date database: revision check only, no reflection
+            statements = []
+            event.listen(db_manager.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            ensure_schema(db_manager)
+            assert statements and all('alembic_version' in statement for statement in statements), statements
+            db_manager.close()
+            
+            # Legacy database made by create_all before migrations existed
+            legacy_url = f"sqlite:///{os.path.join(tmp, 'legacy.db')}"
+            command.upgrade(alembic_config(legacy_url), '0001')
+            db_manager = DatabaseManager(legacy_url)
+            with db_manager.engine.begin() as conn:
+                conn.execute(text("DROP TABLE alembic_version"))
+                conn.execute(text("INSERT INTO users (id, telegram_id) VALUES (1, 100)"))
+                conn.execute(text(
+                    "INSERT INTO subscriptions (id, user_id, plan_type, is_active, end_date) "
+                    "VALUES (7, 1, '1_month', 1, :end)"
+                ), {'end': datetime.utcnow() + timedelta(days=10)})
+            
+            assert ensure_schema(db_manager) == head_revision()
+            with db_manager.engine.connect() as conn:
+                row = conn.execute(text("SELECT current_subscription_id, subscription_end FROM users")).one()
+            assert row[0] == 7 and row[1] is not None
+            db_manager.close()
+            
+            # Without auto migration an outdated schema stops startup
+            outdated_url = f"sqlite:///{os.path.join(tmp, 'outdated.db')}"
+            command.upgrade(alembic_config(outdated_url), '0002')
+            db_manager = DatabaseManager(outdated_url)
+            try:
+                ensure_schema(db_manager, auto_migrate=False)
+                raise AssertionError("outdated schema accepted")
+            except SchemaOutdatedError:
+                pass
+            db_manager.close()
+        
+        print("✅ Migrations test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Migrations test failed: {e!r}")
+        return False
+
+
+def test_broadcast():
+    """Test rate-limited broadcast with checkpoints and resume"""
+    print("📢 Testing broadcasts...")
+    
+    try:
+        import asyncio
+        import time
+        from unittest.mock import patch
+        from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+        from bot.models.database import DatabaseManager, User, Broadcast
+        from bot.models.migrations import ensure_schema_async
+        from sqlalchemy import select
+        from bot.utils.activity import ActivityTracker
+        from bot.utils.broadcast import BroadcastManager, TokenBucket, classify_error
+        
+        assert classify_error(Forbidden("Forbidden: bot was blocked by the user")) == 'blocked'
+        assert classify_error(BadRequest("Chat not found")) == 'chat_not_found'
+        assert classify_error(BadRequest("Message is too long")) == 'failed'
+        assert classify_error(RetryAfter(3)) == 'retry_after'
+        assert classify_error(TimedOut()) == 'transient'
+        assert classify_error(NetworkError("Connection reset")) == 'transient'
+        
+        class FakeBot:
+            def __init__(self, delay=0.0):
+                self.delay = delay
+                self.sent = []
+                self.flooded = False
+                self.edits = 0
+            
+            async def send_message(self, chat_id, text, parse_mode=None):
+                await asyncio.sleep(self.delay)
+                if chat_id == 1005 and not self.flooded:
+                    self.flooded = True
+                    raise RetryAfter(1)
+                if chat_id == 1007:
+                    raise Forbidden("Forbidden: bot was blocked by the user")
+                self.sent.append(chat_id)
+            
+            async def edit_message_text(self, **kwargs):
+                self.edits += 1
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await ensure_schema_async(db_manager)
+            try:
+                async with db_manager.get_async_session() as session:
+                    session.add_all([User(telegram_id=1000 + i) for i in range(60)])
+                    await session.commit()
+                
+                # Token bucket keeps the configured rate
+                bucket = TokenBucket(rate=100, capacity=1)
+                started = time.monotonic()
+                for _ in range(21):
+                    await bucket.acquire()
+                assert time.monotonic() - started >= 0.19
+                
+                manager = BroadcastManager(db_manager, rate=1000, chat_interval=0, concurrency=5,
+                                           batch_size=10, progress_interval=0)
+                broadcast = await manager.create(admin_id=1, text='hello', progress_chat_id=1, progress_message_id=2)
+                assert broadcast.total == 60
+                
+                # Flood control is retried, blocked users are counted as failed
+                bot = FakeBot()
+                result = await manager.run(bot, broadcast.id)
+                assert result.status == 'completed' and result.sent == 59 and result.failed == 1
+                assert result.unreachable == 1
+                assert sorted(bot.sent) == [1000 + i for i in range(60) if i != 7]
+                assert manager.stats['retry_after'] == 1 and manager.stats['blocked'] == 1 and bot.edits > 0
+                
+                # User who blocked the bot is deactivated and left out of later broadcasts
+                async with db_manager.get_async_session() as session:
+                    blocked = await session.scalar(select(User).where(User.telegram_id == 1007))
+                assert blocked.is_active is False
+                
+                # Interrupted broadcast resumes from its checkpoint
+                broadcast = await manager.create(admin_id=1, text='again')
+                assert broadcast.total == 59 and broadcast.skipped == 1
+                slow_bot = FakeBot(delay=0.01)
+                slow_bot.flooded = True
+                manager.start(slow_bot, broadcast.id)
+                while len(slow_bot.sent) < 25:
+                    await asyncio.sleep(0.01)
+                await manager.stop()
+                
+                async with db_manager.get_async_session() as session:
+                    saved = await session.get(Broadcast, broadcast.id)
+                assert saved.status == 'running' and 20 <= saved.last_user_id < 60
+                
+                resumed_manager = BroadcastManager(db_manager, rate=1000, chat_interval=0, batch_size=10)
+                assert await resumed_manager.resume(slow_bot) == [broadcast.id]
+                await resumed_manager.wait()
+                
+                async with db_manager.get_async_session() as session:
+                    saved = await session.get(Broadcast, broadcast.id)
+                assert saved.status == 'completed' and saved.sent + saved.failed == 59
+                assert set(slow_bot.sent) == {1000 + i for i in range(60) if i != 7}
+                # At most the batch in flight is sent twice
+                assert len(slow_bot.sent) - 59 <= 10
+                
+                # Cancelled broadcast is not resumed
+                broadcast = await manager.create(admin_id=1, text='cancel me')
+                assert await manager.cancel(broadcast.id)
+                assert await manager.resume(slow_bot) == []
+                
+                # Crashed broadcast task is logged and left to resume
+                broadcast = await manager.create(admin_id=1, text='crash')
+                
+                async def broken_batch(*args):
+                    raise RuntimeError("database went away")
+                
+                with patch.object(manager, '_load_batch', broken_batch), \
+                        patch('bot.utils.broadcast.logger') as broadcast_logger:
+                    manager.start(slow_bot, broadcast.id)
+                    await manager.wait()
+                    await asyncio.sleep(0)
+                assert 'database went away' in broadcast_logger.error.call_args[0][0]
+                async with db_manager.get_async_session() as session:
+                    saved = await session.get(Broadcast, broadcast.id)
+                assert saved.status == 'running'
+                await manager.cancel(broadcast.id)
+                
+                # Any update from the user makes them reachable again
+                tracker = ActivityTracker(db_manager)
+                tracker.touch(1007)
+                await tracker.flush()
+                async with db_manager.get_async_session() as session:
+                    blocked = await session.scalar(select(User).where(User.telegram_id == 1007))
+                assert blocked.is_active is True
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'broadcast.db')))
+        
+        print("✅ Broadcast test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Broadcast test failed: {e!r}")
+        return False
+
+
+def test_broadcast_segments():
+    """Test broadcast audience segments"""
+    print("🎯 Testing broadcast segments...")
+    
+    try:
+        import asyncio
+        from datetime import datetime, timedelta
+        from sqlalchemy import select, func
+        from bot.models.database import DatabaseManager, User, Subscription, BroadcastRecipient
+        from bot.models.migrations import ensure_schema_async
+        from bot.utils.broadcast import BroadcastManager
+        from bot.utils.segments import parse_segment, describe_segment, count_segment
+        
+        assert parse_segment('inactive:30') == ('inactive', '30')
+        assert parse_segment('plan:3_months') == ('plan', '3_months')
+        for invalid in ('nobody', 'inactive', 'inactive:-1', 'plan:forever', 'active:1'):
+            try:
+                parse_segment(invalid)
+                assert False, f"{invalid} accepted"
+            except ValueError:
+                pass
+        assert '30' in describe_segment('inactive', '30')
+        
+        class FakeBot:
+            def __init__(self):
+                self.sent = []
+            
+            async def send_message(self, chat_id, text, parse_mode=None):
+                self.sent.append(chat_id)
+            
+            async def edit_message_text(self, **kwargs):
+                pass
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await ensure_schema_async(db_manager)
+            now = datetime.utcnow()
+            try:
+                async with db_manager.get_async_session() as session:
+                    referrer = User(telegram_id=1, last_activity=now)
+                    session.add(referrer)
+                    await session.flush()
+                    session.add(User(telegram_id=2, referrer_id=referrer.id, last_activity=now))
+                    session.add(User(telegram_id=3, last_activity=now - timedelta(days=40)))
+                    # Blocked the bot: never in a segment
+                    session.add(User(telegram_id=7, is_active=False, last_activity=now - timedelta(days=40)))
+                    for telegram_id, plan_type, end in [(4, '1_month', now + timedelta(days=10)),
+                                                        (5, '3_months', now + timedelta(days=60)),
+                                                        (6, '1_month', now - timedelta(days=1))]:
+                        user = User(telegram_id=telegram_id, last_activity=now)
+                        session.add(user)
+                        await session.flush()
+                        subscription = Subscription(user_id=user.id, plan_type=plan_type, end_date=end,
+                                                    is_active=end > now)
+                        session.add(subscription)
+                        await session.flush()
+                        user.current_subscription_id = subscription.id
+                        user.subscription_end = end
+                    await session.commit()
+                
+                expected = {
+                    ('all', None): {1, 2, 3, 4, 5, 6},
+                    ('active', None): {4, 5},
+                    ('expired', None): {6},
+                    ('inactive', '30'): {3},
+                    ('plan', '1_month'): {4},
+                    ('plan', '3_months'): {5},
+                    ('referrers', None): {1},
+                }
+                manager = BroadcastManager(db_manager, rate=1000, chat_interval=0, batch_size=2)
+                for (segment, param), telegram_ids in expected.items():
+                    async with db_manager.get_async_session() as session:
+                        assert await count_segment(session, segment, param) == len(telegram_ids), segment
+                    
+                    broadcast = await manager.create(admin_id=1, text='hi', segment=segment, segment_param=param)
+                    assert broadcast.total == len(telegram_ids)
+                    assert broadcast.skipped == (1 if segment in ('all', 'inactive') else 0), segment
+                    bot = FakeBot()
+                    await manager.run(bot, broadcast.id)
+                    assert set(bot.sent) == telegram_ids, (segment, param, bot.sent)
+                
+                # Recipient lists are dropped once broadcasts finish
+                async with db_manager.get_async_session() as session:
+                    assert await session.scalar(select(func.count()).select_from(BroadcastRecipient)) == 0
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'segments.db')))
+        
+        print("✅ Broadcast segments test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Broadcast segments test failed: {e!r}")
+        return False
+
+
+def test_qr_cache():
+    """Test QR code render cache"""
+    print("🔳 Testing QR code cache...")
+    
+    try:
+        import asyncio
+        from bot.utils.cache import QRCodeCache
+        from bot.utils.helpers import render_qr_png
+        
+        configs = [f"[Interface]\nPrivateKey = key{i}\nAddress = 10.0.0.{i}/32" for i in range(4)]
+        
+        async def run(tmp):
+            cache = QRCodeCache(max_size=2, directory=tmp, disk_size=10)
+            try:
+                # Render happens off the event loop
+                ticks = 0
+                
+                async def heartbeat():
+                    nonlocal ticks
+                    while True:
+                        ticks += 1
+                        await asyncio.sleep(0)
+                
+                ticker = asyncio.create_task(heartbeat())
+                pngs = await asyncio.gather(*[cache.get(configs[0]) for _ in range(5)])
+                ticker.cancel()
+                assert ticks > 1
+                # Concurrent requests share one render
+                assert cache.misses == 1 and len(set(pngs)) == 1
+                assert pngs[0].startswith(b'\x89PNG') and pngs[0] == render_qr_png(configs[0])
+                
+                await cache.get(configs[0])
+                assert cache.hits == 5
+                
+                # Memory is bounded, evicted PNGs come back from disk
+                for config in configs[1:]:
+                    await cache.get(config)
+                assert cache.stats()['size'] == 2 and cache.evictions == 2
+                await cache.get(configs[0])
+                assert cache.disk_hits == 1 and cache.misses == 4
+                
+                # Changed config is a different key; invalidated PNG is rendered again
+                cache.invalidate(configs[1])
+                await cache.get(configs[1])
+                assert cache.misses == 5
+            finally:
+                cache.shutdown()
+            
+            # Disk cache survives restarts
+            restarted = QRCodeCache(max_size=2, directory=tmp)
+            try:
+                await restarted.get(configs[2])
+                assert restarted.disk_hits == 1 and restarted.misses == 0
+            finally:
+                restarted.shutdown()
+            
+            # Disk cache is bounded too
+            small = QRCodeCache(max_size=0, directory=os.path.join(tmp, 'small'), disk_size=2)
+            try:
+                for config in configs:
+                    await small.get(config)
+                assert len(os.listdir(os.path.join(tmp, 'small'))) <= 2
+            finally:
+                small.shutdown()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(tmp))
+        
+        print("✅ QR code cache test passed")
+        return True
+    except Exception as e:
+        print(f"❌ QR code cache test failed: {e!r}")
+        return False
+
+
+def test_config_delivery():
+    """Test config delivery as one album with file_id reuse"""
+    print("📎 Testing config delivery...")
+    
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        from datetime import datetime, timedelta
+        from telegram.error import BadRequest
+        from bot.config.settings import Config
+        from bot.models.database import get_db_manager, close_db_managers, User, Subscription
+        from bot.models.migrations import ensure_schema_async
+        from bot.utils.billing import send_vpn_config
+        
+        class FakeBot:
+            def __init__(self):
+                self.calls = 0
+                self.uploads = 0
+                self.rejected = set()
+            
+            async def send_media_group(self, chat_id, media):
+                self.calls += 1
+                assert len(media) == 2 and all(item.type == 'document' for item in media)
+                file_ids = []
+                for item in media:
+                    if isinstance(item.media, str):
+                        if item.media in self.rejected:
+                            raise BadRequest("Wrong file identifier/http url specified")
+                        file_ids.append(item.media)
+                    else:
+                        self.uploads += 1
+                        file_ids.append(f"file-{self.uploads}")
+                return [SimpleNamespace(document=SimpleNamespace(file_id=file_id)) for file_id in file_ids]
+        
+        async def run(database_url):
+            db_manager = get_db_manager(database_url)
+            await ensure_schema_async(db_manager)
+            async with db_manager.get_async_session() as session:
+                user = User(telegram_id=42)
+                session.add(user)
+                await session.flush()
+                subscription = Subscription(user_id=user.id, plan_type='1_month', vpn_config='[Interface]\nA',
+                                            end_date=datetime.utcnow() + timedelta(days=30))
+                session.add(subscription)
+                await session.commit()
+            
+            async def load():
+                async with db_manager.get_async_session() as session:
+                    return await session.get(Subscription, subscription.id)
+            
+            edits = []
+            
+            async def edit_message():
+                await asyncio.sleep(0.05)
+                edits.append(bot.calls)
+            
+            # Config and QR go in one call, the message edit runs alongside
+            bot = FakeBot()
+            report = await send_vpn_config(bot, 42, 42, await load(), 'caption', edit_message())
+            assert report['api_calls'] == 2 and report['uploaded'] and bot.calls == 1 and bot.uploads == 2
+            assert edits == [1] and report['latency_ms'] < 1000
+            stored = await load()
+            assert (stored.config_file_id, stored.qr_file_id) == ('file-1', 'file-2')
+            
+            # Repeat delivery sends both files by file_id
+            report = await send_vpn_config(bot, 42, 42, stored, 'caption')
+            assert report == {**report, 'api_calls': 1, 'uploaded': False} and bot.uploads == 2
+            
+            # Changed config invalidates stored file_ids
+            async with db_manager.get_async_session() as session:
+                changed = await session.get(Subscription, subscription.id)
+                changed.vpn_config = '[Interface]\nB'
+                await session.commit()
+            report = await send_vpn_config(bot, 42, 42, await load(), 'caption')
+            assert report['uploaded'] and bot.uploads == 4
+            
+            # File_id rejected by Telegram falls back to upload
+            bot.rejected.add('file-3')
+            report = await send_vpn_config(bot, 42, 42, await load(), 'caption')
+            assert report['api_calls'] == 2 and report['uploaded'] and bot.uploads == 6
+            assert (await load()).config_file_id == 'file-5'
+        
+        saved_url = Config.DATABASE_URL
+        with tempfile.TemporaryDirectory() as tmp:
+            Config.DATABASE_URL = f"sqlite:///{os.path.join(tmp, 'files.db')}"
+            try:
+                asyncio.run(run(Config.DATABASE_URL))
+            finally:
+                asyncio.run(close_db_managers())
+                Config.DATABASE_URL = saved_url
+        
+        print("✅ Config delivery test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Config delivery test failed: {e!r}")
+        return False
+
+
+def test_key_allocator():
+    """Test atomic VPN key allocation from the pool"""
+    print("🔑 Testing VPN key allocator...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import select, func, update
+        from bot.models.database import DatabaseManager, User, VPNKey
+        from bot.utils.keys import KeyAllocator
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            try:
+                async with db_manager.get_async_session() as session:
+                    users = [User(telegram_id=i) for i in range(30)]
+                    session.add_all(users)
+                    session.add_all([VPNKey(key_data=f"key{i}", server_location='Germany', is_used=False)
+                                     for i in range(25)])
+                    session.add(VPNKey(key_data='nl', server_location='Netherlands', is_used=False))
+                    await session.commit()
+                
+                # Two allocators stand for two bot processes sharing the pool
+                allocators = [KeyAllocator(db_manager, prefetch=4, reservation_ttl=600) for _ in range(2)]
+                
+                async def purchase(allocator, user):
+                    async with db_manager.get_async_session() as session:
+                        key = await allocator.allocate(session, user.id, 'Germany')
+                        await session.commit()
+                        return key and key.key_data
+                
+                keys = await asyncio.gather(*[purchase(allocators[i % 2], user) for i, user in enumerate(users)])
+                issued = [key for key in keys if key]
+                buffered = sum(allocator.buffered('Germany') for allocator in allocators)
+                assert len(issued) == len(set(issued)) and len(issued) + buffered == 25
+                
+                # Keys prefetched by the other process are taken once its buffer is drained
+                for allocator in allocators:
+                    while allocator.buffered('Germany'):
+                        issued.append(await purchase(allocator, users[-1]))
+                assert len(issued) == len(set(issued)) == 25
+                async with db_manager.get_async_session() as session:
+                    owners = (await session.execute(
+                        select(VPNKey.assigned_user_id).where(VPNKey.server_location == 'Germany')
+                    )).scalars().all()
+                    assert None not in owners
+                    assert await session.scalar(
+                        select(func.count(VPNKey.id)).where(VPNKey.is_used == False)) == 1
+                
+                # Prefetched keys go back to the pool on release
+                allocator = KeyAllocator(db_manager, prefetch=5, reservation_ttl=600)
+                async with db_manager.get_async_session() as session:
+                    assert (await allocator.allocate(session, users[0].id, 'Netherlands')).key_data == 'nl'
+                    await session.commit()
+                async with db_manager.get_async_session() as session:
+                    session.add_all([VPNKey(key_data=f"nl{i}", server_location='Netherlands', is_used=False)
+                                     for i in range(3)])
+                    await session.commit()
+                async with db_manager.get_async_session() as session:
+                    await allocator.allocate(session, users[1].id, 'Netherlands')
+                    await session.commit()
+                assert allocator.buffered('Netherlands') == 2
+                assert await allocator.release() == 2 and allocator.buffered() == 0
+                
+                # A rolled back purchase leaves its keys in the pool
+                async with db_manager.get_async_session() as session:
+                    assert await allocator.allocate(session, users[2].id, 'Netherlands')
+                    await session.rollback()
+                    assert await session.scalar(
+                        select(func.count(VPNKey.id)).where(VPNKey.is_used == False)) == 2
+                
+                # Reservations abandoned past the TTL are swept, assigned keys are kept
+                async with db_manager.get_async_session() as session:
+                    await allocator._refill(session, 'Netherlands')
+                    allocator._buffers.clear()
+                    await session.execute(update(VPNKey).values(used_at=datetime.utcnow() - timedelta(hours=1)))
+                    await session.commit()
+                assert await allocator.release_stale() == 2
+                async with db_manager.get_async_session() as session:
+                    assert await session.scalar(
+                        select(func.count(VPNKey.id)).where(VPNKey.is_used == False)) == 2
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'keys.db')))
+        
+        print("✅ VPN key allocator test passed")
+        return True
+    except Exception as e:
+        print(f"❌ VPN key allocator test failed: {e!r}")
+        return False
+
+
+def test_address_allocator():
+    """Test WireGuard client address allocation and release"""
+    print("🌐 Testing address allocator...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import select, func, update
+        from bot.models.database import DatabaseManager, User, Subscription, IPPool
+        from bot.utils.addresses import AddressAllocator, AddressBitmap, AddressPoolExhausted, MAX_ATTEMPTS
+        
+        # /29: network, server and broadcast addresses are never handed out
+        bitmap = AddressBitmap('10.9.0.0/29', b'', 0)
+        addresses = [bitmap.address(bitmap.take()) for _ in range(5)]
+        assert addresses == [f"10.9.0.{i}" for i in range(2, 7)]
+        try:
+            bitmap.take()
+            assert False, "allocated past the end of the network"
+        except AddressPoolExhausted:
+            pass
+        assert bitmap.put(bitmap.offset('10.9.0.4')) and not bitmap.put(bitmap.offset('10.9.0.4'))
+        assert bitmap.address(bitmap.take()) == '10.9.0.4'
+        bitmap.put(bitmap.offset('10.9.0.3'))
+        reloaded = AddressBitmap('10.9.0.0/29', bytes(bitmap.bitmap), 0)
+        assert reloaded.allocated == 4 and reloaded.address(reloaded.take()) == '10.9.0.3'
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            now = datetime.utcnow()
+            try:
+                async with db_manager.get_async_session() as session:
+                    user = User(telegram_id=1)
+                    session.add(user)
+                    await session.commit()
+                
+                # Two allocators stand for two bot processes sharing the pools
+                allocators = [AddressAllocator(db_manager, network='10.8.0.0/16') for _ in range(2)]
+                
+                async def purchase(i):
+                    async with db_manager.get_async_session() as session:
+                        address = await allocators[i % 2].allocate(session, 'Germany')
+                        session.add(Subscription(user_id=user.id, plan_type='1_month', server_location='Germany',
+                                                 client_ip=address,
+                                                 end_date=now + timedelta(days=-1 if i < 10 else 30)))
+                        await session.commit()
+                        return address
+                
+                addresses = await asyncio.gather(*[purchase(i) for i in range(40)])
+                assert len(set(addresses)) == 40 and '10.8.0.1' not in addresses
+                assert sum(allocator.stats['conflicts'] for allocator in allocators) > 0
+                async with db_manager.get_async_session() as session:
+                    assert await session.scalar(select(IPPool.allocated)) == 40
+                
+                # A rolled back allocation leaves the cache ahead of the database, it is reloaded
+                async with db_manager.get_async_session() as session:
+                    lost = await allocators[0].allocate(session, 'Germany')
+                    await session.rollback()
+                async with db_manager.get_async_session() as session:
+                    address = await allocators[0].allocate(session, 'Germany')
+                    await session.commit()
+                assert address not in addresses and address == lost
+                
+                # Expired subscriptions give their addresses back, they are handed out again
+                assert await allocators[1].release_expired() == 10
+                assert await allocators[1].release_expired() == 0
+                async with db_manager.get_async_session() as session:
+                    assert await session.scalar(
+                        select(func.count(Subscription.id)).where(Subscription.client_ip.isnot(None))) == 30
+                    assert await session.scalar(select(IPPool.allocated)) == 31
+                    reused = {await allocators[0].allocate(session, 'Germany') for _ in range(10)}
+                    await session.commit()
+                assert reused == set(addresses[:10])
+                
+                # A writer that keeps losing the version check gives up after MAX_ATTEMPTS reloads
+                class ContendedAllocator(AddressAllocator):
+                    async def _store(self, session, location, pool):
+                        await session.execute(update(IPPool).where(IPPool.server_location == location)
+                                              .values(version=IPPool.version + 1))
+                        return await super()._store(session, location, pool)
+                
+                contended = ContendedAllocator(db_manager, network='10.8.0.0/16')
+                async with db_manager.get_async_session() as session:
+                    try:
+                        await contended.allocate(session, 'Germany')
+                        assert False, "allocated without winning the version check"
+                    except RuntimeError:
+                        pass
+                    await session.rollback()
+                assert contended.stats['conflicts'] == MAX_ATTEMPTS and contended.stats['allocated'] == 0
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'addresses.db')))
+        
+        print("✅ Address allocator test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Address allocator test failed: {e!r}")
+        return False
+
+
+def test_keypair_pool():
+    """Test X25519 key generation and the pre-generated key pair pool"""
+    print("🔐 Testing WireGuard key pairs...")
+    
+    try:
+        import asyncio
+        import base64
+        from bot.utils.helpers import generate_public_key, generate_vpn_config
+        from bot.utils.keys import KeypairPool
+        
+        # RFC 7748 section 6.1 test vector
+        private_key = base64.b64encode(bytes.fromhex(
+            '77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a')).decode()
+        assert base64.b64decode(generate_public_key(private_key)).hex() == \
+            '8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a'
+        
+        async def run():
+            pool = KeypairPool(size=20, low_water=5, batch_size=8)
+            try:
+                assert await pool.fill() == 20 and len(pool) == 20
+                pairs = [pool.get() for _ in range(15)]
+                assert pool.stats['served'] == 15 and pool.stats['refills'] == 1
+                
+                # Dropping below the low-water mark refills in the background
+                pairs.append(pool.get())
+                assert len(pool) == 4
+                await pool.schedule_refill()
+                assert len(pool) == 20 and pool.stats['refills'] == 2
+                
+                # An empty pool generates inline
+                pool.size = pool.low_water = 0
+                pool._pairs.clear()
+                pairs.append(pool.get())
+                assert pool.stats['inline'] == 1 and len(pool) == 0
+                
+                assert len({private for private, _ in pairs}) == len(pairs)
+                assert all(generate_public_key(private) == public for private, public in pairs)
+                config = generate_vpn_config('10.8.0.2', 'Germany', pairs[0])
+                assert f"PrivateKey = {pairs[0][0]}" in config and 'Address = 10.8.0.2/32' in config
+            finally:
+                pool.shutdown()
+        
+        asyncio.run(run())
+        
+        print("✅ WireGuard key pair test passed")
+        return True
+    except Exception as e:
+        print(f"❌ WireGuard key pair test failed: {e!r}")
+        return False
+
+
+def test_server_registry():
+    """Test least-loaded server placement and peer counters"""
+    print("🖥️ Testing server registry...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import select
+        from bot.models.database import DatabaseManager, User, Subscription, Server
+        from bot.utils.servers import ServerRegistry
+        
+        async def run(db_path):
+            db_manager = DatabaseManager(f"sqlite:///{db_path}")
+            await db_manager.create_tables_async()
+            now = datetime.utcnow()
+            try:
+                async with db_manager.get_async_session() as session:
+                    session.add_all([
+                        Server(location='Germany', endpoint='de:51820', capacity=2, active_peers=0),
+                        Server(location='Japan', endpoint='jp:51820', capacity=10, active_peers=5),
+                        Server(location='France', endpoint='fr:51820', capacity=10, active_peers=0,
+                               is_enabled=False),
+                    ])
+                    user = User(telegram_id=1)
+                    session.add(user)
+                    await session.commit()
+                
+                registry = ServerRegistry(db_manager)
+                
+                async def place(registry):
+                    async with db_manager.get_async_session() as session:
+                        location = await registry.place(session)
+                        await session.commit()
+                        return location
+                
+                async def peers():
+                    async with db_manager.get_async_session() as session:
+                        return dict((await session.execute(select(Server.location, Server.active_peers))).all())
+                
+                # Least loaded first, disabled and full servers are skipped
+                placed = [await place(registry) for _ in range(8)]
+                assert placed == ['Germany', 'Germany'] + ['Japan'] * 5 + [None], placed
+                assert await peers() == {'Germany': 2, 'Japan': 10, 'France': 0}
+                assert len(registry._heap) <= 2 * 3 + 16
+                
+                # Released slots are reused; a second process with a stale cache notices full servers
+                async with db_manager.get_async_session() as session:
+                    assert await registry.release(session, ['Germany', 'Japan', 'Japan']) == 3
+                    await session.commit()
+                other = ServerRegistry(db_manager)
+                await other.load()
+                assert [await place(registry) for _ in range(3)] == ['Germany', 'Japan', 'Japan']
+                assert other.get('Japan')['active_peers'] == 8 and await place(other) is None
+                assert other.get('Japan')['active_peers'] == 10
+                assert await peers() == {'Germany': 2, 'Japan': 10, 'France': 0}
+                
+                # Expired subscriptions give their slots back
+                async with db_manager.get_async_session() as session:
+                    session.add_all([
+                        Subscription(user_id=user.id, plan_type='1_month', server_location='Japan',
+                                     server_slot=True, end_date=now - timedelta(days=1)),
+                        Subscription(user_id=user.id, plan_type='1_month', server_location='Japan',
+                                     server_slot=True, end_date=now + timedelta(days=1)),
+                    ])
+                    await session.commit()
+                assert await registry.release_expired() == 1 and await registry.release_expired() == 0
+                assert registry.get('Japan')['active_peers'] == 9 and await place(registry) == 'Japan'
+                assert [server['location'] for server in registry.servers()] == ['France', 'Germany', 'Japan']
+            finally:
+                await db_manager.close_async()
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(run(os.path.join(tmp, 'servers.db')))
+        
+        print("✅ Server registry test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Server registry test failed: {e!r}")
+        return False
+
+
+def test_provider_check_interval():
+    """Test provider status checks are rate limited through the payment row"""
+    print("⏱️ Testing provider check interval...")
+    
+    try:
+        import asyncio
+        from sqlalchemy import update
+        from bot.config.settings import Config
+        from bot.models.database import get_db_manager, close_db_managers, User, Payment
+        from bot.models.migrations import ensure_schema_async
+        from bot.utils.billing import claim_provider_check
+        
+        async def run(database_url):
+            db_manager = get_db_manager(database_url)
+            await ensure_schema_async(db_manager)
+            async with db_manager.get_async_session() as session:
+                user = User(telegram_id=7)
+                session.add(user)
+                await session.flush()
+                payment = Payment(user_id=user.id, amount=29900, plan_type='1_month', status='pending')
+                session.add(payment)
+                await session.commit()
+            
+            # Concurrent presses (or workers) get a single provider check per interval
+            claims = await asyncio.gather(*[claim_provider_check(payment.id) for _ in range(5)])
+            assert claims.count(True) == 1
+            async with db_manager.get_async_session() as session:
+                await session.execute(update(Payment).values(
+                    checked_at=datetime.utcnow() - timedelta(seconds=Config.PAYMENT_CHECK_MIN_INTERVAL + 1)))
+                await session.commit()
+            assert await claim_provider_check(payment.id)
+            
+            # Finished payments are never checked again
+            async with db_manager.get_async_session() as session:
+                await session.execute(update(Payment).values(status='expired', checked_at=None))
+                await session.commit()
+            assert not await claim_provider_check(payment.id)
+        
+        saved = (Config.DATABASE_URL, Config.PAYMENT_CHECK_MIN_INTERVAL)
+        with tempfile.TemporaryDirectory() as tmp:
+            Config.DATABASE_URL = f"sqlite:///{os.path.join(tmp, 'checks.db')}"
+            Config.PAYMENT_CHECK_MIN_INTERVAL = 10
+            try:
+                asyncio.run(run(Config.DATABASE_URL))
+            finally:
+                asyncio.run(close_db_managers())
+                Config.DATABASE_URL, Config.PAYMENT_CHECK_MIN_INTERVAL = saved
+        
+        print("✅ Provider check interval test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Provider check interval test failed: {e!r}")
+        return False
+
+
 def main():
     """Run all tests"""
     print("🚀 Starting VPN Bot functionality tests...\n")
@@ -155,8 +1547,28 @@ def main():
     tests = [
         test_config,
         test_database,
+        test_connection_pool,
+        test_async_session,
         test_localization,
-        test_utilities
+        test_utilities,
+        test_webhook_mode,
+        test_update_ordering,
+        test_user_cache,
+        test_activity_tracker,
+        test_current_subscription,
+        test_dashboard_metrics,
+        test_stats_rollup,
+        test_stats_engine,
+        test_migrations,
+        test_broadcast,
+        test_broadcast_segments,
+        test_qr_cache,
+        test_config_delivery,
+        test_key_allocator,
+        test_address_allocator,
+        test_keypair_pool,
+        test_server_registry,
+        test_provider_check_interval
     ]
     
     passed = 0
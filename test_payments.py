@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Payment provider clients test against a local stub HTTP server
+"""
+
+import os
+import sys
+import asyncio
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('YOOMONEY_TOKEN', 'test_yoomoney_token')
+os.environ.setdefault('QIWI_TOKEN', 'test_qiwi_token')
+os.environ.setdefault('CRYPTOMUS_API_KEY', 'test_cryptomus_key')
+os.environ.setdefault('CRYPTOMUS_MERCHANT_ID', 'test_merchant')
+os.environ.setdefault('QIWI_SECRET_KEY', 'test_qiwi_secret')
+os.environ.setdefault('YOOMONEY_NOTIFICATION_SECRET', 'test_yoomoney_secret')
+
+from aiohttp import web
+
+
+class StubProviderServer:
+    """Local HTTP server imitating YooMoney, QIWI and Cryptomus APIs"""
+    
+    def __init__(self):
+        self.peers = set()
+        self.requests = 0
+        self.delay = 0
+        self.runner = None
+        self.base_url = None
+    
+    def _track(self, request):
+        self.requests += 1
+        self.peers.add(request.transport.get_extra_info('peername'))
+    
+    async def yoomoney_request(self, request):
+        self._track(request)
+        form = await request.post()
+        await asyncio.sleep(self.delay)
+        return web.json_response({'status': 'success', 'request_id': f"req_{form['label']}"})
+    
+    async def yoomoney_details(self, request):
+        self._track(request)
+        return web.json_response({'status': 'success'})
+    
+    async def qiwi_bill(self, request):
+        self._track(request)
+        bill_id = request.match_info['bill_id']
+        if request.method == 'PUT':
+            return web.json_response({'billId': bill_id, 'payUrl': f"https://qiwi.test/{bill_id}"})
+        return web.json_response({'billId': bill_id, 'status': {'value': 'REJECTED'}})
+    
+    async def cryptomus_payment(self, request):
+        self._track(request)
+        from bot.utils.payments import CryptomusPayment
+        body = await request.json()
+        if request.headers.get('sign') != CryptomusPayment()._generate_signature(body):
+            return web.json_response({'state': 1, 'message': 'bad sign'})
+        return web.json_response({'state': 0, 'result': {'uuid': 'uuid-1', 'url': 'https://pay.test/uuid-1'}})
+    
+    async def cryptomus_info(self, request):
+        self._track(request)
+        return web.json_response({'state': 0, 'result': {'payment_status': 'check'}})
+    
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/request-payment', self.yoomoney_request)
+        app.router.add_post('/operation-details', self.yoomoney_details)
+        app.router.add_route('*', '/partner/bill/v1/bills/{bill_id}', self.qiwi_bill)
+        app.router.add_post('/payment', self.cryptomus_payment)
+        app.router.add_post('/payment/info', self.cryptomus_info)
+        
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+    
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def _run_providers():
+    from bot.utils.payments import PaymentManager
+    
+    server = StubProviderServer()
+    await server.start()
+    options = {method: {'base_url': server.base_url} for method in ('yoomoney', 'qiwi', 'crypto')}
+    manager = PaymentManager(provider_options=options)
+    
+    try:
+        payment = await manager.create_payment('yoomoney', 29900, 'vpn_1', 'VPN')
+        assert payment['payment_id'] == 'req_vpn_1'
+        assert await manager.check_payment('yoomoney', 'req_vpn_1') == 'completed'
+        print("  ✅ YooMoney create/check works")
+        
+        payment = await manager.create_payment('qiwi', 29900, 'vpn_2', 'VPN')
+        assert payment['payment_url'] == 'https://qiwi.test/vpn_2'
+        assert await manager.check_payment('qiwi', 'vpn_2') == 'failed'
+        print("  ✅ QIWI create/check works")
+        
+        payment = await manager.create_payment('crypto', 29900, 'vpn_3', 'VPN')
+        assert payment['payment_id'] == 'uuid-1'
+        assert await manager.check_payment('crypto', 'uuid-1') == 'pending'
+        print("  ✅ Cryptomus signed create/check works")
+        
+        # Concurrent checks must reuse keep-alive connections of the provider session
+        server.peers.clear()
+        await asyncio.gather(*[manager.check_payment('yoomoney', f"req_{i}") for i in range(50)])
+        assert len(server.peers) <= manager.yoomoney.limit
+        print(f"  ✅ 50 concurrent checks used {len(server.peers)} connection(s)")
+    finally:
+        await manager.close()
+        await server.stop()
+
+
+async def _run_timeout():
+    from bot.utils.payments import PaymentManager, PaymentError
+    
+    server = StubProviderServer()
+    await server.start()
+    server.delay = 2
+    manager = PaymentManager(provider_options={'yoomoney': {'base_url': server.base_url, 'timeout': 0.5}})
+    
+    try:
+        started = asyncio.get_running_loop().time()
+        try:
+            await manager.create_payment('yoomoney', 29900, 'vpn_slow', 'VPN')
+            raise AssertionError("Timeout was not raised")
+        except PaymentError:
+            pass
+        assert asyncio.get_running_loop().time() - started < 1.5
+        print("  ✅ Slow provider is cut off by the per-provider timeout")
+    finally:
+        await manager.close()
+        await server.stop()
+
+
+class FakePaymentManager:
+    """Payment manager returning predefined statuses and tracking concurrency"""
+    
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.calls = 0
+        self.in_flight = {}
+        self.max_in_flight = {}
+    
+    async def check_payment(self, method, payment_id):
+        self.calls += 1
+        self.in_flight[method] = self.in_flight.get(method, 0) + 1
+        self.max_in_flight[method] = max(self.max_in_flight.get(method, 0), self.in_flight[method])
+        await asyncio.sleep(0.01)
+        self.in_flight[method] -= 1
+        return self.statuses.get(payment_id, 'pending')
+
+
+async def _run_reconciliation(database_url):
+    from datetime import datetime, timedelta
+    from sqlalchemy import select
+    from bot.models.database import get_db_manager, close_db_managers, User, Payment, Subscription
+    from bot.utils.reconciliation import PaymentReconciler
+    
+    db_manager = get_db_manager(database_url)
+    await db_manager.create_tables_async()
+    now = datetime.utcnow()
+    
+    try:
+        async with db_manager.get_async_session() as session:
+            user = User(telegram_id=1001, first_name='Test')
+            session.add(user)
+            await session.flush()
+            
+            statuses = {}
+            for i in range(30):
+                method = ('yoomoney', 'qiwi', 'crypto')[i % 3]
+                status = ('completed', 'failed', 'pending')[i % 3] if i < 27 else 'pending'
+                expires_at = now + timedelta(minutes=30) if i < 27 else now - timedelta(minutes=1)
+                session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method=method,
+                                    payment_id=f"ext_{i}", expires_at=expires_at))
+                statuses[f"ext_{i}"] = status
+            statuses.update({'ext_old_paid': 'completed', 'ext_old_unknown': 'unknown'})
+            # Long expired payments (e.g. after downtime) get one last check before they expire
+            session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='qiwi',
+                                payment_id='ext_old', expires_at=now - timedelta(days=1)))
+            session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='qiwi',
+                                payment_id='ext_old_paid', expires_at=now - timedelta(days=1)))
+            session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='qiwi',
+                                payment_id='ext_old_unknown', expires_at=now - timedelta(days=1)))
+            # Never registered with a provider, nothing to ask
+            session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='qiwi',
+                                expires_at=now - timedelta(days=1)))
+            await session.commit()
+        
+        manager = FakePaymentManager(statuses)
+        reconciler = PaymentReconciler(manager, batch_size=10, concurrency=2, grace_seconds=300)
+        stats = await reconciler.run()
+        
+        assert manager.calls == 33, manager.calls
+        assert max(manager.max_in_flight.values()) <= 2, manager.max_in_flight
+        assert stats['completed'] == 10 and stats['failed'] == 9, stats
+        assert stats['expired'] == 6, stats
+        print(f"  ✅ 33 pending payments reconciled in {stats['last_duration_ms']:.0f} ms")
+        
+        async with db_manager.get_async_session() as session:
+            subscriptions = (await session.execute(select(Subscription))).scalars().all()
+            pending = (await session.execute(select(Payment).filter_by(status='pending'))).scalars().all()
+        assert len(subscriptions) == 10 and len(pending) == 9
+        
+        # Second pass does not touch processed payments
+        manager.calls = 0
+        stats = await reconciler.run()
+        assert manager.calls == 9 and stats['completed'] == 0
+        print(f"  ✅ Processed payments skipped, lag {stats['lag_seconds']:.2f} s")
+        
+        # Provider error after expiry (within grace) is no answer, the payment stays pending
+        async with db_manager.get_async_session() as session:
+            late = Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='qiwi',
+                           payment_id='ext_late', expires_at=now - timedelta(minutes=1))
+            session.add(late)
+            await session.commit()
+        manager.statuses['ext_late'] = 'unknown'
+        stats = await reconciler.run()
+        async with db_manager.get_async_session() as session:
+            assert (await session.get(Payment, late.id)).status == 'pending'
+        
+        manager.statuses['ext_late'] = 'pending'
+        stats = await reconciler.run()
+        async with db_manager.get_async_session() as session:
+            assert (await session.get(Payment, late.id)).status == 'expired'
+        print("  ✅ Unanswered check does not expire a payment")
+    finally:
+        await close_db_managers()
+
+
+def test_payment_reconciliation():
+    """Test background payment reconciliation pass"""
+    print("🔄 Testing payment reconciliation...")
+    
+    import tempfile
+    from bot.config.settings import Config
+    
+    database_url = Config.DATABASE_URL
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            # Billing and reconciliation use the default database manager
+            Config.DATABASE_URL = f"sqlite:///{tmp}/reconcile.db"
+            asyncio.run(_run_reconciliation(Config.DATABASE_URL))
+        print("✅ Payment reconciliation test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Payment reconciliation test failed: {e!r}")
+        return False
+    finally:
+        Config.DATABASE_URL = database_url
+
+
+def _yoomoney_form(label, amount, currency='643'):
+    """Signed YooMoney incoming transfer notification"""
+    import hashlib
+    form = {'notification_type': 'p2p-incoming', 'operation_id': f"op_{label}_{amount}", 'amount': amount,
+            'currency': currency, 'datetime': '2024-01-01T00:00:00Z', 'sender': '4100', 'codepro': 'false',
+            'label': label}
+    check_string = '&'.join([form[k] for k in ['notification_type', 'operation_id', 'amount', 'currency',
+                                               'datetime', 'sender', 'codepro']] + ['test_yoomoney_secret', label])
+    form['sha1_hash'] = hashlib.sha1(check_string.encode()).hexdigest()
+    return form
+
+
+async def _run_webhooks(database_url):
+    from aiohttp.test_utils import TestClient, TestServer
+    from bot.models.database import get_db_manager, close_db_managers, User, Payment
+    from bot.utils.payments import PaymentManager
+    from bot.utils.webhooks import PaymentWebhookServer
+    
+    class RecordingWebhookServer(PaymentWebhookServer):
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.delivered = []
+        
+        async def deliver(self, completion):
+            self.delivered.append(completion['payment'].id)
+    
+    db_manager = get_db_manager(database_url)
+    await db_manager.create_tables_async()
+    server = RecordingWebhookServer(None, PaymentManager())
+    client = TestClient(TestServer(server.create_app()))
+    await client.start_server()
+    
+    async def status(payment_id):
+        async with db_manager.get_async_session() as session:
+            return (await session.get(Payment, payment_id)).status
+    
+    try:
+        async with db_manager.get_async_session() as session:
+            user = User(telegram_id=1002, first_name='Test')
+            session.add(user)
+            await session.flush()
+            payment = Payment(user_id=user.id, amount=269900, plan_type='12_months', payment_method='yoomoney')
+            session.add(payment)
+            await session.commit()
+        label = f"vpn_{payment.id}"
+        
+        # A short transfer or another currency with the right label leaves the payment pending
+        for form in (_yoomoney_form(label, '1.00'), _yoomoney_form(label, '2698.99'),
+                     _yoomoney_form(label, '2699.00', currency='840')):
+            response = await client.post('/webhook/yoomoney', data=form)
+            assert response.status == 200
+            await server.wait()
+            assert await status(payment.id) == 'pending' and server.delivered == []
+        print("  ✅ Short or foreign currency transfer left pending")
+        
+        response = await client.post('/webhook/yoomoney', data=_yoomoney_form(label, '2699.00'))
+        assert response.status == 200
+        await server.wait()
+        assert await status(payment.id) == 'completed' and server.delivered == [payment.id]
+        print("  ✅ Full transfer completes the payment")
+        
+        # Money that arrives after the payment expired still completes it
+        async with db_manager.get_async_session() as session:
+            expired = Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='yoomoney',
+                              status='expired')
+            session.add(expired)
+            await session.commit()
+        response = await client.post('/webhook/yoomoney', data=_yoomoney_form(f"vpn_{expired.id}", '299.00'))
+        assert response.status == 200
+        await server.wait()
+        assert await status(expired.id) == 'completed' and server.delivered == [payment.id, expired.id]
+        print("  ✅ Paid notification after expiry completes the payment")
+    finally:
+        await client.close()
+        await close_db_managers()
+
+
+def test_payment_webhooks():
+    """Test provider notifications complete only fully paid payments"""
+    print("🔔 Testing payment webhooks...")
+    
+    import tempfile
+    from bot.config.settings import Config
+    
+    database_url = Config.DATABASE_URL
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            Config.DATABASE_URL = f"sqlite:///{tmp}/webhooks.db"
+            asyncio.run(_run_webhooks(Config.DATABASE_URL))
+        print("✅ Payment webhooks test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Payment webhooks test failed: {e!r}")
+        return False
+    finally:
+        Config.DATABASE_URL = database_url
+
+
+def test_payment_providers():
+    """Test payment providers against stub server"""
+    print("💳 Testing payment providers...")
+    
+    try:
+        asyncio.run(_run_providers())
+        print("✅ Payment providers test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Payment providers test failed: {e!r}")
+        return False
+
+
+def test_payment_timeout():
+    """Test provider request timeout"""
+    print("⏱️ Testing payment provider timeout...")
+    
+    try:
+        asyncio.run(_run_timeout())
+        print("✅ Payment timeout test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Payment timeout test failed: {e!r}")
+        return False
+
+
+def test_payment_notifications():
+    """Test webhook notification signature verification"""
+    print("🔔 Testing payment notifications...")
+    
+    try:
+        import hashlib
+        import hmac
+        from bot.utils.payments import PaymentManager, PaymentError, Notification
+        
+        manager = PaymentManager()
+        
+        # Cryptomus: signature over payload without 'sign'
+        payload = {'order_id': 'vpn_7', 'status': 'paid', 'uuid': 'uuid-7', 'amount': '299', 'currency': 'RUB'}
+        payload['sign'] = manager.cryptomus._generate_signature(dict(payload))
+        assert manager.cryptomus.parse_notification(payload, {}) == Notification('vpn_7', 'completed', 29900, 'RUB')
+        try:
+            manager.cryptomus.parse_notification(dict(payload, status='fail'), {})
+            raise AssertionError("Tampered Cryptomus notification accepted")
+        except PaymentError:
+            pass
+        print("  ✅ Cryptomus signature verified")
+        
+        # QIWI: HMAC-SHA256 header
+        bill = {'billId': 'vpn_8', 'siteId': 'site', 'status': {'value': 'PAID'},
+                'amount': {'currency': 'RUB', 'value': '299.00'}}
+        check_string = 'RUB|299.00|vpn_8|site|PAID'
+        signature = hmac.new(b'test_qiwi_secret', check_string.encode(), hashlib.sha256).hexdigest()
+        headers = {'X-Api-Signature-SHA256': signature}
+        assert manager.qiwi.parse_notification({'bill': bill}, headers) == Notification('vpn_8', 'completed', 29900, 'RUB')
+        print("  ✅ QIWI signature verified")
+        
+        # YooMoney: sha1_hash of notification fields
+        form = {'notification_type': 'p2p-incoming', 'operation_id': '1', 'amount': '299.00',
+                'currency': '643', 'datetime': '2024-01-01T00:00:00Z', 'sender': '4100', 'codepro': 'false',
+                'label': 'vpn_9'}
+        check_string = '&'.join([form[k] for k in ['notification_type', 'operation_id', 'amount', 'currency',
+                                                   'datetime', 'sender', 'codepro']] + ['test_yoomoney_secret', 'vpn_9'])
+        form['sha1_hash'] = hashlib.sha1(check_string.encode()).hexdigest()
+        assert manager.yoomoney.parse_notification(form, {}) == Notification('vpn_9', 'completed', 29900, 'RUB')
+        print("  ✅ YooMoney signature verified")
+        
+        # Without a configured secret every notification is rejected, even one signed with ''
+        from bot.config.settings import Config
+        saved = Config.QIWI_SECRET_KEY, Config.YOOMONEY_NOTIFICATION_SECRET
+        try:
+            Config.QIWI_SECRET_KEY = Config.YOOMONEY_NOTIFICATION_SECRET = None
+            headers = {'X-Api-Signature-SHA256': hmac.new(b'', check_string.encode(), hashlib.sha256).hexdigest()}
+            form['sha1_hash'] = hashlib.sha1(check_string.replace('test_yoomoney_secret', '').encode()).hexdigest()
+            for provider, payload, provider_headers in ((manager.qiwi, {'bill': bill}, headers),
+                                                        (manager.yoomoney, form, {})):
+                try:
+                    provider.parse_notification(payload, provider_headers)
+                    raise AssertionError(f"{provider.name} notification accepted without a secret")
+                except PaymentError:
+                    pass
+            
+            saved_bot = Config.BOT_TOKEN, Config.ADMIN_IDS
+            Config.BOT_TOKEN, Config.ADMIN_IDS = 'test_token', [1]
+            Config.PAYMENT_WEBHOOK_ENABLED = True
+            try:
+                Config.validate()
+                raise AssertionError("Payment webhooks enabled without provider secrets")
+            except ValueError as e:
+                assert 'YOOMONEY_NOTIFICATION_SECRET' in str(e)
+            finally:
+                Config.BOT_TOKEN, Config.ADMIN_IDS = saved_bot
+                Config.PAYMENT_WEBHOOK_ENABLED = False
+        finally:
+            Config.QIWI_SECRET_KEY, Config.YOOMONEY_NOTIFICATION_SECRET = saved
+        print("  ✅ Notifications rejected without secrets")
+        
+        print("✅ Payment notifications test passed")
+        return True
+    except Exception as e:
+        print(f"❌ Payment notifications test failed: {e!r}")
+        return False
+
+
+def main():
+    """Run all tests"""
+    print("🚀 Starting payment provider tests...\n")
+    
+    tests = [
+        test_payment_providers,
+        test_payment_timeout,
+        test_payment_notifications,
+        test_payment_webhooks,
+        test_payment_reconciliation
+    ]
+    
+    passed = 0
+    total = len(tests)
+    
+    for test in tests:
+        if test():
+            passed += 1
+        print()
+    
+    print(f"📊 Test Results: {passed}/{total} tests passed")
+    return passed == total
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
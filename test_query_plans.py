@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Index advisor check: runs the bot's handlers and background jobs against a
+SQLite database, then EXPLAINs every query they issued and fails on full
+table scans
+"""
+
+import os
+import re
+import sys
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('BOT_TOKEN', '123456:test_token')
+os.environ.setdefault('YOOMONEY_TOKEN', 'test_yoomoney_token')
+
+from sqlalchemy import event
+
+ADMIN_ID = 111
+
+# "SCAN users" without "USING ... INDEX" reads every row of the table
+FULL_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+class QueryRecorder:
+    """Collects distinct statements executed on an engine"""
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = {}
+    
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        self.statements.setdefault(statement, parameters)
+    
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before_execute)
+        return self
+    
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._before_execute)
+
+
+def full_scans(connection, statement, parameters, tables):
+    """Tables the SQLite planner reads without an index for statement"""
+    plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    scans = []
+    for row in plan:
+        match = FULL_SCAN.match(row[-1])
+        if match and match.group(1) in tables:
+            scans.append(match.group(1))
+    return scans
+
+
+def make_update(user_id, data=None, args=None, text=None):
+    """Fake Update and context good enough for the handlers"""
+    update = MagicMock()
+    update.effective_user.id = user_id
+    update.effective_user.username = f"user{user_id}"
+    update.effective_user.first_name = 'Test'
+    update.effective_user.last_name = None
+    update.effective_user.language_code = 'ru'
+    update.effective_chat.id = user_id
+    update.message.reply_text = AsyncMock()
+    update.message.text = text
+    if data is None:
+        update.callback_query = None
+    else:
+        update.callback_query.data = data
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        update.callback_query.message.chat_id = user_id
+        update.callback_query.message.message_id = 1
+    
+    context = MagicMock()
+    context.args = args or []
+    context.user_data = {}
+    for method in ('send_message', 'edit_message_text', 'send_document', 'send_photo', 'send_media_group', 'get_me'):
+        setattr(context.bot, method, AsyncMock())
+    context.bot.get_me.return_value.username = 'vpnbot'
+    context.bot.send_media_group.return_value = [MagicMock(), MagicMock()]
+    context.bot.send_media_group.return_value[0].document.file_id = 'config-file-id'
+    context.bot.send_media_group.return_value[1].document.file_id = 'qr-file-id'
+    return update, context
+
+
+async def seed(db_manager):
+    """A few users with subscriptions, payments and keys"""
+    from bot.models.database import User, Subscription, Payment, VPNKey
+    
+    now = datetime.utcnow()
+    async with db_manager.get_async_session() as session:
+        for i in range(20):
+            user = User(telegram_id=1000 + i, referral_code=f"REF{i}",
+                        created_at=now - timedelta(days=i), last_activity=now - timedelta(days=i))
+            session.add(user)
+            await session.flush()
+            session.add(Subscription(user_id=user.id, plan_type='1_month', is_active=True,
+                                     start_date=now - timedelta(days=i), end_date=now + timedelta(days=30 - 2 * i)))
+            session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='crypto',
+                                status='completed', created_at=now - timedelta(days=i),
+                                completed_at=now - timedelta(days=i)))
+            session.add(Payment(user_id=user.id, amount=29900, plan_type='1_month', payment_method='qiwi',
+                                status='pending', created_at=now - timedelta(minutes=i),
+                                expires_at=now + timedelta(minutes=15 - i)))
+            session.add(VPNKey(key_data=f"key{i}", server_location='Netherlands', is_used=i % 2 == 0))
+        await session.commit()
+
+
+async def exercise(hm, ha):
+    """Run user and admin handlers plus background jobs"""
+    from bot.utils.activity import activity_tracker
+    from bot.utils.broadcast import broadcast_manager
+    from bot.utils.rollups import stats_rollup
+    from bot.utils.reconciliation import PaymentReconciler
+    from bot.utils.keys import key_allocator
+    from bot.utils.addresses import address_allocator
+    from bot.utils.servers import server_registry
+    
+    payment_manager = hm.payment_manager
+    payment_manager.create_payment = AsyncMock(return_value={
+        'payment_id': 'ext-1', 'payment_url': 'https://pay.test/ext-1'
+    })
+    payment_manager.check_payment = AsyncMock(return_value='pending')
+    
+    update, context = make_update(ADMIN_ID)
+    await hm.start_command(update, context)
+    update, context = make_update(1000)
+    await hm.start_command(update, context)
+    update, context = make_update(2000, args=['REF0'])
+    await hm.start_command(update, context)
+    
+    for data, handler in [('buy_vpn', hm.show_plans), ('plan_1_month', hm.select_payment_method)]:
+        update, context = make_update(2000, data)
+        await handler(update, context)
+    update, context = make_update(2000, 'pay_crypto')
+    context.user_data['selected_plan'] = '1_month'
+    await hm.process_payment(update, context)
+    payment_id = context.user_data['payment_id']
+    
+    update, context = make_update(2000, f"verify_payment_{payment_id}")
+    await hm.verify_payment(update, context)
+    payment_manager.check_payment.return_value = 'completed'
+    update, context = make_update(2000, f"verify_payment_{payment_id}")
+    await hm.verify_payment(update, context)
+    
+    for data, handler in [('profile', hm.show_profile), ('my_config', hm.show_my_config), ('my_config', hm.show_my_config),
+                          ('referral', hm.show_referral_info), ('main_menu', hm.main_menu)]:
+        update, context = make_update(2000, data)
+        await handler(update, context)
+    
+    update, context = make_update(ADMIN_ID)
+    await ha.admin_panel(update, context)
+    for action in ['refresh', 'users', 'stats', 'keys', 'payments', 'logs', 'settings']:
+        update, context = make_update(ADMIN_ID, f"admin_{action}")
+        await ha.admin_callback_handler(update, context)
+    for segment in ['all', 'active', 'expired', 'referrers', 'inactive:30', 'plan:1_month']:
+        update, context = make_update(ADMIN_ID, f"admin_broadcast_segment_{segment}")
+        await ha.admin_broadcast_segment(update, context)
+    update, context = make_update(ADMIN_ID, text='hello')
+    context.user_data.update(waiting_broadcast=True, broadcast_segment=('active', None))
+    await ha.handle_broadcast_message(update, context)
+    for segment in [('plan', '1_month'), ('referrers', None)]:
+        update, context = make_update(ADMIN_ID, 'admin_broadcast_confirm')
+        context.user_data.update(broadcast_message='hello', broadcast_segment=segment)
+        await ha.admin_broadcast_confirm(update, context)
+        await broadcast_manager.wait()
+    
+    await activity_tracker.flush()
+    await stats_rollup.run()
+    payment_manager.check_payment.return_value = 'pending'
+    await PaymentReconciler(payment_manager, grace_seconds=0).run()
+    await key_allocator.release()
+    await key_allocator.release_stale()
+    await address_allocator.release_expired()
+    await server_registry.release_expired()
+
+
+async def _run_query_plans(tmp):
+    from bot.config.settings import Config
+    from bot.models.database import Base, get_db_manager
+    from bot.models.migrations import ensure_schema_async
+    from bot.utils.cache import user_cache
+    import bot.handlers.main as hm
+    import bot.handlers.admin as ha
+    
+    database_url = f"sqlite:///{os.path.join(tmp, 'plans.db')}"
+    saved = (Config.DATABASE_URL, Config.ADMIN_IDS, hm.db_manager, ha.db_manager)
+    Config.DATABASE_URL = database_url
+    Config.ADMIN_IDS = [ADMIN_ID]
+    db_manager = get_db_manager(database_url)
+    hm.db_manager = ha.db_manager = db_manager
+    user_cache.clear()
+    try:
+        # Schema from migrations, so the check covers the shipped indexes
+        await ensure_schema_async(db_manager)
+        await seed(db_manager)
+        
+        with QueryRecorder(db_manager.async_engine.sync_engine) as recorder:
+            await exercise(hm, ha)
+        
+        tables = set(Base.metadata.tables)
+        problems = []
+        with db_manager.engine.connect() as connection:
+            for statement, parameters in recorder.statements.items():
+                text = ' '.join(statement.split())
+                if not text.upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                    continue
+                # Reading every row is the point of an unfiltered query
+                if ' WHERE ' not in text and ' ORDER BY ' not in text:
+                    continue
+                scans = full_scans(connection, statement, parameters, tables)
+                if scans:
+                    problems.append((scans, text))
+        return len(recorder.statements), problems
+    finally:
+        Config.DATABASE_URL, Config.ADMIN_IDS, hm.db_manager, ha.db_manager = saved
+        user_cache.clear()
+        await db_manager.close_async()
+
+
+def test_query_plans():
+    """Every query issued by handlers and jobs must use an index"""
+    print("🔎 Testing query plans...")
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            checked, problems = asyncio.run(_run_query_plans(tmp))
+        
+        for scans, statement in problems:
+            print(f"   ⚠️ Full scan of {', '.join(scans)}: {statement[-260:]}")
+        assert checked > 20, f"only {checked} statements recorded"
+        assert not problems, f"{len(problems)} statements scan whole tables"
+        
+        print(f"✅ Query plan test passed ({checked} statements)")
+        return True
+    except Exception as e:
+        print(f"❌ Query plan test failed: {e!r}")
+        return False
+
+
+def main():
+    """Run query plan checks"""
+    print("🚀 Starting query plan checks...\n")
+    
+    if test_query_plans():
+        print("\n🎉 All queries use indexes!")
+        return True
+    
+    print("\n⚠️ Some queries scan whole tables. Add indexes before deploying.")
+    return False
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)